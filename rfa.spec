@@ -1,11 +1,23 @@
 # -*- mode: python ; coding: utf-8 -*-
+import sys, os
+from pathlib import Path
+
+# Pregenerate pycparser's lexer and parser tables, so the frozen app doesn't have to build them on first run.
+sys.path.insert(0, os.path.join(SPECPATH, 'src'))
+from project import parser_factory
+
+pycparser_tables_dir = Path(workpath).joinpath(parser_factory.bundled_tables_dir_name)
+parser_factory.write_tables(pycparser_tables_dir)
 
 
 a = Analysis(
     ['src/rfa.py'],
     pathex=[],
     binaries=[],
-    datas=[],
+    datas=[
+        (str(pycparser_tables_dir.joinpath(parser_factory.lextab_name + '.py')), parser_factory.bundled_tables_dir_name),
+        (str(pycparser_tables_dir.joinpath(parser_factory.yacctab_name + '.py')), parser_factory.bundled_tables_dir_name),
+    ],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -4,6 +4,7 @@ from pathlib import Path
 
 from project import ProjectConfig
 from project.patch_generator import PatchGenerator
+from project.build_manifest import BuildManifest
 import util
 
 from commands import SubCommandBase, CommandProcessorArgs
@@ -41,15 +42,25 @@ class GeneratePatchCommand(SubCommandBase):
     class GeneratePatchCommandArgs(CommandProcessorArgs):
         config_path: Path
         output: io.TextIOWrapper
+        force: bool
+        jobs: int
+        profile: bool
 
     def setup_args(self):
         self.parser.add_argument('config_path', type=Path, help="Path of the config file to run. Paths within the config are relative to itself, not the working directory.")
+        self.parser.add_argument('-f', '--force', action='store_true', help="Regenerate every output, even if its inputs haven't changed since the last run.")
+        self.parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Number of specs to process in parallel. Defaults to the number of CPU cores.")
+        self.parser.add_argument('-p', '--profile', action='store_true', help="Print how long each step of processing a spec takes.")
 
     def process(self, args: GeneratePatchCommandArgs) -> Any:
         new_config = ProjectConfig(args.config_path.parent, config_dict=json.loads(args.config_path.read_text()))
-        generator =  PatchGenerator(new_config)
+        manifest = BuildManifest(BuildManifest.path_for_config(args.config_path))
+        manifest.load()
+        generator =  PatchGenerator(new_config, manifest, args.profile)
         
-        generator.process()
+        failed = generator.process(args.force, max(args.jobs, 1))
+        if len(failed) > 0:
+            return f"{len(failed)} of {len(new_config.process_specs)} specs failed: {', '.join(failed)}"
         
         return None
     
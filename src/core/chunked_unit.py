@@ -0,0 +1,354 @@
+import re
+from pycparser import CParser
+from pycparser.c_ast import Node
+
+class TypedefScope(dict):
+    # The file scope a chunk is parsed in: the typedef names declared by the chunks before it,
+    # and whatever the chunk itself declares, which is stored in the dict as the parser goes.
+    def __init__(self, typedef_chunks : dict[str, int], chunk_index : int):
+        super().__init__()
+        self.typedef_chunks = typedef_chunks
+        self.chunk_index = chunk_index
+
+    def get(self, name, default = None):
+        if name in self:
+            return self[name]
+        index = self.typedef_chunks.get(name)
+        if index != None and index < self.chunk_index:
+            return True
+        return default
+
+class Chunk:
+    # One top-level declaration or function definition of a preprocessed translation unit
+    offset : int
+    file : str
+    line : int
+    text : str
+    # Where a function definition's body starts in the text, None if it isn't one
+    body_start : int
+    # What it declares, found from its tokens without parsing them
+    names : list[str]
+    # Enumerators are declared too, but never as typedef names
+    enumerators : list[str]
+    tags : list[str]
+    is_typedef : bool
+
+    def __init__(self, offset : int, file : str, line : int, text : str):
+        super().__init__()
+        self.offset = offset
+        self.file = file
+        self.line = line
+        self.text = text
+        self.body_start = None
+        self.names = []
+        self.enumerators = []
+        self.tags = []
+        self.is_typedef = False
+
+    def get_code(self, with_body : bool = True) -> str:
+        # The text with a marker in front, so it keeps its coords when parsed on its own.
+        # Without its body, a function definition is only declared.
+        text = self.text
+        if not with_body and self.body_start != None:
+            text = text[:self.body_start] + ';'
+        return '# %d %s\n%s' % (self.line, self.file, text)
+
+class ChunkedUnit:
+    # A preprocessed translation unit split into its top-level declarations, which are parsed one at
+    # a time, only once a symbol they declare is looked up. The typedef names declared before each
+    # chunk are tracked so any of them can be parsed on its own.
+
+    # Only what affects where a declaration ends, strings and comments are matched to be skipped
+    special_re = re.compile(
+        r'^[ \t]*#[^\n]*'
+        r'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+        r'|/\*.*?\*/|//[^\n]*'
+        r'|[{}()\[\];]',
+        re.M | re.S)
+    start_re = re.compile(r'^[ \t]*#[^\n]*|/\*.*?\*/|//[^\n]*|\S', re.M | re.S)
+    token_re = re.compile(
+        r'(?:^[ \t]*#[^\n]*|/\*.*?\*/|//[^\n]*)'
+        r'|("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|[A-Za-z_]\w*|\.?\d(?:[eEpP][+-]|[\w.])*|\S)',
+        re.M | re.S)
+    name_re = re.compile(r'[A-Za-z_]\w*')
+    # Runs of spaces outside of literals are all the same to the parser
+    space_re = re.compile(r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|[ \t]+')
+    line_marker_re = re.compile(r'[ \t]*#[ \t]*(?:line[ \t]+)?(\d+)(?:[ \t]+("(?:\\.|[^"\\])*"))?')
+
+    tag_keywords = { 'struct', 'union', 'enum' }
+    type_keywords = {
+        'void', 'char', 'short', 'int', 'long', 'float', 'double', 'signed', 'unsigned',
+        '_Bool', '_Complex', '__int128', 'struct', 'union', 'enum',
+    }
+    other_keywords = {
+        'typedef', 'extern', 'static', 'auto', 'register', 'const', 'volatile', 'restrict',
+        'inline', '_Noreturn', '_Thread_local', '_Atomic', '_Alignas', '__inline', '__restrict',
+    }
+    brackets = { '(' : 1, '[' : 1, '{' : 1, ')' : -1, ']' : -1, '}' : -1 }
+
+    filename : str
+    parser : CParser
+    chunks : list[Chunk]
+    # Chunks by the names and tags they declare, removed once they're loaded
+    name_chunks : dict[str, list[int]]
+    tag_chunks : dict[str, list[int]]
+    # Index of the first chunk that declares each typedef name
+    typedef_chunks : dict[str, int]
+    parsed : set[int]
+    # Parsed declarations by cache key, optional. Has get(key) -> list[Node] and put(key, nodes).
+    cache = None
+
+    def __init__(self, text : str, filename : str, parser : CParser, cache = None):
+        super().__init__()
+        self.filename = filename
+        self.parser = parser
+        self.cache = cache
+        self.chunks = []
+        self.name_chunks = {}
+        self.tag_chunks = {}
+        self.typedef_chunks = {}
+        self.parsed = set()
+        self.split(text)
+
+    def _add_chunk(self, chunk : Chunk, head : str):
+        # head is the text that declares something, the chunk's text up to the function body if it has one
+        index = len(self.chunks)
+        self.chunks.append(chunk)
+        tokens = [token for token in self.token_re.findall(head) if token != '']
+        if len(tokens) > 0:
+            self.scan_declaration(chunk, tokens)
+        for name in chunk.names:
+            self.name_chunks.setdefault(name, []).append(index)
+            if chunk.is_typedef:
+                self.typedef_chunks.setdefault(name, index)
+        for name in chunk.enumerators:
+            self.name_chunks.setdefault(name, []).append(index)
+        for tag in chunk.tags:
+            self.tag_chunks.setdefault(tag, []).append(index)
+
+    def _set_position(self, directive : str, line : int, file : str) -> tuple[int, str]:
+        # The line and file after a directive line, if it's a line marker
+        marker = self.line_marker_re.match(directive)
+        if marker != None:
+            line = int(marker.group(1)) - 1
+            if marker.group(2) != None:
+                file = marker.group(2)
+        return (line, file)
+
+    def split(self, text : str):
+        # A chunk ends at a ';' outside of any brackets, or at the '}' of a function body
+        file = '"%s"' % (self.filename.replace('\\', '\\\\').replace('"', '\\"'))
+        line = 1
+        counted = 0
+        end = len(text)
+        find_start = self.start_re.search
+        find_special = self.special_re.search
+
+        i = 0
+        while True:
+            # Line markers and pragmas between declarations
+            m = find_start(text, i)
+            if m == None:
+                break
+            content = m.group()
+            if len(content) > 1 and content[0] == '/':
+                i = m.end()
+                continue
+            line += text.count('\n', counted, m.start())
+            counted = m.start()
+            if not content.lstrip().startswith('#'):
+                start = m.start()
+            elif self.line_marker_re.match(content) != None:
+                (line, file) = self._set_position(content, line, file)
+                counted = i = m.end()
+                continue
+            else:
+                if content.lstrip()[1:].lstrip().startswith('pragma'):
+                    self._add_chunk(Chunk(m.start(), file, line, content), '')
+                i = m.end()
+                continue
+
+            chunk = Chunk(start, file, line, None)
+            depth = 0
+            head_end = None
+            i = start
+            while True:
+                m = find_special(text, i)
+                if m == None:
+                    i = end
+                    break
+                i = m.end()
+                content = m.group()
+                c = content[0]
+                if c == '#' or (c in ' \t' and len(content) > 1):
+                    # A marker within the declaration stays in its text
+                    line += text.count('\n', counted, m.start())
+                    (line, file) = self._set_position(content, line, file)
+                    counted = i
+                elif len(content) > 1:
+                    pass
+                elif c == ';':
+                    if depth <= 0:
+                        break
+                elif c in '([{':
+                    if c == '{' and depth == 0 and head_end == None:
+                        k = m.start() - 1
+                        while k >= start and text[k].isspace():
+                            k -= 1
+                        if k >= start and text[k] == ')':
+                            head_end = i
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth <= 0 and head_end != None:
+                        break
+
+            chunk.text = text[start:i]
+            if head_end != None:
+                chunk.body_start = head_end - 1 - start
+            self._add_chunk(chunk, chunk.text if head_end == None else text[start:head_end] + '}')
+
+    @staticmethod
+    def _is_name(token : str) -> bool:
+        return token[0] == '_' or token[0].isalpha()
+
+    def _skip_brackets(self, tokens : list[str], i : int) -> int:
+        # Returns the index after the bracket closing the one at i
+        depth = 0
+        while i < len(tokens):
+            depth += self.brackets.get(tokens[i], 0)
+            i += 1
+            if depth <= 0:
+                break
+        return i
+
+    def _scan_body(self, chunk : Chunk, tokens : list[str], start : int, end : int, is_enum : bool):
+        # Tags defined in a struct's body are declared at file scope too, as are enumerators
+        i = start
+        expect_enumerator = is_enum
+        while i < end:
+            token = tokens[i]
+            if token in self.tag_keywords:
+                i = self._scan_tag(chunk, tokens, i)
+                continue
+            if is_enum:
+                if expect_enumerator and self._is_name(token):
+                    chunk.enumerators.append(token)
+                expect_enumerator = token == ','
+                if token in self.brackets:
+                    i = self._skip_brackets(tokens, i)
+                    continue
+            i += 1
+
+    def _scan_tag(self, chunk : Chunk, tokens : list[str], i : int) -> int:
+        # tokens[i] is 'struct', 'union' or 'enum', returns the index after the tag and its body
+        is_enum = tokens[i] == 'enum'
+        i += 1
+        tag = None
+        if i < len(tokens) and self._is_name(tokens[i]):
+            tag = tokens[i]
+            i += 1
+        if i < len(tokens) and tokens[i] == '{':
+            if tag != None:
+                chunk.tags.append(tag)
+            end = self._skip_brackets(tokens, i)
+            self._scan_body(chunk, tokens, i + 1, end - 1, is_enum)
+            i = end
+        return i
+
+    def scan_declaration(self, chunk : Chunk, tokens : list[str]):
+        # The declared names are the first name in each declarator that isn't part of the type
+        i = 0
+        seen_type = False
+        while i < len(tokens):
+            token = tokens[i]
+            if not self._is_name(token):
+                i += 1
+            elif token == 'typedef':
+                chunk.is_typedef = True
+                i += 1
+            elif token in self.tag_keywords:
+                seen_type = True
+                i = self._scan_tag(chunk, tokens, i)
+            elif token in self.type_keywords:
+                seen_type = True
+                i += 1
+            elif token in self.other_keywords:
+                i += 1
+            elif token.startswith('__'):
+                # Compiler extensions, like '__extension__' or '__attribute__((...))'
+                i += 1
+                if i < len(tokens) and tokens[i] == '(':
+                    i = self._skip_brackets(tokens, i)
+            elif not seen_type and self.typedef_chunks.get(token, len(self.chunks)) < len(self.chunks) - 1:
+                seen_type = True
+                i += 1
+            else:
+                chunk.names.append(token)
+                # Skips the rest of the declarator, its initializer or the function's body
+                depth = 0
+                i += 1
+                while i < len(tokens):
+                    token = tokens[i]
+                    if token in self.brackets:
+                        if token == '{' and depth == 0:
+                            i = self._skip_brackets(tokens, i)
+                            continue
+                        depth += self.brackets[token]
+                    elif depth <= 0 and (token == ',' or token == ';'):
+                        break
+                    i += 1
+                i += 1
+
+    @staticmethod
+    def parse_in_scope(parser : CParser, text : str, filename : str, scope : dict) -> Node:
+        # CParser.parse, with the file scope given instead of an empty one
+        parser.clex.filename = filename
+        parser.clex.reset_lineno()
+        parser._scope_stack = [scope]
+        parser._last_yielded_token = None
+        return parser.cparser.parse(input=text, lexer=parser.clex)
+
+    @staticmethod
+    def _normalize_space(m : re.Match) -> str:
+        return m.group(1) or ' '
+
+    def get_cache_key(self, index : int, code : str) -> str:
+        # A chunk parses the same wherever it is, as long as the same names in it are typedef names.
+        # Lines are kept, they're in the nodes' coords.
+        typedefs = sorted({ name for name in self.name_re.findall(code) if self.typedef_chunks.get(name, index) < index })
+        return ' '.join(typedefs) + '\n' + self.space_re.sub(self._normalize_space, code)
+
+    def parse_chunk(self, index : int, with_body : bool = True) -> list[tuple[int, Node]]:
+        # Returns the chunk's top-level nodes, with positions that keep them in source order
+        chunk = self.chunks[index]
+        code = chunk.get_code(with_body)
+
+        nodes = None
+        if self.cache != None:
+            key = self.get_cache_key(index, code)
+            nodes = self.cache.get(key)
+        if nodes == None:
+            nodes = self.parse_in_scope(self.parser, code, self.filename, TypedefScope(self.typedef_chunks, index)).ext
+            if self.cache != None:
+                self.cache.put(key, nodes)
+        return [(chunk.offset + i, node) for (i, node) in enumerate(nodes)]
+
+    def _load(self, indices : list[int], with_body : bool = True) -> list[tuple[int, Node]]:
+        res = []
+        for index in indices:
+            if index not in self.parsed:
+                self.parsed.add(index)
+                res += self.parse_chunk(index, with_body)
+        return res
+
+    def load(self, name : str, with_body : bool = True) -> list[tuple[int, Node]]:
+        # Parses every chunk that declares the name and hasn't been parsed yet.
+        # Function bodies are only parsed if asked for, a function that's only called needs its declaration.
+        return self._load(self.name_chunks.pop(name, []), with_body)
+
+    def load_tag(self, name : str) -> list[tuple[int, Node]]:
+        return self._load(self.tag_chunks.pop(name, []))
+
+    def __str__(self) -> str:
+        return "%d of %d declaration(s) parsed" % (len(self.parsed), len(self.chunks))
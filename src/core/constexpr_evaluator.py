@@ -1,253 +1,201 @@
-import sys, shutil, os
-from enum import IntEnum
+import operator
 from types import FunctionType as function
-from collections import deque
-from .doubly_linked_list import DoublyLinkedList
-from copy import deepcopy
-from pathlib import Path
-from .macro import MacroExpression, MacroExpressionNode, MacroSection
+from .macro import MacroExpression, MacroSection
 
 class ConstexprEvaluator:
-    class Associativity(IntEnum):
-        LEFT_TO_RIGHT = 0
-        RIGHT_TO_LEFT = 1
-
-    def __init__(self):
-        super().__init__()
-        self.cond_st : deque[int] = deque()
-
-    def handle_single_arg(self, constexpr : MacroExpression, node : MacroExpressionNode, func : function):
-        if node.next:
-            (symbol, val) = node.next.val
-            if symbol == MacroSection.NUMBER:
-                node.val = (MacroSection.NUMBER, func(val))
-                constexpr.remove(node.next)
-                return None
-        raise Exception("Invalid expression!")
-
-    def handle_double_arg(self, constexpr : MacroExpression, node : MacroExpressionNode, func : function):
-        if node.prev and node.next:
-            (l_symbol, l_val) = node.prev.val
-            (r_symbol, r_val) = node.next.val
-            if l_symbol == MacroSection.NUMBER and r_symbol == MacroSection.NUMBER:
-                node.val = (MacroSection.NUMBER, func(l_val, r_val))
-                constexpr.remove(node.prev)
-                constexpr.remove(node.next)
-                return None
-            else:
-                print(node.prev.val)
-                print(node.val)
-                print(node.next.val)
-        raise Exception("Invalid expression!")
-
-    def handle_PLUS(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_single_arg(constexpr, node, lambda x : x)
-
-    def handle_MINUS(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_single_arg(constexpr, node, lambda x : -x)
-
-    def handle_SUM(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x + y)
-
-    def handle_SUB(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x - y)
+    # Evaluates #if expressions. An expression is parsed in one pass by precedence climbing
+    # and compiled into nested closures, which are then called to get its value.
+    # '&&', '||' and '?:' only evaluate the operands they need, like in C.
+
+    @staticmethod
+    def _divide(x : int, y : int) -> int:
+        # C division truncates towards zero
+        if y == 0:
+            raise Exception("Division by zero in expression!")
+        q = abs(x) // abs(y)
+        return q if (x < 0) == (y < 0) else -q
+
+    @staticmethod
+    def _modulo(x : int, y : int) -> int:
+        return x - y * ConstexprEvaluator._divide(x, y)
+
+    # Shifts are done in intmax_t like cpp does, and a negative count shifts the other way
+    @staticmethod
+    def _shift_left(x : int, y : int) -> int:
+        if y < 0:
+            return x >> -y
+        if y >= 64:
+            return 0
+        x = (x << y) & 0xFFFFFFFFFFFFFFFF
+        return x - (1 << 64) if x >= (1 << 63) else x
+
+    @staticmethod
+    def _shift_right(x : int, y : int) -> int:
+        if y < 0:
+            return ConstexprEvaluator._shift_left(x, -y)
+        return x >> y
+
+    # Binding power and implementation of each binary operator, higher binds tighter
+    binary_operators : dict[str, tuple[int, function]] = {
+        '*' : (10, operator.mul),
+        '/' : (10, _divide),
+        '%' : (10, _modulo),
+        '+' : (9, operator.add),
+        '-' : (9, operator.sub),
+        '<<' : (8, _shift_left),
+        '>>' : (8, _shift_right),
+        '<' : (7, lambda x, y : int(x < y)),
+        '<=' : (7, lambda x, y : int(x <= y)),
+        '>' : (7, lambda x, y : int(x > y)),
+        '>=' : (7, lambda x, y : int(x >= y)),
+        '==' : (6, lambda x, y : int(x == y)),
+        '!=' : (6, lambda x, y : int(x != y)),
+        '&' : (5, operator.and_),
+        '^' : (4, operator.xor),
+        '|' : (3, operator.or_),
+        '&&' : (2, None),
+        '||' : (1, None),
+    }
 
-    def handle_MUL(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x * y)
+    unary_operators : dict[str, function] = {
+        '+' : operator.pos,
+        '-' : operator.neg,
+        '!' : lambda x : int(not x),
+        '~' : operator.invert,
+    }
 
-    def handle_DIV(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x / y)
+    char_escapes = {
+        'n' : '\n',
+        't' : '\t',
+        'r' : '\r',
+        '0' : '\0',
+        '\\' : '\\',
+        '\'' : '\'',
+        '"' : '"',
+    }
 
-    def handle_MOD(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x % y)
+    @staticmethod
+    def _parse_number(content : str) -> int:
+        # Integer literals, suffixes are ignored
+        content = content.rstrip('uUlL')
+        try:
+            if content[:2] in { '0x', '0X' }:
+                return int(content[2:], 16)
+            if content[:2] in { '0b', '0B' }:
+                return int(content[2:], 2)
+            if len(content) > 1 and content[0] == '0':
+                return int(content[1:], 8)
+            return int(content)
+        except ValueError:
+            raise Exception("Invalid number \"%s\" in expression!" % (content))
+
+    def _parse_char(self, content : str) -> int:
+        if len(content) >= 3 and content[0] == '\'' and content[-1] == '\'':
+            c = content[1:-1]
+            if len(c) == 1:
+                return ord(c)
+            if len(c) == 2 and c[0] == '\\' and c[1] in self.char_escapes:
+                return ord(self.char_escapes[c[1]])
+        raise Exception("Invalid expression!")
 
-    def handle_NOT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_single_arg(constexpr, node, lambda x : not x)
+    def _parse_primary(self, kinds : list[int], texts : list[str], i : int) -> tuple[function, int]:
+        if i >= len(texts):
+            raise Exception("Expected value in expression!")
 
-    def handle_CONDL(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        try:
-            z = self.cond_st.pop()
-        except IndexError:
-            raise Exception("Invalid expression!")
-        self.handle_double_arg(constexpr, node, lambda x, y : y if x else z)
-
-    def handle_CONDR(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_single_arg(constexpr, node, lambda x : self.cond_st.append(x))
-        constexpr.remove(node)
-
-    def handle_AND(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x and y)
-
-    def handle_OR(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x or y)
-
-    def handle_EQ(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x == y)
-
-    def handle_NEQ(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x != y)
-
-    def handle_LT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x < y)
-
-    def handle_GT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x > y)
-
-    def handle_LEQ(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x <= y)
-
-    def handle_GEQ(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x >= y)
-
-    def handle_BAND(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x & y)
-
-    def handle_BOR(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x | y)
-
-    def handle_BXOR(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x ^ y)
-
-    def handle_BNOT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_single_arg(constexpr, node, lambda x : ~x)
-
-    def handle_BLSHFT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x << y)
-
-    def handle_BRSHFT(self, constexpr : MacroExpression, node : MacroExpressionNode):
-        self.handle_double_arg(constexpr, node, lambda x, y : x >> y)
-
-    operators : dict[str, function] = {
-        'u+' : handle_PLUS,
-        'u-' : handle_MINUS,
-        '+' : handle_SUM,
-        '-' : handle_SUB,
-        '*' : handle_MUL,
-        '/' : handle_DIV,
-        '%' : handle_MOD,
-        '!' : handle_NOT,
-        '?' : handle_CONDL,
-        ':' : handle_CONDR,
-        '&&' : handle_AND,
-        '||' : handle_OR,
-        '==' : handle_EQ,
-        '!=' : handle_NEQ,
-        '<' : handle_LT,
-        '>' : handle_GT,
-        '<=' : handle_LEQ,
-        '>=' : handle_GEQ,
-        '&' : handle_BAND,
-        '|' : handle_BOR,
-        '^' : handle_BXOR,
-        '~' : handle_BNOT,
-        '<<' : handle_BLSHFT,
-        '>>' : handle_BRSHFT,
-    }
+        section = kinds[i]
+        content = texts[i]
+        if section == MacroSection.NUMBER:
+            value = self._parse_number(content)
+            return (lambda : value, i + 1)
+        if section == MacroSection.NAME:
+            # Prefix of a wide character constant, like L'\0'
+            if content in { 'L', 'u', 'U' } and i + 1 < len(texts) and kinds[i + 1] == MacroSection.TEXT:
+                value = self._parse_char(texts[i + 1])
+                return (lambda : value, i + 2)
+            # Identifiers left after macro expansion are 0
+            return (lambda : 0, i + 1)
+        if section == MacroSection.TEXT:
+            value = self._parse_char(content)
+            return (lambda : value, i + 1)
+        if section == MacroSection.OPERATOR:
+            if content == '(':
+                (inner, i) = self._parse_expression(kinds, texts, i + 1, 0)
+                if i >= len(texts) or texts[i] != ')':
+                    raise Exception("Invalid expression!")
+                return (inner, i + 1)
+
+            func = self.unary_operators.get(content)
+            if func != None:
+                (operand, i) = self._parse_primary(kinds, texts, i + 1)
+                return (lambda : func(operand()), i)
+        raise Exception("Invalid expression!")
 
-    precedence : list[tuple[int, set[str]]] = [
-        (Associativity.RIGHT_TO_LEFT, {'u+', 'u-', '!', '~'}),
-        (Associativity.LEFT_TO_RIGHT, {'*', '/', '%'}),
-        (Associativity.LEFT_TO_RIGHT, {'+', '-'}),
-        (Associativity.LEFT_TO_RIGHT, {'<<', '>>'}),
-        (Associativity.LEFT_TO_RIGHT, {'<', '<=', '>', '>='}),
-        (Associativity.LEFT_TO_RIGHT, {'==', '!='}),
-        (Associativity.LEFT_TO_RIGHT, {'&'}),
-        (Associativity.LEFT_TO_RIGHT, {'^'}),
-        (Associativity.LEFT_TO_RIGHT, {'|'}),
-        (Associativity.LEFT_TO_RIGHT, {'&&'}),
-        (Associativity.LEFT_TO_RIGHT, {'||'}),
-        (Associativity.RIGHT_TO_LEFT, {'?', ':'}),
-    ]
-
-    def _eval_simplify_constexpr(self, constexpr : MacroExpression):
-        current = constexpr.begin
-        parenth_level = 0
-        f : MacroExpressionNode = None
-        t : MacroExpressionNode = None
-        while current != None:
-            (section, content) = current.val
-            match section:
-                case MacroSection.OPERATOR:
-                    if content == '(':
-                        if parenth_level == 0:
-                            f = current.next
-                        parenth_level += 1
-                        constexpr.remove(current)
-                    elif content == ')':
-                        parenth_level -= 1
-                        if parenth_level == 0:
-                            if f == current:
-                                raise Exception("Expected value in expression!")
-                            t = current.prev
-
-                            constexpr = constexpr.extract_list(f, t)
-                            current.val = (MacroSection.NUMBER, self._eval(constexpr))
-                        elif parenth_level < 0:
-                            raise Exception("Invalid expression!")
-                        else:
-                            constexpr.remove(current)
-                case MacroSection.NUMBER:
-                    # TODO Support more number formats
-                    num : int
-                    try:
-                        num = int(content)
-                    except ValueError:
-                        # Temporary solution for suffixes
-                        i = len(content)
-                        while i > 0:
-                            i -= 1
-                            c = content[i]
-                            if c.isdigit():
-                                break
-                        updated_content = content[0 : i + 1]
-                        num = int(updated_content)
-                    current.val = (section, num)
-                case MacroSection.WHITESPACE:
-                    constexpr.remove(current)
-                case MacroSection.NAME:
-                    current.val = (MacroSection.NUMBER, 0)
-            current = current.next
-
-    def _eval_detect_unary_plus_minus(self, constexpr : MacroExpression):
-        prev = MacroSection.OPERATOR
-        current = constexpr.begin
-        while current != None:
-            (symbol, val) = current.val
-            if symbol == MacroSection.OPERATOR and prev == symbol and (val == '+' or val == '-'):
-                current.val = (MacroSection.OPERATOR, 'u' + val)
-            prev = symbol
-            current = current.next
-
-    def _eval_process_operators(self, constexpr : MacroExpression):
-        for (associativity, symbol_set) in self.precedence:
-            if associativity == self.Associativity.LEFT_TO_RIGHT:
-                current = constexpr.begin
+    def _parse_expression(self, kinds : list[int], texts : list[str], i : int, min_precedence : int) -> tuple[function, int]:
+        (lhs, i) = self._parse_primary(kinds, texts, i)
+
+        end = len(texts)
+        while i < end and kinds[i] == MacroSection.OPERATOR:
+            content = texts[i]
+            if content == '?':
+                # Lowest precedence, and right-associative
+                if min_precedence > 0:
+                    break
+                (if_true, i) = self._parse_expression(kinds, texts, i + 1, 0)
+                if i >= end or texts[i] != ':':
+                    raise Exception("Invalid expression!")
+                (if_false, i) = self._parse_expression(kinds, texts, i + 1, 0)
+                lhs = self._make_conditional(lhs, if_true, if_false)
+                continue
+
+            binary = self.binary_operators.get(content)
+            if binary == None:
+                break
+            (precedence, func) = binary
+            if precedence < min_precedence:
+                break
+
+            # Left-associative, the right operand only takes tighter operators
+            (rhs, i) = self._parse_expression(kinds, texts, i + 1, precedence + 1)
+            if content == '&&':
+                lhs = self._make_and(lhs, rhs)
+            elif content == '||':
+                lhs = self._make_or(lhs, rhs)
             else:
-                current = constexpr.end
-
-            while current != None:
-                (symbol, val) = current.val
-                if symbol == MacroSection.OPERATOR and val in symbol_set:
-                    self.operators[val](self, constexpr, current)
-                if associativity == self.Associativity.LEFT_TO_RIGHT:
-                    current = current.next
-                else:
-                    current = current.prev
-
-        if len(self.cond_st) > 0:
-            raise Exception("Invalid expression!")
-
-    def _eval(self, constexpr : MacroExpression) -> int:
-        self._eval_simplify_constexpr(constexpr)
-        self._eval_detect_unary_plus_minus(constexpr)
-        self._eval_process_operators(constexpr)
+                lhs = self._make_binary(func, lhs, rhs)
+        return (lhs, i)
+
+    @staticmethod
+    def _make_binary(func : function, lhs : function, rhs : function) -> function:
+        return lambda : func(lhs(), rhs())
+
+    @staticmethod
+    def _make_and(lhs : function, rhs : function) -> function:
+        return lambda : 1 if lhs() and rhs() else 0
+
+    @staticmethod
+    def _make_or(lhs : function, rhs : function) -> function:
+        return lambda : 1 if lhs() or rhs() else 0
+
+    @staticmethod
+    def _make_conditional(cond : function, if_true : function, if_false : function) -> function:
+        return lambda : if_true() if cond() else if_false()
+
+    def compile(self, constexpr : MacroExpression) -> function:
+        # Returns a function that evaluates the expression
+        kinds = []
+        texts = []
+        for (section, content) in constexpr:
+            if section != MacroSection.WHITESPACE:
+                kinds.append(section)
+                texts.append(content)
+
+        if len(texts) == 0:
+            raise Exception("Expected value in expression!")
 
-        if constexpr.begin != constexpr.end:
+        (res, i) = self._parse_expression(kinds, texts, 0, 0)
+        if i != len(texts):
             raise Exception("Invalid expression!")
-
-        return constexpr.begin.val[1]
+        return res
 
     def eval(self, constexpr : MacroExpression) -> int:
-        if constexpr.is_empty():
-            raise Exception("Expected value in expression!")
-        return self._eval(constexpr)
\ No newline at end of file
+        return self.compile(constexpr)()
@@ -2,11 +2,16 @@ import sys, shutil, os
 from enum import IntEnum
 from types import FunctionType as function
 from collections import deque
-from copy import deepcopy
 from pathlib import Path
 
-from .macro import MacroSection, MacroExpression, MacroExpressionNode, Macro, ObjectMacro, FunctionMacro, VariadicMacro, MacroSource, ExternalSource, CodeSource, FUNCTION_MACRO_PREFIX
+from .macro import MacroSection, MacroExpression, Macro, ObjectMacro, FunctionMacro, VariadicMacro, MacroSource, ExternalSource, CodeSource, FUNCTION_MACRO_PREFIX
 from .constexpr_evaluator import ConstexprEvaluator
+from .macro_expander import ExpansionEngine, MacroExpander
+from .include_index import IncludeIndex, shared_include_index
+from .include_graph import IncludeGraph
+from .header_cache import HeaderCache, HeaderRecord, MacroState, FileState, macro_definition, macro_kinds
+from .section_reader import ReaderEngine, SectionReader
+from .output_writer import OutputWriter
 
 class FunctionDefState(IntEnum):
     OUTSIDE = 0
@@ -37,6 +42,110 @@ class StoredSection:
     def __str__(self):
         return f"{self.section.name} @ {self.line},{self.pos}"
 
+class ConditionCacheEntry:
+    # A compiled #if/#elif expression and its value. It's valid while every macro it looked up,
+    # defined or not, still has the generation it had when the expression was compiled.
+    evaluate : function
+    value : int
+    dependencies : list[tuple[str, int]]
+
+    def __init__(self, evaluate : function, value : int, dependencies : list[tuple[str, int]]):
+        self.evaluate = evaluate
+        self.value = value
+        self.dependencies = dependencies
+
+class PreprocessorSnapshot:
+    # The state a Preprocessor is left in after reading some files, like a prelude every
+    # translation unit starts with. Any number of preprocessors can be forked from one snapshot.
+    # The tables are copied when forking, but the macros in them are shared: a macro is never
+    # modified after it's defined, (re)defining a name just replaces the table entry.
+    macros : dict[str, Macro]
+    macro_generations : dict[str, int]
+    condition_cache : dict[str, ConditionCacheEntry]
+    conditional_segment : tuple
+    cond_st : tuple
+    inactive_level : int
+    include_guards : dict[str, str]
+    once_files : frozenset[str]
+    files : frozenset[str]
+    # The output so far, and the source position it ended at, if the preprocessor was writing any
+    output : str | None
+    output_file : str
+    output_line : int
+
+    def __init__(self, preproc : "Preprocessor"):
+        self.macros = dict(preproc.macros)
+        self.macro_generations = dict(preproc.macro_generations)
+        self.condition_cache = dict(preproc.condition_cache)
+        self.conditional_segment = preproc.conditionalSegment
+        self.cond_st = tuple(preproc.cond_st)
+        self.inactive_level = preproc.inactive_level
+        self.include_guards = dict(preproc.include_guards)
+        self.once_files = frozenset(preproc.once_files)
+        # Every file that was included, the files that were run directly only if they include something
+        self.files = frozenset(preproc.include_graph.files())
+        self.output = None
+        self.output_file = None
+        self.output_line = 0
+        if preproc.output_writer != None:
+            self.output = preproc.output_writer.get_text()
+            self.output_file = preproc.output_writer.file
+            self.output_line = preproc.output_writer.line
+
+    def __getstate__(self) -> dict:
+        # Compiled conditions are closures, which can't be pickled
+        state = dict(self.__dict__)
+        state["condition_cache"] = {}
+        return state
+
+class IncludeGuardState(IntEnum):
+    START = 0
+    INSIDE = 1
+    AFTER = 2
+    INVALID = 3
+
+class IncludeGuardDetector:
+    # Tracks whether a header is entirely wrapped in '#ifndef X ... #endif',
+    # in which case re-reading it is pointless while X stays defined.
+    state: IncludeGuardState
+    controlling_macro: str
+    level: int
+
+    def __init__(self):
+        self.state = IncludeGuardState.START
+        self.controlling_macro = None
+        self.level = 0
+
+    def on_directive(self, dir : str, name : str):
+        match self.state:
+            case IncludeGuardState.START:
+                if dir == "ifndef" and name != None:
+                    self.controlling_macro = name
+                    self.state = IncludeGuardState.INSIDE
+                else:
+                    self.state = IncludeGuardState.INVALID
+            case IncludeGuardState.INSIDE:
+                if dir in { "if", "ifdef", "ifndef" }:
+                    self.level += 1
+                elif dir == "endif":
+                    if self.level == 0:
+                        self.state = IncludeGuardState.AFTER
+                    else:
+                        self.level -= 1
+                elif dir in { "elif", "else" } and self.level == 0:
+                    self.state = IncludeGuardState.INVALID
+            case IncludeGuardState.AFTER:
+                self.state = IncludeGuardState.INVALID
+
+    def on_code(self):
+        if self.state != IncludeGuardState.INSIDE:
+            self.state = IncludeGuardState.INVALID
+
+    def get_guard(self) -> str:
+        if self.state == IncludeGuardState.AFTER:
+            return self.controlling_macro
+        return None
+
 class Preprocessor:
     forbidden_macro_names = {
         "defined"
@@ -48,25 +157,70 @@ class Preprocessor:
     include_dirs : list[str]
     recurse_includes: bool
     detected_includes: set[str]
+    include_graph : IncludeGraph
     macros : dict[str, Macro]
+    include_index : IncludeIndex
+    reader_engine : ReaderEngine
+    expansion_engine : ExpansionEngine
+    macro_expander : MacroExpander
+    skip_inactive : bool
+    include_guards : dict[str, str]
+    once_files : set[str]
+    skipped_includes : int
+    macro_generations : dict[str, int]
+    condition_cache : dict[str, ConditionCacheEntry]
+    condition_cache_hits : int
+    condition_cache_misses : int
+    inherited_macros : dict[str, Macro]
+    header_cache : HeaderCache
+    header_recordings : list[HeaderRecord]
+    output_writer : OutputWriter
+    main_includes : set[str]
+    main_macros : dict[str, Macro]
 
     def _add_predefined_macros(self):
         # TODO Implement
         self.new_ObjectMacro("__STDC_VERSION__", ExternalSource("predefined"), "199901L")
 
-    def __init__(self, include_dirs : list[str], standard_c_lib_dir : str, recurse_includes = True):
+    def __init__(self, include_dirs : list[str], standard_c_lib_dir : str, recurse_includes = True, include_index : IncludeIndex = None, reader_engine = ReaderEngine.FAST, skip_inactive = True, expansion_engine = ExpansionEngine.HIDE_SET, header_cache : HeaderCache = None, emit_output = False):
         super().__init__()
 
         self.recurse_includes = recurse_includes
+        self.include_index = include_index if include_index != None else shared_include_index
+        self.reader_engine = reader_engine
+        self.expansion_engine = expansion_engine
+        self.skip_inactive = skip_inactive
+        self.section_reader = SectionReader(self)
 
         self.include_dirs = []
+        self.current_dir = ""
+        self.current_file = ""
         self.conditionalSegment = None
         self.cond_st = deque()
         self.inactive_level = 0
         self.macros = {}
+        self.macro_expander = MacroExpander(self.macros)
         self.detected_includes = set()
         self.sections : dict[str, StoredSection] = {}
-        self.include_graph : dict[str, set[str]]
+        self.include_graph = IncludeGraph()
+        self.include_guards = {}
+        self.once_files = set()
+        self.skipped_includes = 0
+        self.macro_generations = {}
+        self.condition_cache = {}
+        self.condition_cache_hits = 0
+        self.condition_cache_misses = 0
+        self.guard_detectors : list[IncludeGuardDetector] = []
+        self.inherited_macros = {}
+        # Replaying headers needs every macro lookup reported, which only the hide-set engine does
+        self.header_cache = header_cache if expansion_engine == ExpansionEngine.HIDE_SET else None
+        # One per header being read and recorded, innermost last
+        self.header_recordings = []
+        # Writes the preprocessed code, if it's wanted
+        self.output_writer = OutputWriter(self) if emit_output else None
+        # What the files run directly include and define themselves, as opposed to their includes
+        self.main_includes = set()
+        self.main_macros = {}
 
         self._add_predefined_macros()
 
@@ -86,26 +240,105 @@ class Preprocessor:
             included.add(standard_c_lib_dir)
             self.include_dirs += [standard_c_lib_dir]
 
+        self._include_dirs_key = tuple(self.include_dirs)
+
+    def _next_macro_generation(self, name : str):
+        # Counted per name, for both the object-like and the function-like macro
+        name = name.removeprefix(FUNCTION_MACRO_PREFIX)
+        self.macro_generations[name] = self.macro_generations.get(name, 0) + 1
+
     def new_Macro(self, name : str, macro : Macro) -> Macro:
         if name in self.forbidden_macro_names:
             raise Exception("Forbidden macro name!")
+        if len(self.header_recordings) > 0:
+            self._record_macro_write(name.removeprefix(FUNCTION_MACRO_PREFIX))
         self.macros[name] = macro
+        if len(self.guard_detectors) == 0:
+            self.main_macros[name] = macro
+        self._next_macro_generation(name)
         return macro
 
     def new_ObjectMacro(self, name : str, source : MacroSource, definition : str) -> ObjectMacro:
-        return self.new_Macro(name, ObjectMacro(self.macros, source, definition))
+        return self.new_Macro(name, ObjectMacro(source, self.macros, definition))
 
     def new_FunctionMacro(self, name : str, source : MacroSource, definition : str, args : list[str]) -> FunctionMacro:
-        return self.new_Macro(FUNCTION_MACRO_PREFIX + name, FunctionMacro(self.macros, source, definition, args))
+        return self.new_Macro(FUNCTION_MACRO_PREFIX + name, FunctionMacro(source, self.macros, definition, args).check_operators())
 
     def new_VariadicMacro(self, name : str, source : MacroSource, definition : str, args : list[str]) -> FunctionMacro:
-        return self.new_Macro(FUNCTION_MACRO_PREFIX + name, VariadicMacro(self.macros, source, definition, args))
+        return self.new_Macro(FUNCTION_MACRO_PREFIX + name, VariadicMacro(source, self.macros, definition, args).check_operators())
+
+    def snapshot(self) -> PreprocessorSnapshot:
+        return PreprocessorSnapshot(self)
+
+    def fork(self, snapshot : PreprocessorSnapshot):
+        # Continues from the snapshot's state, as if the files it was taken after were read first.
+        # Includes, sections and stats are still only collected from what's read after this.
+        if self.expansion_engine != ExpansionEngine.HIDE_SET:
+            # Legacy expansion looks nested macros up in the table a macro was defined in
+            raise Exception("Forking needs the hide-set expansion engine!")
+
+        self.macros.clear()
+        self.macros.update(snapshot.macros)
+        self.inherited_macros = snapshot.macros
+        self.macro_generations = dict(snapshot.macro_generations)
+        self.condition_cache = dict(snapshot.condition_cache)
+        self.conditionalSegment = snapshot.conditional_segment
+        self.cond_st = deque(snapshot.cond_st)
+        self.inactive_level = snapshot.inactive_level
+        self.include_guards = dict(snapshot.include_guards)
+        self.once_files = set(snapshot.once_files)
+        if self.output_writer != None and snapshot.output != None:
+            self.output_writer.append(snapshot.output, snapshot.output_file, snapshot.output_line)
+
+    def is_inherited_macro(self, name : str) -> bool:
+        # Whether the macro still has the definition it was forked with
+        macro = self.macros.get(name)
+        return macro != None and self.inherited_macros.get(name) is macro
+
+    def handle_command_line_macros(self, flags : list[str]):
+        # Applies the '-D' and '-U' options in a compiler's command line, in order, other options are ignored
+        source = ExternalSource("command line")
+        i = 0
+        while i < len(flags):
+            flag = flags[i]
+            i += 1
+            if flag[:2] not in { "-D", "-U" }:
+                continue
+            arg = flag[2:]
+            if len(arg) == 0 and i < len(flags):
+                arg = flags[i]
+                i += 1
+
+            if flag[:2] == "-U":
+                self.handle_UNDEF(arg, source)
+            else:
+                (name, sep, value) = arg.partition('=')
+                self.handle_DEFINE(name + ' ' + (value if sep != '' else '1'), source)
+
+    def get_output(self) -> str:
+        if self.output_writer == None:
+            raise Exception("The preprocessor isn't writing any output!")
+        return self.output_writer.get_text()
+
+    def expand_macros(self, macroexpr : MacroExpression, looked_up : set[str] = None) -> MacroExpression:
+        # looked_up collects the names that were looked up as macros, the legacy engine doesn't report them
+        if self.expansion_engine == ExpansionEngine.HIDE_SET:
+            return self.macro_expander.expand(macroexpr, looked_up)
+        ObjectMacro(None, self.macros, "")._solve(macroexpr, set())
+        return macroexpr
 
     def print_macros(self):
         for n, m in self.macros.items():
             print("%s : %s" % (n, ObjectMacro.contents_to_string(m.contents)))
         print("\n")
 
+    def print_include_stats(self):
+        print(self.include_index)
+        print("%d guarded include(s) known, %d re-read(s) skipped" % (len(self.include_guards) + len(self.once_files), self.skipped_includes))
+        print("#if cache: %d hit(s), %d miss(es)" % (self.condition_cache_hits, self.condition_cache_misses))
+        if self.header_cache != None:
+            print(self.header_cache)
+
     class ConditionalSegmentStatus(IntEnum):
         DISABLED = 0
         ACTIVE = 1
@@ -201,6 +434,9 @@ class Preprocessor:
                 i += 1
         return (variadic, args, i)
 
+    def get_current_path(self) -> str:
+        return os.path.join(self.current_dir, self.current_file)
+
     def _is_conditional_segment_inactive(self):
         return (self.conditionalSegment != None) and (self.conditionalSegment[0] != self.ConditionalSegmentStatus.ACTIVE)
 
@@ -217,6 +453,8 @@ class Preprocessor:
             if c == '(':
                 i += 1
                 (variadic, args, i) = self._handle_get_macro_args(contents, i, end)
+                # Skip the closing ')'
+                i += 1
 
         definition = contents[i:end]
 
@@ -235,11 +473,21 @@ class Preprocessor:
 
         (name, i) = self._handle_get_identifier(contents, i, end)
 
+        if len(self.header_recordings) > 0:
+            self._record_macro_write(name)
         self.macros.pop(name, None)
+        self.macros.pop(FUNCTION_MACRO_PREFIX + name, None)
+        self._next_macro_generation(name)
+
+    def _is_defined(self, name : str) -> bool:
+        if len(self.header_recordings) > 0:
+            self._record_macro_read(name)
+        # Function-like macros are stored under a prefixed name
+        return name in self.macros or (FUNCTION_MACRO_PREFIX + name) in self.macros
 
     def _handle_check_def(self, contents : str) -> bool:
         (name, i) = self._handle_get_identifier(contents, 0, len(contents))
-        return name in self.macros
+        return self._is_defined(name)
 
     def _get_segment_status(self, current : ConditionalSegmentStatus, activate : bool) -> ConditionalSegmentStatus:
         if current == self.ConditionalSegmentStatus.SKIP or current == self.ConditionalSegmentStatus.ACTIVE:
@@ -256,11 +504,13 @@ class Preprocessor:
         status = self._get_segment_status(self.ConditionalSegmentStatus.DISABLED, func(contents) != 0)
         self.conditionalSegment = (status, source)
 
-    def _handle_defined(self, macroexpr : MacroExpression, origin_node : MacroExpressionNode):
+    def _handle_defined(self, macroexpr : MacroExpression, i : int, looked_up : set[str] = None):
         inParentheses = False
 
-        current = origin_node.next
-        (section, content) = current.val
+        if i + 1 >= len(macroexpr):
+            raise Exception("Invalid expression!")
+        current = i + 1
+        (section, content) = macroexpr[current]
 
         (current, section, content) = ObjectMacro._remove_space(macroexpr, current, section, content)
 
@@ -270,7 +520,9 @@ class Preprocessor:
             (current, section, content) = ObjectMacro._remove_space(macroexpr, current, section, content)
 
         if section == MacroSection.NAME:
-            origin_node.val = (MacroSection.NUMBER, content in self.macros)
+            if looked_up != None:
+                looked_up.add(content)
+            macroexpr.set(i, MacroSection.NUMBER, '1' if self._is_defined(content) else '0')
             (current, section, content) = ObjectMacro._remove_node(macroexpr, current)
         else:
             raise Exception("Invalid expression!")
@@ -283,20 +535,51 @@ class Preprocessor:
             else:
                 raise Exception("Invalid expression!")
 
-    def _check_for_defined(self, macroexpr : MacroExpression):
-        current = macroexpr.begin
-        while current != None:
-            (section, content) = current.val
+    def _check_for_defined(self, macroexpr : MacroExpression, looked_up : set[str] = None):
+        i = 0
+        while i < len(macroexpr):
+            (section, content) = macroexpr[i]
             if section == MacroSection.NAME and content == "defined":
-                self._handle_defined(macroexpr, current)
-            current = current.next
+                self._handle_defined(macroexpr, i, looked_up)
+            i += 1
 
-    def handle_IF(self, contents : str, source):
-        c = ConstexprEvaluator()
+    def _is_condition_cache_entry_valid(self, entry : ConditionCacheEntry) -> bool:
+        generations = self.macro_generations
+        for (name, generation) in entry.dependencies:
+            if generations.get(name, 0) != generation:
+                return False
+        return True
+
+    def _eval_condition(self, contents : str) -> int:
+        # #if/#elif expressions are compiled once per directive text, and their values are reused
+        # until a macro they depend on is defined or undefined
+        entry = self.condition_cache.get(contents)
+        if entry != None and self._is_condition_cache_entry_valid(entry):
+            self.condition_cache_hits += 1
+            if len(self.header_recordings) > 0:
+                for (name, generation) in entry.dependencies:
+                    self._record_macro_read(name)
+            return entry.value
+        self.condition_cache_misses += 1
+
+        looked_up : set[str] = set()
         parsed = ObjectMacro.parse(contents)
-        self._check_for_defined(parsed)
-        ObjectMacro(None, self.macros, "")._solve(parsed, set())
-        self._handle_ifs(contents, source, lambda contents: c.eval(parsed))
+        self._check_for_defined(parsed, looked_up)
+        parsed = self.expand_macros(parsed, looked_up)
+        evaluate = ConstexprEvaluator().compile(parsed)
+        value = evaluate()
+
+        if len(self.header_recordings) > 0:
+            for name in looked_up:
+                self._record_macro_read(name)
+
+        if self.expansion_engine == ExpansionEngine.HIDE_SET:
+            dependencies = [(name, self.macro_generations.get(name, 0)) for name in looked_up]
+            self.condition_cache[contents] = ConditionCacheEntry(evaluate, value, dependencies)
+        return value
+
+    def handle_IF(self, contents : str, source):
+        self._handle_ifs(contents, source, self._eval_condition)
 
     def handle_IFDEF(self, contents : str, source):
         self._handle_ifs(contents, source, lambda contents: self._handle_check_def(contents))
@@ -312,11 +595,7 @@ class Preprocessor:
         self.conditionalSegment = (status, source)
 
     def handle_ELIF(self, contents : str, source):
-        c = ConstexprEvaluator()
-        parsed = ObjectMacro.parse(contents)
-        self._check_for_defined(parsed)
-        ObjectMacro(None, self.macros, "")._solve(parsed, set())
-        self._handle_elifs(contents, source, lambda contents: c.eval(parsed))
+        self._handle_elifs(contents, source, self._eval_condition)
 
     def handle_ELSE(self, contents : str, source):
         if self.conditionalSegment == None:
@@ -336,6 +615,8 @@ class Preprocessor:
 
     def handle_INCLUDE(self, contents : str, source):
         self.detected_includes.add(contents)
+        if len(self.guard_detectors) == 0:
+            self.main_includes.add(contents)
 
         end = len(contents)
         if end > 0:
@@ -352,47 +633,215 @@ class Preprocessor:
                     break
                 i += 1
 
-            (path_dir, path_file) = os.path.split(contents[1:i])
-
-            # find the file using the algorithm specified in the standard
-            # https://en.cppreference.com/w/c/preprocessor/include
-
-            file : str = None
-            if include_type == '"':
-                # Search in the directory of the current file
-                root = os.path.join(self.current_dir, path_dir)
-                if os.path.isdir(root):
-                    for item in os.listdir(root):
-                        if item == path_file:
-                            file = os.path.join(root, path_file)
-                            break
-
-            # Search in the standard include directories
-            for dir in self.include_dirs:
-                root = os.path.join(dir, path_dir)
-                if os.path.isdir(root):
-                    for item in os.listdir(root):
-                        if item == path_file:
-                            file = os.path.join(root, path_file)
-                            break
-                    if file != None:
-                        break
+            file = self.include_index.resolve(include_type, self.current_dir, contents[1:i], self._include_dirs_key)
+            includer = self.get_current_path()
+            line = self._get_directive_line(source)
+            if file != None:
+                self.include_graph.add(includer, file, line)
+            for recording in self.header_recordings:
+                recording.includes.append((contents, include_type, self.current_dir, contents[1:i], file, includer, line))
 
             if self.recurse_includes:
+                if file == None:
+                    raise Exception("Include file not found: %s" % (contents))
+
+                if self._is_include_redundant(file):
+                    self.skipped_includes += 1
+                    for recording in self.header_recordings:
+                        recording.skipped_includes += 1
+                    return None
+
+                recording = None
+                if self.header_cache != None:
+                    file_hash = self.header_cache.hash_file(file)
+                    key = self.header_cache.key(file, file_hash, self._include_dirs_key)
+                    if self._replay_header(file, file_hash, key):
+                        return None
+
+                    for parent in self.header_recordings:
+                        parent.files[file] = file_hash
+                    recording = HeaderRecord(file_hash)
+                    self.header_recordings.append(recording)
+                    if self.output_writer != None:
+                        output_mark = self.output_writer.mark()
+                    conditional_state = (len(self.cond_st), self.conditionalSegment, self.inactive_level)
+
                 text = Path(file).read_text()
                 current_dir = self.current_dir
-                self.current_dir = os.path.split(file)[0]
+                current_file = self.current_file
+                (self.current_dir, self.current_file) = os.path.split(file)
+
+                detector = IncludeGuardDetector()
+                self.guard_detectors.append(detector)
 
                 self.read_include(text)
 
+                self.guard_detectors.pop()
+                guard = detector.get_guard()
+                if guard != None:
+                    if len(self.header_recordings) > 0:
+                        self._record_file_write(file)
+                    self.include_guards[file] = guard
+
+                if recording != None:
+                    self.header_recordings.pop()
+                    # A header that leaves a conditional open or closes one of its includer's can't be replayed
+                    if conditional_state == (len(self.cond_st), self.conditionalSegment, self.inactive_level):
+                        recording.finish(self.macros, FUNCTION_MACRO_PREFIX, self.once_files, self.include_guards)
+                        if self.output_writer != None:
+                            recording.output = self.output_writer.text_since(output_mark)
+                            recording.output_file = self.output_writer.file
+                            recording.output_line = self.output_writer.line
+                        self.header_cache.add(key, recording)
+
                 self.current_dir = current_dir
+                self.current_file = current_file
 
             return None
 
         raise Exception("Invalid include directive!")
 
+    def _is_include_redundant(self, file : str) -> bool:
+        if len(self.header_recordings) > 0:
+            self._record_file_read(file)
+        if file in self.once_files:
+            return True
+        guard = self.include_guards.get(file)
+        if guard != None and len(self.header_recordings) > 0:
+            self._record_macro_read(guard)
+        return guard != None and guard in self.macros
+
+    def _macro_state(self, name : str) -> MacroState:
+        return (macro_definition(self.macros.get(name)), macro_definition(self.macros.get(FUNCTION_MACRO_PREFIX + name)))
+
+    def _file_state(self, file : str) -> FileState:
+        return (file in self.once_files, self.include_guards.get(file))
+
+    # Everything a header touches is reported to every header being recorded. Whatever an inner
+    # recording has seen, the ones around it have seen too, so these stop at the first that has.
+
+    def _record_macro_read(self, name : str):
+        # Only the first touch of a name is an input, later ones see what the header itself did
+        state = None
+        for recording in reversed(self.header_recordings):
+            if name in recording.macro_inputs:
+                break
+            if state == None:
+                state = self._macro_state(name)
+            recording.macro_inputs[name] = state
+
+    def _record_macro_write(self, name : str):
+        # Called before the change. What a name was before it's changed is an input too,
+        # as replaying sets both of its definitions.
+        self._record_macro_read(name)
+        for recording in reversed(self.header_recordings):
+            if name in recording.written_macros:
+                break
+            recording.written_macros.add(name)
+
+    def _record_file_read(self, file : str):
+        state = None
+        for recording in reversed(self.header_recordings):
+            if file in recording.file_inputs:
+                break
+            if state == None:
+                state = self._file_state(file)
+            recording.file_inputs[file] = state
+
+    def _record_file_write(self, file : str):
+        self._record_file_read(file)
+        for recording in reversed(self.header_recordings):
+            if file in recording.written_files:
+                break
+            recording.written_files.add(file)
+
+    def _is_header_record_valid(self, record : HeaderRecord) -> bool:
+        # Records made without output can't be replayed when writing it, and the other way around
+        if (record.output != None) != (self.output_writer != None):
+            return False
+        for (name, state) in record.macro_inputs.items():
+            if self._macro_state(name) != state:
+                return False
+        for (file, state) in record.file_inputs.items():
+            if self._file_state(file) != state:
+                return False
+        for (file, file_hash) in record.files.items():
+            if self.header_cache.hash_file(file) != file_hash:
+                return False
+        for (contents, include_type, current_dir, relative_path, file, includer, line) in record.includes:
+            if self.include_index.resolve(include_type, current_dir, relative_path, self._include_dirs_key) != file:
+                return False
+        return True
+
+    def _replay_header(self, file : str, file_hash : str, key : str) -> bool:
+        # Applies what reading the header did last time it was included in the same state,
+        # instead of reading it again. Returns False if there's no such record.
+        record = None
+        for candidate in self.header_cache.lookup(key):
+            if self._is_header_record_valid(candidate):
+                record = candidate
+                break
+        if record == None:
+            self.header_cache.misses += 1
+            return False
+        self.header_cache.hits += 1
+
+        # Headers being recorded take the replayed one's inputs and effects as their own
+        for name in record.macro_inputs:
+            self._record_macro_read(name)
+        for file_input in record.file_inputs:
+            self._record_file_read(file_input)
+        for recording in self.header_recordings:
+            recording.files[file] = file_hash
+            recording.files.update(record.files)
+            recording.includes += record.includes
+            recording.skipped_includes += record.skipped_includes
+
+        for (contents, include_type, current_dir, relative_path, included, includer, line) in record.includes:
+            self.detected_includes.add(contents)
+            if included != None:
+                self.include_graph.add(includer, included, line)
+        self.skipped_includes += record.skipped_includes
+        if self.output_writer != None:
+            self.output_writer.append(record.output, record.output_file, record.output_line)
+
+        for (name, outputs) in record.macro_outputs.items():
+            if len(self.header_recordings) > 0:
+                self._record_macro_write(name)
+            for (table_name, output) in zip((name, FUNCTION_MACRO_PREFIX + name), outputs):
+                if output == None:
+                    self.macros.pop(table_name, None)
+                    continue
+                ((kind, definition, args), source) = output
+                if kind == "object":
+                    self.macros[table_name] = ObjectMacro(source, self.macros, definition)
+                else:
+                    self.macros[table_name] = macro_kinds[kind](source, self.macros, definition, list(args))
+            self._next_macro_generation(name)
+
+        for (file_output, (once, guard)) in record.file_outputs.items():
+            if len(self.header_recordings) > 0:
+                self._record_file_write(file_output)
+            if once:
+                self.once_files.add(file_output)
+            else:
+                self.once_files.discard(file_output)
+            if guard != None:
+                self.include_guards[file_output] = guard
+            else:
+                self.include_guards.pop(file_output, None)
+        return True
+
+    def _get_directive_line(self, source) -> int:
+        # The reader reports the position after the directive's terminating newline
+        ((line, pos), code) = source
+        return line - code.count('\n')
+
     def handle_PRAGMA(self, contents : str, source):
-        pass
+        if contents.strip() == "once":
+            if len(self.header_recordings) > 0:
+                self._record_file_write(self.get_current_path())
+            self.once_files.add(self.get_current_path())
 
     directives = {
         "define" : handle_DEFINE,
@@ -429,21 +878,38 @@ class Preprocessor:
         (dir, i) = self._handle_get_identifier(directive, 1, end)
         contents = directive[(i + 1) : end]
 
+        if len(self.guard_detectors) > 0:
+            self._on_guard_directive(dir, contents)
+
         try:
             if self._is_conditional_segment_inactive():
                 if dir in { "if", "ifdef", "ifndef" }:
                     self.inactive_level += 1
-                elif dir == "endif":
+                elif dir in { "endif", "else", "elif" }:
                     if self.inactive_level > 0:
-                        self.inactive_level -= 1
+                        if dir == "endif":
+                            self.inactive_level -= 1
                     else:
-                        file = os.path.join(self.current_dir, self.current_file)
+                        file = self.get_current_path()
                         self.directives[dir](self, contents, ((line, pos), CodeSource(file, line, pos)))
             else:
                 self.directives[dir](self, contents, ((line, pos), code))
         except KeyError:
             raise Exception("Invalid directive!")
 
+    def _on_guard_directive(self, dir : str, contents : str):
+        name = None
+        if dir == "ifndef":
+            try:
+                (name, i) = self._handle_get_identifier(contents, 0, len(contents))
+            except Exception:
+                pass
+        self.guard_detectors[-1].on_directive(dir, name)
+
+    def _on_guard_code(self):
+        if len(self.guard_detectors) > 0:
+            self.guard_detectors[-1].on_code()
+
     def _check_for_newline(self, c : str, i : int, line : int, line_start : int) -> tuple[bool, int, int]:
         if c == '\n':
             line_start = i + 1
@@ -481,6 +947,10 @@ class Preprocessor:
                 tmp_cont = False
                 if res == CodeSection.COMMENT:
                     (tmp_cont, tmp_section, i, line, line_start) = self._read_COMMENT(code, i, end, c, tmp_buf_code, line, line_start)
+                elif c == '\n':
+                    # The newline still terminates the directive
+                    cont = True
+                    break
                 else:
                     (tmp_section, line, line_start) = self._read_LINE_COMMENT(i, c, tmp_buf_code, line, line_start)
 
@@ -574,6 +1044,8 @@ class Preprocessor:
                         section = CodeSection.CODE
                         buf += tmp_buf + [c]
                         buf_code += tmp_buf_code + [c]
+                    else:
+                        self._on_guard_code()
                 else:
                     (is_newline, line, line_start) = self._check_for_newline(c, i, line, line_start)
         return (section, i, line, line_start)
@@ -653,6 +1125,18 @@ class Preprocessor:
         return self.sections[self._make_line_pos_string(line, pos)]
 
     def read_include(self, code : str) -> list[tuple[CodeSection, str, int, int]]:
+        if self.output_writer != None:
+            return self.section_reader.read_output(code)
+        if self.reader_engine == ReaderEngine.FAST:
+            return self.section_reader.read_include(code)
+        return self.read_include_legacy(code)
+
+    def read(self, code : str) -> list[tuple[CodeSection, str, int, int]]:
+        if self.reader_engine == ReaderEngine.FAST:
+            return self.section_reader.read(code)
+        return self.read_legacy(code)
+
+    def read_include_legacy(self, code : str) -> list[tuple[CodeSection, str, int, int]]:
         code = code.replace("\r\n", "\n")
 
         line = 1
@@ -693,7 +1177,7 @@ class Preprocessor:
             buf.clear()
             buf_code.clear()
 
-    def read(self, code : str) -> list[tuple[CodeSection, str, int, int]]:
+    def read_legacy(self, code : str) -> list[tuple[CodeSection, str, int, int]]:
         code = code.replace("\r\n", "\n")
 
         line = 1
@@ -768,6 +1252,8 @@ class Preprocessor:
         self.current_dir = dir
         self.current_file = file
         self.preprocess(Path(path).read_text())
+        if self.header_cache != None:
+            self.header_cache.save()
 
     # Temporary names
     def preprocess2(self, code : str):
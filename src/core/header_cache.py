@@ -0,0 +1,170 @@
+import hashlib, os, pickle, tempfile
+from pathlib import Path
+from .macro import Macro, ObjectMacro, FunctionMacro, VariadicMacro, MacroSource
+
+# What a macro name is defined as: (kind, definition, parameters), or None if it isn't
+MacroDefinition = tuple[str, str, tuple[str, ...]] | None
+# A name's object-like and function-like definitions
+MacroState = tuple[MacroDefinition, MacroDefinition]
+# Whether a file was marked '#pragma once', and its known include guard
+FileState = tuple[bool, str | None]
+
+macro_kinds : dict[str, type] = {
+    "object" : ObjectMacro,
+    "function" : FunctionMacro,
+    "variadic" : VariadicMacro,
+}
+
+def macro_definition(macro : Macro) -> MacroDefinition:
+    if macro == None:
+        return None
+    if isinstance(macro, VariadicMacro):
+        return ("variadic", macro.definition, tuple(macro.args))
+    if isinstance(macro, FunctionMacro):
+        return ("function", macro.definition, tuple(macro.args))
+    return ("object", macro.definition, ())
+
+class HeaderRecord:
+    # What reading a header did, recorded while it was read so it can be replayed instead.
+    # The inputs are the state of every macro name and file the header (or anything it included)
+    # touched before changing it. Conditions only depend on macros, so they're covered by those.
+    file_hash : str
+    macro_inputs : dict[str, MacroState]
+    file_inputs : dict[str, FileState]
+    # Every file read, by content hash
+    files : dict[str, str | None]
+    # (directive contents, include type, current dir, relative path, resolved file, includer, line)
+    includes : list[tuple[str, str, str, str, str | None, str, int]]
+    skipped_includes : int
+    # Net changes, the definitions carry their source too
+    macro_outputs : dict[str, tuple[tuple[MacroDefinition, MacroSource] | None, tuple[MacroDefinition, MacroSource] | None]]
+    file_outputs : dict[str, FileState]
+    # The header's output, and the source position it ended at. None if no output was written.
+    output : str | None
+    output_file : str
+    output_line : int
+    written_macros : set[str]
+    written_files : set[str]
+
+    def __init__(self, file_hash : str):
+        super().__init__()
+        self.file_hash = file_hash
+        self.macro_inputs = {}
+        self.file_inputs = {}
+        self.files = {}
+        self.includes = []
+        self.skipped_includes = 0
+        self.macro_outputs = {}
+        self.file_outputs = {}
+        self.output = None
+        self.output_file = None
+        self.output_line = 0
+        self.written_macros = set()
+        self.written_files = set()
+
+    @staticmethod
+    def _output(macro : Macro) -> tuple[MacroDefinition, MacroSource] | None:
+        if macro == None:
+            return None
+        return (macro_definition(macro), macro.source)
+
+    def finish(self, macros : dict[str, Macro], function_macro_prefix : str, once_files : set[str], include_guards : dict[str, str]):
+        # Takes the net changes from the state the header left behind
+        for name in self.written_macros:
+            self.macro_outputs[name] = (self._output(macros.get(name)), self._output(macros.get(function_macro_prefix + name)))
+        for file in self.written_files:
+            self.file_outputs[file] = (file in once_files, include_guards.get(file))
+        self.written_macros = set()
+        self.written_files = set()
+
+class HeaderCache:
+    # Records of headers, by path, content hash and include dirs. A header can have several,
+    # one per distinct state it was included in. If a directory is given, records are also
+    # saved there and loaded by later runs. One cache can be shared by any number of preprocessors.
+    suffix = ".header.pickle"
+    max_records = 8
+    # Bumped whenever HeaderRecord changes, records saved before then are never looked up again
+    format_version = 2
+
+    directory : Path | None
+    records : dict[str, list[HeaderRecord]]
+    unsaved : set[str]
+    file_hashes : dict[str, tuple[int, int, str]]
+    hits : int
+    misses : int
+
+    def __init__(self, directory : Path = None):
+        super().__init__()
+        self.directory = directory
+        self.records = {}
+        self.unsaved = set()
+        self.file_hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, file : str, file_hash : str, include_dirs : tuple[str, ...]) -> str:
+        return hashlib.sha256("\0".join((str(cls.format_version), file, file_hash) + include_dirs).encode("utf-8")).hexdigest()
+
+    def hash_file(self, path : str) -> str | None:
+        # Hashes are kept while the file's size and mtime stay the same
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self.file_hashes.get(path)
+        if entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        file_hash = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+        self.file_hashes[path] = (stat.st_size, stat.st_mtime_ns, file_hash)
+        return file_hash
+
+    def _entry_path(self, key : str) -> Path:
+        return self.directory.joinpath(key + self.suffix)
+
+    def lookup(self, key : str) -> list[HeaderRecord]:
+        records = self.records.get(key)
+        if records != None:
+            return records
+
+        records = []
+        if self.directory != None:
+            try:
+                with self._entry_path(key).open("rb") as file:
+                    records = pickle.load(file)
+            except FileNotFoundError:
+                pass
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+                self._entry_path(key).unlink(missing_ok=True)
+        self.records[key] = records
+        return records
+
+    def add(self, key : str, record : HeaderRecord):
+        records = self.lookup(key)
+        records.append(record)
+        del records[:-self.max_records]
+        self.unsaved.add(key)
+
+    def save(self):
+        # Writes the headers recorded since the last save
+        if self.directory != None and len(self.unsaved) > 0:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for key in self.unsaved:
+                # Written to a temporary file first, so other processes never see a partial entry
+                (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as file:
+                    pickle.dump(self.records[key], file, pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, self._entry_path(key))
+        self.unsaved.clear()
+
+    def clear(self):
+        self.records.clear()
+        self.unsaved.clear()
+        self.file_hashes.clear()
+        if self.directory != None:
+            for path in self.directory.glob("*" + self.suffix):
+                path.unlink(missing_ok=True)
+
+    def __str__(self) -> str:
+        return "Header cache: %d hit(s), %d miss(es)" % (self.hits, self.misses)
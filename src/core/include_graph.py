@@ -0,0 +1,65 @@
+import os
+from collections import deque
+
+class IncludeGraph:
+    # Resolved include relationships, recorded by the preprocessor as it runs.
+    # All paths are absolute and normalized.
+    edges : dict[str, dict[str, list[int]]]
+    reverse_edges : dict[str, set[str]]
+
+    def __init__(self):
+        super().__init__()
+        self.edges = {}
+        self.reverse_edges = {}
+
+    @staticmethod
+    def normalize(path : str) -> str:
+        return os.path.normpath(os.path.abspath(path))
+
+    def add(self, includer : str, includee : str, line : int):
+        includer = self.normalize(includer)
+        includee = self.normalize(includee)
+
+        lines = self.edges.setdefault(includer, {}).setdefault(includee, [])
+        # A header that isn't guarded is read again for every include of it
+        if line not in lines:
+            lines.append(line)
+        self.reverse_edges.setdefault(includee, set()).add(includer)
+
+    def files(self) -> set[str]:
+        return set(self.edges.keys()) | set(self.reverse_edges.keys())
+
+    def includes(self, file : str) -> set[str]:
+        return set(self.edges.get(self.normalize(file), {}).keys())
+
+    def included_by(self, file : str) -> set[str]:
+        return set(self.reverse_edges.get(self.normalize(file), set()))
+
+    def include_lines(self, includer : str, includee : str) -> list[int]:
+        return list(self.edges.get(self.normalize(includer), {}).get(self.normalize(includee), []))
+
+    def _closure(self, file : str, adjacent) -> set[str]:
+        res = set()
+        queue = deque([self.normalize(file)])
+        while len(queue) > 0:
+            current = queue.popleft()
+            for next in adjacent(current):
+                if next not in res:
+                    res.add(next)
+                    queue.append(next)
+        res.discard(self.normalize(file))
+        return res
+
+    def transitive_includes(self, file : str) -> set[str]:
+        return self._closure(file, lambda current: self.edges.get(current, {}).keys())
+
+    def reverse_dependencies(self, file : str) -> set[str]:
+        return self._closure(file, lambda current: self.reverse_edges.get(current, ()))
+
+    def __repr__(self) -> str:
+        res = ''
+        for includer, includees in self.edges.items():
+            res += includer + '\n'
+            for includee, lines in includees.items():
+                res += '    %s (line %s)\n' % (includee, ', '.join(str(i) for i in lines))
+        return res
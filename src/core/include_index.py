@@ -0,0 +1,82 @@
+import os
+
+class IncludeIndex:
+    listings : dict[str, frozenset[str] | None]
+    resolved : dict[tuple[str, str, str, tuple[str, ...]], str | None]
+    hits : int
+    misses : int
+
+    def __init__(self):
+        super().__init__()
+        self.listings = {}
+        self.resolved = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.listings.clear()
+        self.resolved.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_listing(self, root : str) -> frozenset[str] | None:
+        try:
+            return self.listings[root]
+        except KeyError:
+            pass
+
+        listing = None
+        if os.path.isdir(root):
+            listing = frozenset(os.listdir(root))
+        self.listings[root] = listing
+        return listing
+
+    def _find_in(self, dir : str, path_dir : str, path_file : str) -> str | None:
+        root = os.path.normpath(os.path.join(dir, path_dir))
+        listing = self._get_listing(root)
+        if listing != None and path_file in listing:
+            return os.path.join(root, path_file)
+        return None
+
+    def _resolve(self, include_type : str, current_dir : str, relative_path : str, include_dirs : tuple[str, ...]) -> str | None:
+        (path_dir, path_file) = os.path.split(relative_path)
+
+        # find the file using the algorithm specified in the standard
+        # https://en.cppreference.com/w/c/preprocessor/include
+        if include_type == '"':
+            # Search in the directory of the current file
+            file = self._find_in(current_dir, path_dir, path_file)
+            if file != None:
+                return file
+
+        # Search in the standard include directories
+        for dir in include_dirs:
+            file = self._find_in(dir, path_dir, path_file)
+            if file != None:
+                return file
+
+        return None
+
+    def resolve(self, include_type : str, current_dir : str, relative_path : str, include_dirs : tuple[str, ...]) -> str | None:
+        # The directory of the current file is irrelevant for <> includes
+        if include_type != '"':
+            current_dir = ""
+
+        key = (include_type, current_dir, relative_path, include_dirs)
+        try:
+            file = self.resolved[key]
+            self.hits += 1
+            return file
+        except KeyError:
+            pass
+
+        self.misses += 1
+        file = self._resolve(include_type, current_dir, relative_path, include_dirs)
+        self.resolved[key] = file
+        return file
+
+    def __str__(self):
+        return f"include index: {self.hits} hits, {self.misses} misses, {len(self.listings)} directories listed"
+
+# Shared by every Preprocessor that isn't given an index of its own.
+shared_include_index = IncludeIndex()
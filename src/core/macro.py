@@ -1,7 +1,6 @@
 import sys, shutil, os
 from enum import IntEnum
-from .doubly_linked_list import DoublyLinkedList
-from copy import deepcopy
+from .token_list import TokenList
 
 FUNCTION_MACRO_PREFIX = '*'
 
@@ -13,8 +12,7 @@ class MacroSection(IntEnum):
     NUMBER = 4
     MISC = 5
 
-MacroExpression = DoublyLinkedList[tuple[MacroSection, str]]
-MacroExpressionNode = DoublyLinkedList.Node[tuple[MacroSection, str]]
+MacroExpression = TokenList
 
 class MacroSource:
     def __repr__(self):
@@ -41,11 +39,14 @@ class CodeSource(MacroSource):
 
 
 class Macro:
+    # Thousands of macros are defined per translation unit, most of them never used
+    __slots__ = ('source',)
+
     def __init__(self, source : MacroSource):
         super().__init__()
         self.source = source
 
-    def solve(self, macroexpr : MacroExpression, origin_node : MacroExpressionNode):
+    def solve(self, macroexpr : MacroExpression, origin : int):
         raise NotImplementedError()
 
 class ObjectMacro(Macro):
@@ -98,6 +99,8 @@ class ObjectMacro(Macro):
         '##',
     }
 
+    __slots__ = ('macros', 'definition', '_contents', '_is_constant')
+
     concatenation_res = {
         (MacroSection.NAME, MacroSection.NAME) : MacroSection.NAME,
         (MacroSection.NAME, MacroSection.NUMBER) : MacroSection.NAME,
@@ -109,11 +112,33 @@ class ObjectMacro(Macro):
     def __init__(self, source : MacroSource, macros : dict[str, Macro], definition : str):
         super().__init__(source)
         self.macros = macros
-        self.contents = self.parse(definition)
+        # Most macros are never expanded, so only the definition's text is kept until the body is first used
+        self.definition = definition
+        self._contents = None
+        self._is_constant = False
+
+    def _parse_body(self):
+        # The body is frozen and shared by every expansion. Expansions work on a copy of it,
+        # unless there's nothing in it to expand, in which case the body itself is spliced in.
+        contents = self.parse(self.definition).freeze()
+        self._is_constant = self._check_constant(contents)
+        self._contents = contents
+
+    @property
+    def contents(self) -> MacroExpression:
+        if self._contents == None:
+            self._parse_body()
+        return self._contents
+
+    @property
+    def is_constant(self) -> bool:
+        if self._contents == None:
+            self._parse_body()
+        return self._is_constant
 
     @staticmethod
     def parse(definition : str) -> MacroExpression:
-        res : MacroExpression = DoublyLinkedList()
+        res : MacroExpression = TokenList()
 
         processed_section = MacroSection.WHITESPACE
         buffer : list[str] = []
@@ -136,12 +161,12 @@ class ObjectMacro(Macro):
                 if processed_section == MacroSection.OPERATOR:
                     tmp = ''.join(buffer) + c
                     if tmp not in ObjectMacro.operators:
-                        res.add_end((processed_section, ''.join(buffer)))
+                        res.append(processed_section, ''.join(buffer))
                         buffer = []
             elif c in {'"', "'"}:
                 section = MacroSection.TEXT
 
-                res.add_end((processed_section, ''.join(buffer)))
+                res.append(processed_section, ''.join(buffer))
                 buffer = [c]
                 processed_section = section
 
@@ -157,366 +182,339 @@ class ObjectMacro(Macro):
                 section = MacroSection.MISC
 
             if section != processed_section:
-                res.add_end((processed_section, ''.join(buffer)))
+                res.append(processed_section, ''.join(buffer))
                 buffer = [c]
                 processed_section = section
             elif section != MacroSection.WHITESPACE:
                 buffer += [c]
             i += 1
         if processed_section != MacroSection.WHITESPACE:
-            res.add_end((processed_section, ''.join(buffer)))
-        res.pop_begin()
+            res.append(processed_section, ''.join(buffer))
+        res.delete(0)
         return res
 
     @staticmethod
-    def _remove_node(contents : MacroExpression, current : MacroExpressionNode):
-        contents.remove(current)
-        current = current.next
-        if current == None:
+    def _check_constant(contents : MacroExpression) -> bool:
+        # Names may be macros (or parameters), and '#'/'##' edit the body
+        for (section, content) in contents:
+            if section == MacroSection.NAME or (section == MacroSection.OPERATOR and (content == '#' or content == '##')):
+                return False
+        return True
+
+    @staticmethod
+    def _remove_node(contents : MacroExpression, i : int) -> tuple[int, MacroSection, str]:
+        contents.delete(i)
+        if i >= len(contents):
             return (None, None, None)
-        (section, content) = current.val
-        return (current, section, content)
+        (section, content) = contents[i]
+        return (i, section, content)
 
     @staticmethod
-    def _remove_space(contents : MacroExpression, current : MacroExpressionNode, section : MacroSection, content : str) -> tuple[MacroExpressionNode, MacroSection, str]:
+    def _remove_space(contents : MacroExpression, i : int, section : MacroSection, content : str) -> tuple[int, MacroSection, str]:
         if section == MacroSection.WHITESPACE:
-            return ObjectMacro._remove_node(contents, current)
-        return (current, section, content)
+            return ObjectMacro._remove_node(contents, i)
+        return (i, section, content)
+
+    def _solve_get_operands(self, contents : MacroExpression, i : int) -> tuple[int, int]:
+        # Indices of the tokens around the '##' at i, ignoring whitespace
+        left = contents.find_non_space(i - 1, -1, MacroSection.WHITESPACE)
+        right = contents.find_non_space(i + 1, 1, MacroSection.WHITESPACE)
+        if left < 0 or right < 0:
+            raise Exception("'##' cannot appear at either end of a macro expansion!")
+        return (left, right)
+
+    def _solve_paste(self, l_section : MacroSection, l_content : str, r_section : MacroSection, r_content : str) -> tuple[MacroSection, str]:
+        res_content = l_content + r_content
+        res_section = self.concatenation_res.get((l_section, r_section))
+        if res_section != None and (res_section != MacroSection.OPERATOR or res_content in self.operators):
+            return (res_section, res_content)
+        raise Exception(("Pasting formed \"%s\", an invalid preprocessing token!") % (res_content))
 
     def _solve_perform_concatenation(self, contents : MacroExpression):
-        current = contents.begin
-        while current != None:
-            (section, content) = current.val
+        i = 0
+        while i < len(contents):
+            (section, content) = contents[i]
             if section == MacroSection.OPERATOR and content == '##':
-                operator = current
-                current = current.next
-                if current != None:
-                    left = current.prev.prev
-                    (l_section, l_content) = left.val
-                    (left, l_section, l_content) = self._remove_space(contents, left, l_section, l_content)
-
-                    right = current
-                    (r_section, r_content) = right.val
-                    (right, r_section, r_content) = self._remove_space(contents, right, r_section, r_content)
-
-                    res_content = l_content + r_content
-                    res_section = self.concatenation_res[(l_section, r_section)]
-                    if res_section != None and (res_section != MacroSection.OPERATOR or res_content in self.operators):
-                        right.val = (res_section, res_content)
-                        contents.remove(left)
-                        contents.remove(operator)
-
-                        current = right
-                    else:
-                        raise Exception(("Pasting formed \"%s\", an invalid preprocessing token!") % (res_content))
-                else:
-                    break
-            current = current.next
+                (left, right) = self._solve_get_operands(contents, i)
+                (l_section, l_content) = contents[left]
+                (r_section, r_content) = contents[right]
+
+                (res_section, res_content) = self._solve_paste(l_section, l_content, r_section, r_content)
+                contents.set(left, res_section, res_content)
+                contents.delete(left + 1, right + 1)
+                i = left
+            i += 1
 
     def _solve_add_arg(self, arg : MacroExpression, args : list[MacroExpression]):
-        begin = arg.begin
-        if begin != None and begin.val[0] == MacroSection.WHITESPACE:
-            arg.remove(begin)
+        if len(arg) > 0 and arg.kinds[0] == MacroSection.WHITESPACE:
+            arg.delete(0)
 
-        end = arg.end
-        if end != None and end.val[0] == MacroSection.WHITESPACE:
-            arg.remove(end)
+        if len(arg) > 0 and arg.kinds[-1] == MacroSection.WHITESPACE:
+            arg.delete(len(arg) - 1)
 
         args += [arg]
 
-    def _solve_handle_functionMacro(self, used : set[str], macro : Macro, contents : MacroExpression, start : MacroExpressionNode) -> tuple[MacroExpression, MacroExpressionNode]:
-        current = start.next
-        if current != None:
-            (section, content) = current.val
-            if section == MacroSection.OPERATOR and content == '(':
-                contents.remove(current)
-                current = current.next
-
-                parenth_level = 1
-                args : list[MacroExpression] = []
-                f = current
-                t = None
-                while current != None:
-                    (section, content) = current.val
-                    if section == MacroSection.OPERATOR:
-                        if content == '(':
-                            parenth_level += 1
-                            t = current
-                        elif content == ')':
-                            parenth_level -= 1
-                            if parenth_level > 0:
-                                t = current
-                            else:
-                                arg = contents.extract_list(f, t)
-                                self._solve_add_arg(arg, args)
-
-                                contents.remove(current)
-                                break
-                        elif content == ',':
-                            if parenth_level > 0:
-                                t = current
-                            else:
-                                arg = contents.extract_list(f, t)
-                                self._solve_add_arg(arg, args)
-
-                                contents.remove(current)
-                                current = current.next
-
-                                f = current
-                                t = None
-                                continue
-                        else:
-                            t = current
-                    else:
-                        t = current
-                    current = current.next
+    def _solve_handle_functionMacro(self, used : set[str], macro : Macro, contents : MacroExpression, paren : int) -> tuple[MacroExpression, int]:
+        # paren is the index of the '(' after the macro's name.
+        # Returns the expansion and the index after the closing ')'.
+        parenth_level = 1
+        args : list[MacroExpression] = []
+        f = paren + 1
+        i = f
+        end = len(contents)
+        while i < end:
+            (section, content) = contents[i]
+            if section == MacroSection.OPERATOR:
+                if content == '(':
+                    parenth_level += 1
+                elif content == ')':
+                    parenth_level -= 1
+                    if parenth_level == 0:
+                        self._solve_add_arg(contents.slice(f, i), args)
+                        break
+                elif content == ',' and parenth_level == 1:
+                    self._solve_add_arg(contents.slice(f, i), args)
+                    f = i + 1
+            i += 1
 
-                if parenth_level > 0:
-                    raise Exception("unterminated function-like macro invocation")
-                return (macro._copy_and_solve(args, used), current)
-            return (None, current)
-        return (None, current)
+        if parenth_level > 0:
+            raise Exception("unterminated function-like macro invocation")
+        return (macro._copy_and_solve(args, used), i + 1)
 
     def _solve_replace_macros(self, contents : MacroExpression, used : set[str]) -> MacroExpression:
-        current = contents.begin
-        while current != None:
-            (section, content) = current.val
+        i = 0
+        while i < len(contents):
+            (section, content) = contents[i]
             if section == MacroSection.NAME:
                 name = content
-                func_name = FUNCTION_MACRO_PREFIX + name
-
                 macro = None
 
-                next = current.next
-                if next != None:
-                    (section, content) = next.val
-                    if section == MacroSection.OPERATOR and content == '(':
-                        macro = self.macros.get(func_name)
+                paren = contents.find_non_space(i + 1, 1, MacroSection.WHITESPACE)
+                if paren >= 0 and contents[paren] == (MacroSection.OPERATOR, '('):
+                    macro = self.macros.get(FUNCTION_MACRO_PREFIX + content)
+                    if macro != None:
+                        name = FUNCTION_MACRO_PREFIX + content
 
-                if macro != None:
-                    name = func_name
-                else:
+                if macro == None:
                     macro = self.macros.get(content)
 
-                if macro != None and content not in used:
-                    used.add(content)
+                if macro != None and name not in used:
+                    used.add(name)
                     if isinstance(macro, FunctionMacro):
-                        start = current
-
-                        (list, current) = self._solve_handle_functionMacro(used, macro, contents, current)
-
-                        contents.add_list_before(list, current)
-                        contents.remove(start)
+                        (expansion, stop) = self._solve_handle_functionMacro(used, macro, contents, paren)
+                        contents.splice(i, stop, expansion)
+                        i += len(expansion) - 1
                     elif isinstance(macro, ObjectMacro):
-                        contents.add_list_before(macro._copy_and_solve(used), current)
+                        expansion = macro._copy_and_solve(used)
+                        contents.splice(i, i + 1, expansion)
+                        i += len(expansion) - 1
                     elif isinstance(macro, Macro):
-                        macro.solve(contents, current)
+                        macro.solve(contents, i)
                     else:
                         raise Exception("Not a macro!")
-                    contents.remove(current)
-                    used.remove(content)
-            current = current.next
+                    used.remove(name)
+            i += 1
 
     def _solve(self, contents : MacroExpression, used : set[str]) -> MacroExpression:
         self._solve_perform_concatenation(contents)
         self._solve_replace_macros(contents, used)
 
     def _copy_and_solve(self, used : set[str]) -> MacroExpression:
-        res = deepcopy(self.contents)
+        # The result may be the frozen body itself
+        if self.is_constant:
+            return self.contents
+        res = self.contents.copy()
         self._solve(res, used)
         return res
 
     def solve(self) -> MacroExpression:
-        return self._copy_and_solve(set())
+        return self._copy_and_solve(set()).copy()
 
     @staticmethod
     def contents_to_string(contents : MacroExpression) -> str:
-        current = contents.begin
         res = ''
-        while current != None:
-            content = current.val[1]
+        for content in contents.texts:
             if isinstance(content, bool):
                 res += "True" if content else "False"
             else:
-                res += content
-            current = current.next
+                res += str(content)
         return res
 
 class FunctionMacro(ObjectMacro):
+    # The body is compiled once, when the macro is first expanded (or defined, if it has '#' or '##'
+    # that need checking, see check_operators), into a template: a list of
+    # (TemplateSite, value) pieces. Literal pieces are runs of body tokens copied as they are,
+    # the other pieces name the argument (by index) that gets substituted there.
+    # An invocation only fills in the template and rescans the result for macros.
+    class TemplateSite(IntEnum):
+        LITERAL = 0
+        ARG = 1         # Macro-expanded argument
+        RAW_ARG = 2     # Operand of '##', substituted as written
+        STRINGIFY = 3   # Operand of '#'
+        PASTE = 4       # '##' between the previous and the next piece
+
+    __slots__ = ('args', '_template')
+
     def __init__(self, source : MacroSource, macros : dict[str, Macro], definition : str, args : list[str]):
-        super().__init__(macros, source, definition)
+        super().__init__(source, macros, definition)
         self.args = {arg: i for (i, arg) in enumerate(args)}
+        self._template = None
+
+    @property
+    def template(self) -> list[tuple[TemplateSite, object]]:
+        # Compiled when the macro is first expanded
+        if self._template == None:
+            self._template = self._compile(self.contents)
+        return self._template
+
+    def check_operators(self) -> 'FunctionMacro':
+        # Compiles the template right away if the body may have '#' or '##' in it,
+        # so a misplaced one is reported where the macro is defined, like cpp does
+        if '#' in self.definition:
+            self.template
+        return self
+
+    def _compile_get_param(self, content : str) -> int:
+        return self.args.get(content)
+
+    def _compile(self, contents : MacroExpression) -> list[tuple[TemplateSite, object]]:
+        Site = self.TemplateSite
+        template : list[tuple[FunctionMacro.TemplateSite, object]] = []
+        literal = TokenList()
+
+        def flush_literal():
+            nonlocal literal
+            if not literal.is_empty():
+                template.append((Site.LITERAL, literal.freeze()))
+                literal = TokenList()
 
-    def _solve_get_arg(self, args : list[MacroExpression], name : str) -> MacroExpression:
-        pos = self.args.get(name)
-        if pos != None:
-            try:
-                arg = args[pos]
-                return arg
-            except IndexError:
-                return None
-        return None
-
-    def _solve_stringify_arg(self, args : list[MacroExpression], contents : MacroExpression, origin_node : MacroExpressionNode, content : str):
-        arg = self._solve_get_arg(args, content)
-        if arg != None:
-            contents.remove(origin_node.prev)
-            origin_node.val = (MacroSection.TEXT, '"' + self.contents_to_string(arg) + '"')
-        else:
-            raise Exception("'#' is not followed by a macro parameter!")
-
-    def _solve_perform_stringification(self, args : list[MacroExpression], contents : MacroExpression):
-        current = contents.begin
-        while current != None:
-            (section, content) = current.val
+        i = 0
+        end = len(contents)
+        while i < end:
+            (section, content) = contents[i]
             if section == MacroSection.OPERATOR and content == '#':
-                current = current.next
-                if current != None:
-                    (section, content) = current.val
-                    (current, section, content) = self._remove_space(contents, current, section, content)
-
-                    if section == MacroSection.NAME:
-                        self._solve_stringify_arg(args, contents, current, content)
-                else:
-                    break
-            current = current.next
-
-    def _solve_perform_concatenation_get_left_arg(self, args : list[MacroExpression], contents : MacroExpression, current : MacroExpressionNode) -> tuple[MacroExpressionNode, MacroSection, str]:
-        left = current.prev.prev
-        (l_section, l_content) = left.val
-        (left, l_section, l_content) = self._remove_space(contents, left, l_section, l_content)
-
-        if l_section == MacroSection.NAME:
-            arg = self._solve_get_arg(args, l_content)
-            if arg != None:
-                if arg.is_empty():
-                    left = None
-                else:
-                    contents.add_list_before(deepcopy(arg), left)
-                    contents.remove(left)
-                    left = left.prev
-                    (l_section, l_content) = left.val
-        return (left, l_section, l_content)
-
-    def _solve_perform_concatenation_get_right_arg(self, args : list[MacroExpression], contents : MacroExpression, current : MacroExpressionNode) -> tuple[MacroExpressionNode, MacroSection, str]:
-        right = current
-        (r_section, r_content) = right.val
-        (right, r_section, r_content) = self._remove_space(contents, right, r_section, r_content)
-
-        end = right
-
-        if r_section == MacroSection.NAME:
-            arg = self._solve_get_arg(args, r_content)
-            if arg != None:
-                if arg.is_empty():
-                    right = None
-                else:
-                    arg = deepcopy(arg)
-                    end = arg.end
-
-                    contents.add_list_after(arg, right)
-                    contents.remove(right)
-                    right = right.next
-                    (r_section, r_content) = right.val
-        return (right, r_section, r_content, end)
-
-    def _solve_perform_concatenation_f(self, args : list[MacroExpression], contents : MacroExpression):
-        current = contents.begin
-        while current != None:
-            (section, content) = current.val
-            if section == MacroSection.OPERATOR and content == '##':
-                operator = current
-                current = current.next
-                if current != None:
-                    (left, l_section, l_content) = self._solve_perform_concatenation_get_left_arg(args, contents, current)
-                    (right, r_section, r_content, end) = self._solve_perform_concatenation_get_right_arg(args, contents, current)
-
-                    if left == None:
-                        contents.remove(left)
-                        contents.remove(operator)
-                        if right == None:
-                            contents.remove(right)
-                        current = right
-                    elif right == None:
-                        contents.remove(operator)
-                        contents.remove(right)
-                        current = left
-                    else:
-                        res_content = l_content + r_content
-                        res_section = self.concatenation_res[(l_section, r_section)]
-                        if res_section != None and (res_section != MacroSection.OPERATOR or res_content in self.operators):
-                            right.val = (res_section, res_content)
-                            contents.remove(left)
-                            contents.remove(operator)
-
-                            current = end
-                        else:
-                            raise Exception(("Pasting formed \"%s\", an invalid preprocessing token!") % (res_content))
-                else:
-                    break
-            current = current.next
-
-    def _solve_replace_arg(self, args : list[MacroExpression], contents : MacroExpression, origin_node : MacroExpressionNode, content : str):
-        arg = self._solve_get_arg(args, content)
-        if arg != None:
-            contents.add_list_before(deepcopy(arg), origin_node)
-            contents.remove(origin_node)
-
-    def _solve_replace_args(self, args : list[MacroExpression], contents : MacroExpression, used : set[str]):
-        for arg in args:
-            super()._solve(arg, used)
-
-        current = contents.begin
-        while current != None:
-            (section, content) = current.val
-            if section == MacroSection.NAME:
-                self._solve_replace_arg(args, contents, current, content)
-            current = current.next
+                j = contents.find_non_space(i + 1, 1, MacroSection.WHITESPACE)
+                if j >= 0 and contents.kinds[j] == MacroSection.NAME:
+                    param = self._compile_get_param(contents.texts[j])
+                    if param == None:
+                        raise Exception("'#' is not followed by a macro parameter!")
+                    flush_literal()
+                    template.append((Site.STRINGIFY, param))
+                    i = j + 1
+                    continue
+            elif section == MacroSection.OPERATOR and content == '##':
+                # Whitespace around '##' is dropped
+                while not literal.is_empty() and literal.kinds[-1] == MacroSection.WHITESPACE:
+                    literal.delete(len(literal) - 1)
+                flush_literal()
+                j = contents.find_non_space(i + 1, 1, MacroSection.WHITESPACE)
+                if len(template) == 0 or j < 0:
+                    raise Exception("'##' cannot appear at either end of a macro expansion!")
+                template.append((Site.PASTE, None))
+                i = j
+                continue
+            elif section == MacroSection.NAME:
+                param = self._compile_get_param(content)
+                if param != None:
+                    flush_literal()
+                    template.append((Site.ARG, param))
+                    i += 1
+                    continue
+            literal.append(section, content)
+            i += 1
+        flush_literal()
+
+        # Operands of '##' aren't expanded
+        for (k, (site, value)) in enumerate(template):
+            if site == Site.ARG and ((k > 0 and template[k - 1][0] == Site.PASTE) or (k + 1 < len(template) and template[k + 1][0] == Site.PASTE)):
+                template[k] = (Site.RAW_ARG, value)
+        return template
+
+    def _solve_prepare_args(self, args : list[MacroExpression]) -> list[MacroExpression]:
+        # Missing arguments are left as the parameter's name
+        if len(args) < len(self.args):
+            args = args[:]
+            for name in list(self.args)[len(args):]:
+                arg = TokenList()
+                arg.append(MacroSection.NAME, name)
+                args.append(arg)
+        return args
+
+    def _solve_expand_arg(self, arg : MacroExpression, used : set[str]) -> MacroExpression:
+        res = arg.copy()
+        super()._solve(res, used)
+        return res
 
-    def _solve(self, args : list[MacroExpression], contents: MacroExpression, used : set[str]):
-        self._solve_perform_stringification(args, contents)
-        self._solve_perform_concatenation_f(args, contents)
-        self._solve_replace_args(args, contents, used)
-        super()._solve_replace_macros(contents, used)
+    def _solve_fill(self, args : list[MacroExpression], used : set[str]) -> MacroExpression:
+        Site = self.TemplateSite
+        res = TokenList()
+        expanded : dict[int, MacroExpression] = {}
+        # Where the current '##' operand chain starts in res, and whether a '##' is pending
+        piece_start = 0
+        paste = False
+        for (site, value) in self.template:
+            if site == Site.PASTE:
+                paste = True
+                left_empty = len(res) == piece_start
+                continue
+
+            mark = len(res)
+            if site == Site.LITERAL:
+                res.extend(value)
+            elif site == Site.RAW_ARG:
+                res.extend(args[value])
+            elif site == Site.ARG:
+                arg = expanded.get(value)
+                if arg == None:
+                    arg = self._solve_expand_arg(args[value], used)
+                    expanded[value] = arg
+                res.extend(arg)
+            else:
+                res.append(MacroSection.TEXT, '"' + self.contents_to_string(args[value]) + '"')
+
+            if paste:
+                # An empty operand leaves the other one as it is
+                if not left_empty and len(res) > mark:
+                    (res_section, res_content) = self._solve_paste(res.kinds[mark - 1], res.texts[mark - 1], res.kinds[mark], res.texts[mark])
+                    res.set(mark - 1, res_section, res_content)
+                    res.delete(mark)
+                paste = False
+            else:
+                piece_start = mark
+        return res
 
     def _copy_and_solve(self, args : list[MacroExpression], used : set[str]) -> MacroExpression:
-        res = deepcopy(self.contents)
-        self._solve(args, res, used)
+        if self.is_constant:
+            return self.contents
+        res = self._solve_fill(self._solve_prepare_args(args), used)
+        super()._solve_replace_macros(res, used)
         return res
 
     def solve(self, args : list[MacroExpression]) -> MacroExpression:
-        return self._copy_and_solve(args, set())
+        return self._copy_and_solve(args, set()).copy()
 
 class VariadicMacro(FunctionMacro):
+    __slots__ = ()
+
+    def _compile_get_param(self, content : str) -> int:
+        # __VA_ARGS__ comes after the named parameters
+        if content == "__VA_ARGS__":
+            return len(self.args)
+        return super()._compile_get_param(content)
+
     def _generate_va_args(self, args : list[MacroExpression]) -> MacroExpression:
-        res = DoublyLinkedList()
+        res = TokenList()
 
         i = len(self.args)
         end = len(args)
         if i < end:
-            res.add_begin(None)
             while i < end - 1:
-                res.add_list_after(deepcopy(args[i]), res.end)
-                res.add_end((MacroSection.WHITESPACE, ','))
+                res.extend(args[i])
+                res.append(MacroSection.OPERATOR, ',')
                 i += 1
-            res.add_list_after(deepcopy(args[i]), res.end)
-            res.pop_begin()
-        self.va_args = res
-
-    def _solve(self, args : list[MacroExpression], contents: MacroExpression, used : set[str]):
-        self._generate_va_args(args)
-        super()._solve(contents, used)
-
-    def _solve_stringify_arg(self, args : list[MacroExpression], contents : MacroExpression, origin_node : MacroExpressionNode, content : str):
-        if content == "__VA_ARGS__":
-            contents.remove(origin_node.prev)
-            origin_node.val = (MacroSection.TEXT, '"' + self.contents_to_string(self.va_args) + '"')
-        else:
-            super()._solve_stringify_arg(args, contents, origin_node, content)
+            res.extend(args[i])
+        return res
 
-    def _solve_replace_arg(self, args : list[MacroExpression], contents : MacroExpression, origin_node : MacroExpressionNode, content : str):
-        if content == "__VA_ARGS__":
-            contents.add_list_before(deepcopy(self.va_args), origin_node)
-            contents.remove(origin_node)
-        else:
-            super()._solve_replace_arg(args, contents, origin_node, content)
\ No newline at end of file
+    def _solve_prepare_args(self, args : list[MacroExpression]) -> list[MacroExpression]:
+        named = super()._solve_prepare_args(args[:len(self.args)])
+        return named + [self._generate_va_args(args)]
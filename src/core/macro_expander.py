@@ -0,0 +1,179 @@
+from array import array
+from enum import IntEnum
+from .macro import MacroSection, MacroExpression, Macro, ObjectMacro, FunctionMacro, VariadicMacro, FUNCTION_MACRO_PREFIX
+from .token_list import TokenList
+
+class ExpansionEngine(IntEnum):
+    LEGACY = 0
+    HIDE_SET = 1
+
+HideSet = frozenset[str]
+Token = tuple[MacroSection, str, HideSet]
+
+empty_hide_set : HideSet = frozenset()
+
+class MacroExpander:
+    # Macro expansion with hide sets (Prosser's algorithm), replacing ObjectMacro._solve.
+    # Every token carries the set of macro names it came out of, and a name is never expanded
+    # by a macro in its own hide set. Expansions are pushed back onto the input and rescanned from
+    # there, so every token is scanned once per expansion it takes part in. The expander keeps no
+    # state between calls and never modifies the macros, so it can run concurrently.
+    macros : dict[str, Macro]
+
+    def __init__(self, macros : dict[str, Macro]):
+        super().__init__()
+        self.macros = macros
+
+    def expand(self, contents : MacroExpression, looked_up : set[str] = None) -> MacroExpression:
+        # looked_up, if given, collects every name that was looked up as a macro
+        tokens = [(section, content, empty_hide_set) for (section, content) in contents]
+        res = self._expand(tokens, looked_up if looked_up != None else set())
+        return TokenList(array('B', [token[0] for token in res]), [token[1] for token in res])
+
+    def _expand(self, tokens : list[Token], looked_up : set[str]) -> list[Token]:
+        # The input is a stack, with the next token at the end
+        stack = tokens[::-1]
+        res : list[Token] = []
+        macros = self.macros
+        pop = stack.pop
+        append = res.append
+        NAME = MacroSection.NAME
+        while stack:
+            token = pop()
+            (section, content, hide_set) = token
+            if section == NAME and content not in hide_set:
+                looked_up.add(content)
+                macro = macros.get(FUNCTION_MACRO_PREFIX + content)
+                if macro != None:
+                    paren = self._find_paren(stack)
+                    if paren >= 0:
+                        del stack[paren:]
+                        (args, r_hide_set) = self._collect_args(stack)
+                        expansion = self._substitute_function(macro, args, (hide_set & r_hide_set) | {content}, looked_up)
+                        stack.extend(reversed(expansion))
+                        continue
+
+                macro = macros.get(content)
+                if isinstance(macro, ObjectMacro):
+                    stack.extend(reversed(self._substitute_object(macro, hide_set | {content})))
+                    continue
+            append(token)
+        return res
+
+    @staticmethod
+    def _find_paren(stack : list[Token]) -> int:
+        # Stack index of the '(' that opens an invocation, or -1
+        i = len(stack) - 1
+        while i >= 0 and stack[i][0] == MacroSection.WHITESPACE:
+            i -= 1
+        if i >= 0 and stack[i][0] == MacroSection.OPERATOR and stack[i][1] == '(':
+            return i
+        return -1
+
+    @staticmethod
+    def _trim(arg : list[Token]) -> list[Token]:
+        start = 0
+        stop = len(arg)
+        while start < stop and arg[start][0] == MacroSection.WHITESPACE:
+            start += 1
+        while stop > start and arg[stop - 1][0] == MacroSection.WHITESPACE:
+            stop -= 1
+        return arg[start:stop]
+
+    def _collect_args(self, stack : list[Token]) -> tuple[list[list[Token]], HideSet]:
+        # Pops the arguments of an invocation, up to its closing ')', off the stack.
+        # Returns them with the hide set of the ')'.
+        parenth_level = 1
+        args : list[list[Token]] = []
+        arg : list[Token] = []
+        while len(stack) > 0:
+            token = stack.pop()
+            (section, content, hide_set) = token
+            if section == MacroSection.OPERATOR:
+                if content == '(':
+                    parenth_level += 1
+                elif content == ')':
+                    parenth_level -= 1
+                    if parenth_level == 0:
+                        args.append(self._trim(arg))
+                        return (args, hide_set)
+                elif content == ',' and parenth_level == 1:
+                    args.append(self._trim(arg))
+                    arg = []
+                    continue
+            arg.append(token)
+        raise Exception("unterminated function-like macro invocation")
+
+    @staticmethod
+    def _prepare_args(macro : FunctionMacro, args : list[list[Token]]) -> list[list[Token]]:
+        # Lines the arguments up with the template's parameter indices, like FunctionMacro._solve_prepare_args
+        n = len(macro.args)
+        res = args[:n]
+        for name in list(macro.args)[len(res):]:
+            res.append([(MacroSection.NAME, name, empty_hide_set)])
+
+        if isinstance(macro, VariadicMacro):
+            va_args : list[Token] = []
+            for arg in args[n:]:
+                if len(va_args) > 0:
+                    va_args.append((MacroSection.OPERATOR, ',', empty_hide_set))
+                va_args += arg
+            res.append(va_args)
+        return res
+
+    def _substitute_object(self, macro : ObjectMacro, hide_set : HideSet) -> list[Token]:
+        contents = macro.contents
+        if '##' in contents.texts:
+            contents = contents.copy()
+            macro._solve_perform_concatenation(contents)
+        return [(section, content, hide_set) for (section, content) in contents]
+
+    def _substitute_function(self, macro : FunctionMacro, args : list[list[Token]], hide_set : HideSet, looked_up : set[str]) -> list[Token]:
+        # Fills in the macro's template. Every token of the result gets hide_set added to its own.
+        Site = FunctionMacro.TemplateSite
+        args = self._prepare_args(macro, args)
+        expanded : dict[int, list[Token]] = {}
+        hide_sets : dict[HideSet, HideSet] = {}
+
+        res : list[Token] = []
+        # Where the current '##' operand chain starts in res, and whether a '##' is pending
+        piece_start = 0
+        paste = False
+        for (site, value) in macro.template:
+            if site == Site.PASTE:
+                paste = True
+                left_empty = len(res) == piece_start
+                continue
+
+            mark = len(res)
+            if site == Site.LITERAL:
+                res += [(section, content, hide_set) for (section, content) in value]
+            elif site == Site.STRINGIFY:
+                res.append((MacroSection.TEXT, '"' + ''.join(token[1] for token in args[value]) + '"', hide_set))
+            else:
+                if site == Site.ARG:
+                    arg = expanded.get(value)
+                    if arg == None:
+                        arg = self._expand(args[value], looked_up)
+                        expanded[value] = arg
+                else:
+                    arg = args[value]
+                for (section, content, arg_hide_set) in arg:
+                    res_hide_set = hide_sets.get(arg_hide_set)
+                    if res_hide_set == None:
+                        res_hide_set = arg_hide_set | hide_set
+                        hide_sets[arg_hide_set] = res_hide_set
+                    res.append((section, content, res_hide_set))
+
+            if paste:
+                # An empty operand leaves the other one as it is
+                if not left_empty and len(res) > mark:
+                    (l_section, l_content, l_hide_set) = res[mark - 1]
+                    (r_section, r_content, r_hide_set) = res[mark]
+                    (res_section, res_content) = macro._solve_paste(l_section, l_content, r_section, r_content)
+                    res[mark - 1] = (res_section, res_content, l_hide_set & r_hide_set)
+                    del res[mark]
+                paste = False
+            else:
+                piece_start = mark
+        return res
@@ -0,0 +1,180 @@
+import re
+from .macro import MacroSection, ObjectMacro, FUNCTION_MACRO_PREFIX
+from .token_list import TokenList
+
+class OutputWriter:
+    # Writes the preprocessed translation unit: the active code of every file read, with its macros
+    # expanded and '# <line> "<file>"' markers wherever the output stops following the source's lines.
+    # Code is expanded a line at a time, or across lines as long as a macro invocation is open.
+    max_line_gap = 8
+
+    operators = sorted(ObjectMacro.operators | { '...' }, key=len, reverse=True)
+    token_re = re.compile(
+        r'(\s+)'
+        r'|([A-Za-z_]\w*)'
+        r'|(\.?\d(?:[eEpP][+-]|[\w.])*)'
+        r'|("(?:\\.|[^"\\\n])*"?|\'(?:\\.|[^\'\\\n])*\'?)'
+        r'|(' + '|'.join(re.escape(op) for op in operators) + r')'
+        r'|(.)',
+        re.S)
+    token_kinds = [
+        MacroSection.WHITESPACE,
+        MacroSection.NAME,
+        MacroSection.NUMBER,
+        MacroSection.TEXT,
+        MacroSection.OPERATOR,
+        MacroSection.MISC,
+    ]
+
+    parts : list[str]
+    file : str
+    line : int
+
+    def __init__(self, preprocessor):
+        super().__init__()
+        self.preprocessor = preprocessor
+        self.parts = []
+        # Where the next line of output comes from, None if a marker is needed first
+        self.file = None
+        self.line = 0
+
+    def tokenize(self, code : str) -> TokenList:
+        res = TokenList()
+        kinds = self.token_kinds
+        for m in self.token_re.finditer(code):
+            res.append(kinds[m.lastindex - 1], m.group(m.lastindex))
+        return res
+
+    def get_text(self) -> str:
+        return ''.join(self.parts)
+
+    def mark(self) -> int:
+        return len(self.parts)
+
+    def text_since(self, mark : int) -> str:
+        return ''.join(self.parts[mark:])
+
+    def append(self, text : str, file : str, line : int):
+        # Adds output written before, like a replayed header's, and the position it ended at
+        if len(text) > 0:
+            self.parts.append(text)
+            self.file = file
+            self.line = line
+
+    @staticmethod
+    def _quote(file : str) -> str:
+        # Escaped like cpp does, pycparser keeps the name as written
+        return '"%s"' % (file.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def _sync(self, file : str, line : int):
+        if file != self.file or line < self.line or line > self.line + self.max_line_gap:
+            if len(self.parts) > 0 and not self.parts[-1].endswith('\n'):
+                self.parts.append('\n')
+            self.parts.append('# %d %s\n' % (line, self._quote(file)))
+            self.file = file
+        elif line > self.line:
+            self.parts.append('\n' * (line - self.line))
+        self.line = line
+
+    @staticmethod
+    def _needs_space(l_section : MacroSection, l_content : str, r_section : MacroSection, r_content : str) -> bool:
+        # Whether two tokens that came out of different places would lex as something else if joined
+        if l_section in { MacroSection.NAME, MacroSection.NUMBER }:
+            return r_section in { MacroSection.NAME, MacroSection.NUMBER }
+        if l_section == MacroSection.OPERATOR or l_section == MacroSection.MISC:
+            if r_section != MacroSection.OPERATOR and r_section != MacroSection.MISC:
+                return False
+            pair = l_content[-1] + r_content[0]
+            return pair in ObjectMacro.operators or pair == '/*' or pair == '//' or (l_content + r_content) in ObjectMacro.operators
+        return False
+
+    def _join(self, tokens : TokenList) -> str:
+        res : list[str] = []
+        l_section = MacroSection.WHITESPACE
+        l_content = ''
+        for (section, content) in tokens:
+            if section != MacroSection.WHITESPACE and l_section != MacroSection.WHITESPACE:
+                if self._needs_space(l_section, l_content, section, content):
+                    res.append(' ')
+            res.append(content)
+            l_section = section
+            l_content = content
+        return ''.join(res)
+
+    @staticmethod
+    def _replace_position_macros(tokens : TokenList, file : str, line : int):
+        # __LINE__ is the line the code starts at, even if an invocation spans more
+        for i in range(len(tokens)):
+            if tokens.kinds[i] == MacroSection.NAME:
+                content = tokens.texts[i]
+                if content == '__LINE__':
+                    tokens.set(i, MacroSection.NUMBER, str(line))
+                elif content == '__FILE__':
+                    tokens.set(i, MacroSection.TEXT, OutputWriter._quote(file))
+
+    def _write_line(self, tokens : TokenList, file : str, line : int):
+        pp = self.preprocessor
+        macros = pp.macros
+        self._sync(file, line)
+        newlines = sum(content.count('\n') for (section, content) in tokens if section == MacroSection.WHITESPACE)
+
+        expand = False
+        for (section, content) in tokens:
+            if section == MacroSection.NAME and (content in macros or (FUNCTION_MACRO_PREFIX + content) in macros):
+                expand = True
+                break
+
+        if len(pp.header_recordings) > 0:
+            # Names that aren't macros are inputs too, the output depends on them staying that way
+            looked_up = { content for (section, content) in tokens if section == MacroSection.NAME }
+            if expand:
+                tokens = pp.expand_macros(tokens, looked_up)
+            for name in looked_up:
+                pp._record_macro_read(name)
+        elif expand:
+            tokens = pp.expand_macros(tokens)
+
+        if expand or '__LINE__' in tokens.texts or '__FILE__' in tokens.texts:
+            self._replace_position_macros(tokens, file, line)
+
+        text = self._join(tokens)
+        self.parts.append(text)
+        self.line += newlines
+        # An invocation across lines is written on one, the source's line numbers need a marker again
+        if expand and text.count('\n') != newlines:
+            self.file = None
+
+    def write(self, code : str, line : int):
+        # code starts at the beginning of the given line of the current file
+        pp = self.preprocessor
+        if pp._is_conditional_segment_inactive() or len(code) == 0 or code.isspace():
+            return
+
+        file = pp.get_current_path()
+        macros = pp.macros
+        tokens = self.tokenize(code)
+        kinds = tokens.kinds
+        texts = tokens.texts
+
+        start = 0
+        parenth_level = 0
+        # Last name outside of parentheses, an invocation may have its '(' on the next line
+        last_name = None
+        for i in range(len(texts)):
+            section = kinds[i]
+            content = texts[i]
+            if section == MacroSection.WHITESPACE:
+                if '\n' in content and parenth_level == 0 and (last_name == None or (FUNCTION_MACRO_PREFIX + last_name) not in macros):
+                    self._write_line(TokenList(kinds[start:i + 1], texts[start:i + 1]), file, line)
+                    line += sum(text.count('\n') for text in texts[start:i + 1])
+                    start = i + 1
+            elif section == MacroSection.OPERATOR and content == '(':
+                parenth_level += 1
+                last_name = None
+            elif section == MacroSection.OPERATOR and content == ')':
+                parenth_level = max(parenth_level - 1, 0)
+            elif parenth_level == 0:
+                last_name = content if section == MacroSection.NAME else None
+
+        if start < len(texts):
+            self._write_line(TokenList(kinds[start:], texts[start:]), file, line)
@@ -2,41 +2,81 @@ import shutil
 from pathlib import Path
 from pycparser import parse_file
 from pycparser.c_ast import *
+from .chunked_unit import ChunkedUnit
 
 class Scanner(NodeVisitor):
     TAG_PREFIX = ''
 
-    searchin_funcs = set()
+    searchin_funcs : set[str]
 
     # Symbols
-    functions = set()
-    variables = set()
-    types = set()
+    functions : set[str]
+    variables : set[str]
+    types : set[str]
+    # Enumerators
+    constants : set[str]
 
-    node = {}
+    # Ordered so that reversing it gives source order
+    node : dict[str, Node]
 
     # Tags
-    structs = set()
-    unions = set()
-    enums = set()
-
-    tag_node = {}
+    structs : set[str]
+    unions : set[str]
+    enums : set[str]
+
+    # Ordered so that reversing it gives source order
+    tag_node : dict[str, Node]
+
+    # Index of the translation unit's top-level declarations, by position in source order
+    ext : dict[int, Node]
+    # Positions in ext of every declaration of a name
+    symbol_index : dict[str, list[int]]
+    # Position and definition of a tag
+    tag_index : dict[str, tuple[int, Node]]
+    # Position and enum of an enumerator
+    constant_index : dict[str, tuple[int, Enum]]
+
+    # Symbols gathered but not looked up yet
+    pending : list[tuple[set[str], str]]
+    resolved : set[str]
+    resolved_tags : set[str]
+    node_position : dict[str, int]
+    tag_node_position : dict[str, int]
+
+    # Source files of the recorded nodes, interned to ids as coord.file strings and as paths
+    file_ids : dict[str, int]
+    path_ids : dict[Path, int]
+    node_file : dict[str, int]
+    tag_node_file : dict[str, int]
+    # node and tag_node split by file id, in the same order
+    node_buckets : dict[int, dict[str, Node]]
+    tag_node_buckets : dict[int, dict[str, Node]]
+    # Parses the declarations a symbol needs when it's looked up, if only part of the translation unit is parsed
+    chunked_unit : ChunkedUnit
 
     class GatherSymbols(NodeVisitor):
-        local_variables : set[str] = set()
-        current_level_variables : set[str] = None
+        local_variables : set[str]
+        current_level_variables : set[str]
 
-        local_tags : set[str] = set()
-        current_level_tags : set[str] = None
+        local_tags : set[str]
+        current_level_tags : set[str]
 
         def __init__(self, parent):
             super().__init__()
             self.parent : Scanner = parent
+            self.reset()
+
+        def reset(self):
+            self.local_variables = set()
+            self.current_level_variables = set()
+
+            self.local_tags = set()
+            self.current_level_tags = set()
 
         def visit_FuncCall(self, node : Node):
             name : Node = node.name
             if isinstance(name, ID):
-                self.parent.functions.add(name.name)
+                self.parent.require(self.parent.functions, name.name)
             else:
                 self.visit(name)
 
@@ -47,7 +87,7 @@ class Scanner(NodeVisitor):
         def visit_ID(self, node : Node):
             name : str = node.name
             if name not in self.local_variables:
-                self.parent.variables.add(name)
+                self.parent.require(self.parent.variables, name)
 
         def visit_Compound(self, node : Node):
             prev_level_variables = self.current_level_variables
@@ -69,9 +109,15 @@ class Scanner(NodeVisitor):
             self.current_level_variables.add(node.name)
 
             self.visit(node.type)
+            # The name is in scope in its own initializer already
+            if node.init != None:
+                self.visit(node.init)
+            if node.bitsize != None:
+                self.visit(node.bitsize)
 
         def visit_IdentifierType(self, node : Node):
-            self.parent.types.update(set(node.names))
+            for name in node.names:
+                self.parent.require(self.parent.types, name)
 
         def visit_Struct(self, node : Node):
             self.handle_struct_union(node, self.parent.structs)
@@ -88,11 +134,13 @@ class Scanner(NodeVisitor):
                     self.current_level_tags.add(name)
 
                 for enumerator in values.enumerators:
-                    name = enumerator.name
-                    if name in self.parent.variables:
-                        self.coord[name] = node.coord
+                    # Enumerators are in scope like variables
+                    self.local_variables.add(enumerator.name)
+                    self.current_level_variables.add(enumerator.name)
+                    if enumerator.value != None:
+                        self.visit(enumerator.value)
             elif name != None and name not in self.local_tags:
-                self.parent.enums.add(Scanner.TAG_PREFIX + name)
+                self.parent.require(self.parent.enums, Scanner.TAG_PREFIX + name)
 
 
         def handle_struct_union(self, node : Node, symbols : set[str]):
@@ -106,14 +154,16 @@ class Scanner(NodeVisitor):
 
                 for decl in decls:
                     self.visit(decl.type)
+                    if decl.bitsize != None:
+                        self.visit(decl.bitsize)
             elif name != None and name not in self.local_tags:
-                symbols.add(Scanner.TAG_PREFIX + name)
+                self.parent.require(symbols, Scanner.TAG_PREFIX + name)
 
         def visit_StructRef(self, node : Node):
             self.visit(node.name)
 
         def visit_FuncDecl(self, node : Node):
-            for param in node.args.params:
+            for param in Scanner.get_params(node):
                 self.visit(param.type)
             self.visit(node.type)
 
@@ -122,158 +172,266 @@ class Scanner(NodeVisitor):
     def __init__(self, funcs):
         super().__init__()
         self.v_gatherSymbols = Scanner.GatherSymbols(self)
-        for func in funcs:
-            self.searchin_funcs.add(func)
-
-    def visit_FuncDef(self, node : Node):
-        name = node.decl.name
-        is_tracked = False
-
-        t = node.decl.type
-        args = t.args
-
-        if name in self.searchin_funcs:
-            if args != None:
-                for param in args.params:
-                    self.v_gatherSymbols.local_variables.add(param.name)
-
-            self.v_gatherSymbols.visit(node.body)
-
-            self.v_gatherSymbols.local_variables.clear()
-            is_tracked = True
-        elif name in self.functions:
-            is_tracked = True
-        elif name in self.variables:
-            self.variables.remove(name)
-            self.functions.add(name)
-
-            is_tracked = True
-
-        if is_tracked:
-            if args != None:
-                for param in args.params:
-                    self.v_gatherSymbols.visit(param.type)
-            self.v_gatherSymbols.visit(t.type)
-            self.node[name] = node
-
-
-    def visit_Decl(self, node : Node):
-        name = node.name
-        t = node.type
-        if isinstance(t, FuncDecl):
-        # function declaration
-            is_tracked = False
-            if name in self.functions:
-                is_tracked = True
-            elif name in self.variables:
-                self.variables.remove(name)
-                self.functions.add(name)
-                is_tracked = True
-
-            if is_tracked:
-                self.v_gatherSymbols.visit(t)
-                self.node[name] = node
-        else:
-            t = self.skip_array_ptr_declaration(t)
-
-            if isinstance(t, TypeDecl) and not isinstance(t, Typedef):
-            # variable declaration
-                t = t.type
-                if name in self.variables:
-                    self.node[name] = node
-                    self.v_gatherSymbols.visit(node.type)
-
-            if isinstance(t, Enum):
-            # enum declaration
-                self.handle_enum_declaration(t, node)
-            else:
-            # struct or union declaration
-                self.handle_nested_struct_union_declarations(t, node, [])
-
-    def visit_Typedef(self, node : Node):
-        name = node.name
-        if name in self.types:
-            self.node[name] = node
-            t = node.type.type
-            t = self.skip_array_ptr_declaration(t)
-
-            if isinstance(t, TypeDecl):
-                t = t.type
-
-            if isinstance(t, IdentifierType):
-                self.types.update(set(t.names))
-            elif isinstance(t, Enum):
-                self.handle_enum_declaration(t, node)
-            else:
-                self.handle_nested_struct_union_declarations(t, node, None)
-        else:
-            # handle this like a normal declaration
-            self.visit_Decl(node)
-
-    def skip_array_ptr_declaration(self, node : Node) -> Node:
-        while isinstance(node, ArrayDecl):
-            node = node.type
-        while isinstance(node, PtrDecl):
+        self.reset(funcs)
+
+    def reset(self, funcs = None):
+        # Forgets everything gathered so far, so the scanner can be reused for another translation unit.
+        # Keeps searching in the same functions unless new ones are given.
+        if funcs != None:
+            self.searchin_funcs = set(funcs)
+
+        self.functions = set()
+        self.variables = set()
+        self.types = set()
+        self.constants = set()
+
+        self.node = {}
+
+        self.structs = set()
+        self.unions = set()
+        self.enums = set()
+
+        self.tag_node = {}
+
+        self.ext = {}
+        self.symbol_index = {}
+        self.tag_index = {}
+        self.constant_index = {}
+
+        self.pending = []
+        self.resolved = set()
+        self.resolved_tags = set()
+        self.node_position = {}
+        self.tag_node_position = {}
+
+        self.file_ids = {}
+        self.path_ids = {}
+        self.node_file = {}
+        self.tag_node_file = {}
+        self.node_buckets = {}
+        self.tag_node_buckets = {}
+        self.chunked_unit = None
+
+        self.v_gatherSymbols.reset()
+
+    @staticmethod
+    def get_params(node : FuncDecl) -> list[Node]:
+        # Parameters that have a type, '...' and K&R identifier lists don't
+        if node.args == None:
+            return []
+        return [param for param in node.args.params if isinstance(param, (Decl, Typename))]
+
+    @staticmethod
+    def skip_array_ptr_declaration(node : Node) -> Node:
+        while isinstance(node, (ArrayDecl, PtrDecl)):
             node = node.type
         return node
 
-
-    def handle_enum_declaration(self, node : Node, origin_node : Node):
-        values = node.values
-        if values != None:
-            name = node.name
-            if name != None:
-                name = Scanner.TAG_PREFIX + name
-                self.tag_node[name] = origin_node
-            for enumerator in values.enumerators:
-                name = enumerator.name
-                if name in self.variables:
-                    self.node[name] = origin_node
-
-    def handle_nested_struct_union_declarations(self, node : Node, origin_node : Node, gather_stash : list):
+    def require(self, symbols : set[str], name : str):
+        # Adds a symbol the code needs, and queues it to be looked up if it's new
+        if name not in symbols:
+            symbols.add(name)
+            self.pending.append((symbols, name))
+
+    def index(self, node : Node):
+        # One pass over the top-level declarations
+        for (position, c) in enumerate(node):
+            self.index_declaration(position, c)
+
+    def index_declaration(self, position : int, c : Node):
+        # Indexes a top-level declaration, its tags and enumerators included
+        self.ext[position] = c
+        if isinstance(c, FuncDef):
+            self.symbol_index.setdefault(c.decl.name, []).append(position)
+        elif isinstance(c, (Decl, Typedef)):
+            if c.name != None:
+                self.symbol_index.setdefault(c.name, []).append(position)
+            if not isinstance(c.type, FuncDecl):
+                self.index_tags(c.type, position)
+
+    def index_tags(self, node : Node, position : int):
         node = self.skip_array_ptr_declaration(node)
         if isinstance(node, TypeDecl):
             node = node.type
 
-        symbols : set[str] = None
+        if isinstance(node, (Struct, Union)) and node.decls != None:
+            if node.name != None:
+                self.tag_index.setdefault(Scanner.TAG_PREFIX + node.name, (position, node))
+            for decl in node.decls:
+                self.index_tags(decl.type, position)
+        elif isinstance(node, Enum) and node.values != None:
+            if node.name != None:
+                self.tag_index.setdefault(Scanner.TAG_PREFIX + node.name, (position, node))
+            for enumerator in node.values.enumerators:
+                self.constant_index.setdefault(enumerator.name, (position, node))
+
+    def tag_symbols(self, node : Node) -> set[str]:
         if isinstance(node, Struct):
-            symbols = self.structs
-        elif isinstance(node, Union):
-            symbols = self.unions
-
-        if symbols != None:
-            name = node.name
-            if name != None:
-                name = Scanner.TAG_PREFIX + name
-                if name in symbols and gather_stash != None:
-                    for el in gather_stash:
-                        self.v_gatherSymbols.visit(el)
-                    gather_stash = None
-            decls = node.decls
-            if decls != None:
-                if name != None:
-                    self.tag_node[name] = origin_node
-                for decl in decls:
-                    self.handle_nested_struct_union_declarations(decl.type, origin_node, gather_stash)
-        elif isinstance(node, Enum):
-            self.handle_enum_declaration(node, origin_node)
-        elif gather_stash != None:
-            gather_stash += [node]
-        else:
-            self.v_gatherSymbols.visit(node)
-
-    def generic_visit(self, node : Node):
+            return self.structs
+        if isinstance(node, Union):
+            return self.unions
+        return self.enums
+
+    def get_owner(self, position : int) -> tuple[set[str], str]:
+        # The symbol a top-level declaration is emitted as, if it isn't only a variable
+        node = self.ext[position]
+        if isinstance(node, Typedef):
+            return (self.types, node.name)
+        if isinstance(node, Decl) and node.name == None and isinstance(node.type, (Struct, Union, Enum)) and node.type.name != None:
+            return (self.tag_symbols(node.type), Scanner.TAG_PREFIX + node.type.name)
         return None
 
+    def gather(self, node : Node, local_variables : list[str] = ()):
+        # Each top-level declaration is gathered in a scope of its own
+        self.v_gatherSymbols.reset()
+        self.v_gatherSymbols.local_variables.update(local_variables)
+        self.v_gatherSymbols.visit(node)
+
+    def get_file_id(self, node : Node) -> int:
+        # Each distinct coord.file is only turned into a path once
+        file = node.coord.file if node.coord != None else ''
+        file_id = self.file_ids.get(file)
+        if file_id == None:
+            file_id = self.path_ids.setdefault(Path(file), len(self.path_ids))
+            self.file_ids[file] = file_id
+        return file_id
+
+    def add_node(self, name : str, position : int):
+        self.node[name] = self.ext[position]
+        self.node_position[name] = position
+        self.node_file[name] = self.get_file_id(self.ext[position])
+
+    def move_symbol(self, name : str, old_symbols : set[str], new_symbols : set[str]):
+        # A name can be gathered as something it turns out not to be, like a function called through a pointer
+        if name in old_symbols:
+            old_symbols.remove(name)
+            new_symbols.add(name)
+
+    def resolve_symbol(self, name : str):
+        if self.chunked_unit != None:
+            for (position, c) in self.chunked_unit.load(name, name in self.searchin_funcs):
+                self.index_declaration(position, c)
+
+        positions = self.symbol_index.get(name)
+        if positions == None:
+            if name in self.constant_index:
+                self.resolve_constant(name)
+            return
+        # Declarations parsed later may come first
+        positions.sort()
+
+        first = self.ext[positions[0]]
+        if isinstance(first, FuncDef) or isinstance(first.type, FuncDecl):
+            self.move_symbol(name, self.variables, self.functions)
+            self.add_node(name, positions[0])
+
+            definition = None
+            for position in positions:
+                if isinstance(self.ext[position], FuncDef):
+                    definition = self.ext[position]
+                    # Searched functions are kept as their definition
+                    if name in self.searchin_funcs:
+                        self.add_node(name, position)
+                    break
+
+            if name in self.searchin_funcs and definition != None:
+                params = self.get_params(definition.decl.type)
+                self.gather(definition.body, [param.name for param in params])
+                self.gather(definition.decl.type)
+            elif isinstance(first, FuncDef):
+                self.gather(first.decl.type)
+            else:
+                self.gather(first.type)
+        elif isinstance(first, Typedef):
+            self.add_node(name, positions[0])
+            self.gather(first.type)
+        else:
+            self.move_symbol(name, self.functions, self.variables)
+            self.add_node(name, positions[0])
+            self.gather(first.type)
+
+    def resolve_constant(self, name : str):
+        (position, enum) = self.constant_index[name]
+        self.move_symbol(name, self.variables, self.constants)
+        self.constants.add(name)
+
+        # The enum is emitted with what it's declared in, a typedef or tag, if it can be
+        owner = self.get_owner(position)
+        if owner != None:
+            self.require(*owner)
+        elif enum.name != None:
+            self.require(self.enums, Scanner.TAG_PREFIX + enum.name)
+        else:
+            self.add_node(name, position)
+            self.gather(enum)
+
+    def resolve_tag(self, name : str):
+        if self.chunked_unit != None:
+            for (position, c) in self.chunked_unit.load_tag(name):
+                self.index_declaration(position, c)
+
+        entry = self.tag_index.get(name)
+        if entry == None:
+            return
+
+        (position, definition) = entry
+        symbols = self.tag_symbols(definition)
+        self.move_symbol(name, self.structs, symbols)
+        self.move_symbol(name, self.unions, symbols)
+        self.move_symbol(name, self.enums, symbols)
+
+        # Nested tags and the ones defined in a typedef are emitted with the declaration they're in
+        owner = self.get_owner(position)
+        if owner != None and (owner[0] is not symbols or owner[1] != name):
+            self.require(*owner)
+        else:
+            self.tag_node[name] = self.ext[position]
+            self.tag_node_position[name] = position
+            self.tag_node_file[name] = self.get_file_id(self.ext[position])
+            self.gather(definition)
+
     def exec(self, node : Node):
-        for c in reversed([i for i in node]):
-            self.visit(c)
-               
+        self.index(node)
+        self.resolve_all()
+
+    def exec_chunked(self, unit : ChunkedUnit):
+        # Same as exec, but the declarations are only parsed once something needs them
+        self.chunked_unit = unit
+        try:
+            self.resolve_all()
+        finally:
+            self.chunked_unit = None
+
+    def resolve_all(self):
+        for name in sorted(self.searchin_funcs):
+            self.resolved.add(name)
+            self.resolve_symbol(name)
+
+        # Each symbol is looked up once, whatever order the declarations are in
+        while len(self.pending) > 0:
+            (symbols, name) = self.pending.pop()
+            if symbols is self.structs or symbols is self.unions or symbols is self.enums:
+                if name not in self.resolved_tags:
+                    self.resolved_tags.add(name)
+                    self.resolve_tag(name)
+            elif name not in self.resolved:
+                self.resolved.add(name)
+                self.resolve_symbol(name)
+
+        self.node = dict(sorted(self.node.items(), key=lambda entry: self.node_position[entry[0]], reverse=True))
+        self.tag_node = dict(sorted(self.tag_node.items(), key=lambda entry: self.tag_node_position[entry[0]], reverse=True))
+
+        for (name, c) in self.node.items():
+            self.node_buckets.setdefault(self.node_file[name], {})[name] = c
+        for (name, c) in self.tag_node.items():
+            self.tag_node_buckets.setdefault(self.tag_node_file[name], {})[name] = c
+
     def filter_nodes_by_source(self, source_path: Path) -> dict[str, Node]:
-        return dict(filter(lambda entry: Path(entry[1].coord.file) == source_path, self.node.items()))
+        # The nodes from one source file, don't modify the dict
+        return self.node_buckets.get(self.path_ids.get(Path(source_path)), {})
     
     def filter_tag_nodes_by_source(self, source_path: Path) -> dict[str, Node]:
-        return dict(filter(lambda entry: Path(entry[1].coord.file) == source_path, self.tag_node.items()))
+        return self.tag_node_buckets.get(self.path_ids.get(Path(source_path)), {})
     
     def collect_includes(self) -> list[Path]:
         retVal = set()
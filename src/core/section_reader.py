@@ -0,0 +1,463 @@
+import re
+from enum import IntEnum
+
+class ReaderEngine(IntEnum):
+    LEGACY = 0
+    FAST = 1
+
+class SectionReader:
+    # Drop-in replacement for the per-character state machine in Preprocessor.read/read_include.
+    # Instead of visiting every character, it jumps between section boundaries with compiled
+    # regexes and str.find, slicing the source in bulk. Section positions, stored content and
+    # the arguments passed to Preprocessor.handle_directive are identical to the legacy reader.
+
+    non_space_re = re.compile(r'\S')
+    include_special_re = re.compile(r'[#/]')
+    directive_special_re = re.compile(r'[\n\\/]')
+    code_special_re = re.compile(r'[/{}();]')
+    skip_special_re = re.compile(r'/[*/]|\\\n|\n[ \t\f\v]*#')
+    directive_line_re = re.compile(r'[ \t\f\v]*#')
+    output_special_re = re.compile(r'[\n#"\'\\/]')
+
+    def __init__(self, preprocessor):
+        super().__init__()
+        self.preprocessor = preprocessor
+
+    @staticmethod
+    def _count_lines(code : str, start : int, stop : int, line : int, line_start : int) -> tuple[int, int]:
+        n = code.count('\n', start, stop)
+        if n > 0:
+            line += n
+            line_start = code.rfind('\n', start, stop) + 1
+        return (line, line_start)
+
+    def _read_directive(self, code : str, i : int, end : int, buf : list[str], buf_code : list[str], line : int, line_start : int) -> tuple[bool, int, int, int]:
+        find_special = self.directive_special_re.search
+        while True:
+            m = find_special(code, i)
+            k = m.start() if m != None else end
+
+            if k > i:
+                chunk = code[i:k]
+                buf_code.append(chunk)
+                buf.append(chunk.replace('\t', ' '))
+
+            if k >= end:
+                return (False, end, line, line_start)
+
+            c = code[k]
+            if c == '\n':
+                buf_code.append(c)
+                line += 1
+                line_start = k + 1
+                self.preprocessor.handle_directive(''.join(buf), ''.join(buf_code), line, line_start)
+                return (True, k + 1, line, line_start)
+            elif c == '\\':
+                i = k + 1
+                buf_code.append(c)
+                if i < end:
+                    if code[i] == '\n':
+                        buf_code.append('\n')
+                        buf.append(' ')
+                        line += 1
+                        line_start = i + 1
+                        i += 1
+                    else:
+                        buf.append(c)
+            else:
+                # c == '/'
+                i = k + 1
+                buf_code.append(c)
+                if i >= end:
+                    return (False, end, line, line_start)
+
+                n = code[i]
+                if n == '*':
+                    # Comments inside of directives are dropped from the directive text
+                    buf_code.append(n)
+                    stop = code.find('*/', k + 2)
+                    stop = end if stop < 0 else stop + 2
+                    (line, line_start) = self._count_lines(code, k + 2, stop, line, line_start)
+                    i = stop
+                elif n == '/':
+                    buf_code.append(n)
+                    stop = code.find('\n', k + 2)
+                    i = end if stop < 0 else stop
+                else:
+                    buf.append(c)
+
+    def _read_comment(self, code : str, k : int, end : int, line : int, line_start : int) -> tuple[int, str, int, int, bool]:
+        # k points at the opening '/'. The stored content starts at the character after it.
+        if code[k + 1] == '*':
+            stop = code.find('*/', k + 1)
+            terminated = stop >= 0
+            stop = stop + 2 if terminated else end
+            (line, line_start) = self._count_lines(code, k + 1, stop, line, line_start)
+        else:
+            stop = code.find('\n', k + 2)
+            terminated = stop >= 0
+            if terminated:
+                line += 1
+                line_start = stop + 1
+                stop += 1
+            else:
+                stop = end
+        return (stop, code[k + 1 : stop], line, line_start, terminated)
+
+    def _skip_inactive(self, code : str, i : int, end : int) -> int:
+        # Fast-forwards through a disabled conditional segment, starting at the beginning of a line.
+        # Only lines whose first token is '#' can change the conditional state, so everything else is
+        # skipped without building any buffers. Comments and line continuations are honoured, so a
+        # '#' inside a comment or after a continued line doesn't count as a directive.
+        find_special = self.skip_special_re.search
+        match_directive = self.directive_line_re.match
+
+        at_line_start = True
+        while True:
+            if at_line_start:
+                m = match_directive(code, i)
+                if m != None:
+                    return m.end() - 1
+
+            m = find_special(code, i)
+            if m == None:
+                return end
+
+            k = m.start()
+            if code[k] == '\n':
+                return m.end() - 1
+
+            # Has this logical line had anything but whitespace before k?
+            nl = code.rfind('\n', i, k)
+            if nl >= 0:
+                i = nl + 1
+                at_line_start = True
+            at_line_start = at_line_start and (i == k or code[i:k].isspace())
+
+            if code[k] == '\\':
+                i = k + 2
+            elif code[k + 1] == '*':
+                stop = code.find('*/', k + 1)
+                if stop < 0:
+                    return end
+                i = stop + 2
+            else:
+                stop = code.find('\n', k + 2)
+                if stop < 0:
+                    return end
+                at_line_start = False
+                i = stop
+
+    def _should_skip(self) -> bool:
+        pp = self.preprocessor
+        return pp.skip_inactive and pp._is_conditional_segment_inactive()
+
+    def read_include(self, code : str):
+        pp = self.preprocessor
+        code = code.replace("\r\n", "\n")
+
+        find_special = self.include_special_re.search
+        line = 1
+        line_start = 1
+        end = len(code)
+
+        i = 0
+        while i < end:
+            m = find_special(code, i)
+            k = m.start() if m != None else end
+
+            if k > i:
+                (line, line_start) = self._count_lines(code, i, k, line, line_start)
+                if len(pp.guard_detectors) > 0 and not code[i:k].isspace():
+                    pp._on_guard_code()
+
+            if k >= end:
+                break
+
+            buf : list[str] = None
+            if code[k] == '#':
+                buf = ['#']
+                i = k + 1
+            else:
+                i = k + 1
+                if i >= end:
+                    break
+
+                n = code[i]
+                if n == '*' or n == '/':
+                    (i, content, line, line_start, terminated) = self._read_comment(code, k, end, line, line_start)
+                    continue
+                elif n == '#':
+                    buf = ['/', '#']
+                elif n == '\n':
+                    line += 1
+                    line_start = i + 1
+                elif not n.isspace():
+                    pp._on_guard_code()
+                i += 1
+
+            if buf != None:
+                buf_code = buf[:]
+                (done, i, line, line_start) = self._read_directive(code, i, end, buf, buf_code, line, line_start)
+                if not done:
+                    pp.handle_directive(''.join(buf), ''.join(buf_code), line, line_start)
+                elif self._should_skip():
+                    k = self._skip_inactive(code, i, end)
+                    (line, line_start) = self._count_lines(code, i, k, line, line_start)
+                    i = k
+
+    def read_output(self, code : str):
+        # Like read_include, but also hands the active code to the preprocessor's output writer.
+        # Unlike read_include, string and character literals are skipped over, and only a '#'
+        # that starts a line starts a directive. Comments are written as a space, or as the
+        # newlines they span.
+        pp = self.preprocessor
+        writer = pp.output_writer
+        code = code.replace("\r\n", "\n")
+
+        find_special = self.output_special_re.search
+        line = 1
+        line_start = 1
+        end = len(code)
+
+        chunk : list[str] = []
+        chunk_line = 1
+        at_line_start = True
+
+        i = 0
+        while i < end:
+            m = find_special(code, i)
+            k = m.start() if m != None else end
+
+            if k > i:
+                piece = code[i:k]
+                chunk.append(piece)
+                if not piece.isspace():
+                    at_line_start = False
+                    if len(pp.guard_detectors) > 0:
+                        pp._on_guard_code()
+
+            if k >= end:
+                break
+
+            c = code[k]
+            i = k + 1
+            if c == '\n':
+                chunk.append(c)
+                line += 1
+                line_start = i
+                at_line_start = True
+            elif c == '#' and at_line_start:
+                writer.write(''.join(chunk), chunk_line)
+                chunk = []
+
+                buf = ['#']
+                buf_code = buf[:]
+                (done, i, line, line_start) = self._read_directive(code, i, end, buf, buf_code, line, line_start)
+                if not done:
+                    pp.handle_directive(''.join(buf), ''.join(buf_code), line, line_start)
+                elif self._should_skip():
+                    k = self._skip_inactive(code, i, end)
+                    (line, line_start) = self._count_lines(code, i, k, line, line_start)
+                    i = k
+                chunk_line = line
+            elif c == '"' or c == '\'':
+                # The literal ends at its closing quote, or unterminated at the end of the line
+                j = i
+                while j < end and code[j] != c and code[j] != '\n':
+                    j += 2 if code[j] == '\\' and code[j + 1 : j + 2] != '\n' else 1
+                i = min(j + 1, end) if j < end and code[j] == c else j
+                chunk.append(code[k:i])
+                at_line_start = False
+                if len(pp.guard_detectors) > 0:
+                    pp._on_guard_code()
+            elif c == '\\':
+                if i < end and code[i] == '\n':
+                    # Line splice, the line count is caught up on by a line marker
+                    line += 1
+                    line_start = i + 1
+                    i += 1
+                else:
+                    chunk.append(c)
+                    at_line_start = False
+            elif c == '/' and i < end and (code[i] == '*' or code[i] == '/'):
+                # A line comment ends with its newline, a block comment is whitespace in the line it ends in
+                (i, content, line, line_start, terminated) = self._read_comment(code, k, end, line, line_start)
+                newlines = content.count('\n')
+                chunk.append('\n' * newlines if newlines > 0 else ' ')
+                if code[k + 1] == '/' and terminated:
+                    at_line_start = True
+            else:
+                chunk.append(c)
+                at_line_start = False
+                if len(pp.guard_detectors) > 0:
+                    pp._on_guard_code()
+
+        writer.write(''.join(chunk), chunk_line)
+
+    def read(self, code : str):
+        # Imported here, the legacy reader's enums live in cpreprocessor
+        from .cpreprocessor import CodeSection, FunctionDefState
+
+        pp = self.preprocessor
+        code = code.replace("\r\n", "\n")
+
+        find_non_space = self.non_space_re.search
+        find_special = self.code_special_re.search
+        line = 1
+        line_start = 0
+        brace_level = 0
+        parentheses_level = 0
+        func_def_state = FunctionDefState.OUTSIDE
+        end = len(code)
+        section = CodeSection.WHITESPACE
+
+        i = 0
+        while i < end:
+            m = find_non_space(code, i)
+            k = m.start() if m != None else end
+
+            (line, line_start) = self._count_lines(code, i, k, line, line_start)
+            if k >= end:
+                break
+
+            c = code[k]
+            buf : list[str]
+            if c == '#':
+                buf = ['#']
+                section = CodeSection.DIRECTIVE
+                i = k + 1
+            elif c == '/':
+                i = k + 1
+                if i >= end:
+                    break
+
+                n = code[i]
+                if n == '*' or n == '/':
+                    section = CodeSection.COMMENT if n == '*' else CodeSection.LINE_COMMENT
+                    start_line = line
+                    start_pos = i - line_start
+                    (i, content, line, line_start, terminated) = self._read_comment(code, k, end, line, line_start)
+                    pp._store_section(start_line, start_pos, section, [], [content])
+                    if terminated:
+                        section = CodeSection.WHITESPACE
+                    continue
+                elif n == '#':
+                    buf = ['/', '#']
+                    section = CodeSection.DIRECTIVE
+                elif n.isspace():
+                    if n == '\n':
+                        line += 1
+                        line_start = i + 1
+                    i += 1
+                    continue
+                else:
+                    buf = ['/', n]
+                    section = CodeSection.CODE
+                i += 1
+            else:
+                buf = [c]
+                section = CodeSection.CODE
+                i = k + 1
+
+            start_line = line
+            start_pos = i - line_start
+            stored = i < end
+            buf_code = buf[:]
+
+            if section == CodeSection.DIRECTIVE:
+                (done, i, line, line_start) = self._read_directive(code, i, end, buf, buf_code, line, line_start)
+                if done:
+                    pp._store_section(start_line, start_pos, section, buf, buf_code)
+                    section = CodeSection.WHITESPACE
+                    if self._should_skip():
+                        k = self._skip_inactive(code, i, end)
+                        (line, line_start) = self._count_lines(code, i, k, line, line_start)
+                        i = k
+                elif stored:
+                    pp._store_section(start_line, start_pos, section, buf, buf_code)
+                continue
+
+            # CODE
+            while True:
+                m = find_special(code, i)
+                k = m.start() if m != None else end
+
+                if k > i:
+                    chunk = code[i:k]
+                    if func_def_state == FunctionDefState.WATCHING:
+                        w = find_non_space(chunk)
+                        if w != None:
+                            func_def_state = FunctionDefState.OUTSIDE
+                            buf_code.append(chunk[: w.start() + 1])
+                            raise Exception("Invalid C syntax at line %d!\n%s" % (line, ''.join(buf_code)))
+                    buf.append(chunk)
+                    buf_code.append(chunk)
+                    (line, line_start) = self._count_lines(code, i, k, line, line_start)
+
+                if k >= end:
+                    i = end
+                    break
+
+                c = code[k]
+                i = k + 1
+                if c == '/':
+                    if i >= end:
+                        buf_code.append(c)
+                        break
+
+                    n = code[i]
+                    if n == '*':
+                        stop = code.find('*/', k + 2)
+                        stop = end if stop < 0 else stop + 2
+                        buf_code.append(code[k : stop])
+                        (line, line_start) = self._count_lines(code, k + 2, stop, line, line_start)
+                        i = stop
+                    elif n == '/':
+                        stop = code.find('\n', k + 2)
+                        if stop < 0:
+                            stop = end
+                        else:
+                            stop += 1
+                            line += 1
+                            line_start = stop
+                        buf_code.append(code[k : stop])
+                        i = stop
+                    else:
+                        buf.append(c)
+                        buf_code.append(c)
+                    continue
+
+                buf.append(c)
+                buf_code.append(c)
+
+                code_section_end = False
+                match c:
+                    case '{':
+                        brace_level += 1
+                        if func_def_state == FunctionDefState.WATCHING:
+                            func_def_state = FunctionDefState.INSIDE
+                    case '}':
+                        brace_level -= 1
+                        if func_def_state == FunctionDefState.INSIDE and brace_level == 0:
+                            code_section_end = True
+                    case '(':
+                        parentheses_level += 1
+                    case ')':
+                        if brace_level == 0:
+                            func_def_state = FunctionDefState.WATCHING
+                        parentheses_level -= 1
+                    case ';':
+                        if brace_level == 0:
+                            code_section_end = True
+
+                if code_section_end:
+                    func_def_state = FunctionDefState.OUTSIDE
+                    section = CodeSection.WHITESPACE
+                    break
+
+            if stored:
+                pp._store_section(start_line, start_pos, CodeSection.CODE, buf, buf_code)
+
+        if section == CodeSection.DIRECTIVE:
+            pp.handle_directive(''.join(buf), ''.join(buf_code), line, line_start)
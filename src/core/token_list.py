@@ -0,0 +1,88 @@
+import sys
+from array import array
+
+class TokenList:
+    # Compact token buffer used for macro bodies and expansions.
+    # Tokens are stored as two parallel arrays: one byte per token for its kind (a MacroSection)
+    # and a list of interned strings for its text. Tokens are addressed by index, and lists are
+    # edited by splicing ranges instead of relinking nodes.
+    # A frozen list keeps its tokens in bytes and a tuple instead, so it can be shared
+    # (e.g. a macro body used by every expansion) and copied or spliced from, but not edited.
+    __slots__ = ('kinds', 'texts')
+
+    kinds : array | bytes
+    texts : list[str] | tuple[str]
+
+    def __init__(self, kinds : array | bytes = None, texts : list[str] | tuple[str] = None):
+        super().__init__()
+        self.kinds = kinds if kinds != None else array('B')
+        self.texts = texts if texts != None else []
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __iter__(self):
+        return zip(self.kinds, self.texts)
+
+    def __getitem__(self, i : int) -> tuple[int, str]:
+        return (self.kinds[i], self.texts[i])
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, TokenList) and bytes(self.kinds) == bytes(other.kinds) and tuple(self.texts) == tuple(other.texts)
+
+    def __repr__(self) -> str:
+        return '[' + ', '.join(repr(token) for token in self) + ']'
+
+    def is_empty(self) -> bool:
+        return len(self.texts) == 0
+
+    def is_frozen(self) -> bool:
+        return type(self.texts) == tuple
+
+    def set(self, i : int, kind : int, text : str):
+        self.kinds[i] = kind
+        self.texts[i] = text
+
+    def append(self, kind : int, text : str):
+        if type(text) == str:
+            text = sys.intern(text)
+        self.kinds.append(kind)
+        self.texts.append(text)
+
+    def extend(self, other):
+        self.kinds.extend(other.kinds)
+        self.texts.extend(other.texts)
+
+    def copy(self):
+        # Shallow, the texts are immutable
+        return TokenList(array('B', self.kinds), list(self.texts))
+
+    def freeze(self):
+        return TokenList(bytes(self.kinds), tuple(self.texts))
+
+    def slice(self, start : int, stop : int):
+        return TokenList(self.kinds[start:stop], self.texts[start:stop])
+
+    def delete(self, start : int, stop : int = None):
+        if stop == None:
+            stop = start + 1
+        del self.kinds[start:stop]
+        del self.texts[start:stop]
+
+    def splice(self, start : int, stop : int, other):
+        # Replaces the tokens in [start, stop) with the tokens of other
+        kinds = other.kinds
+        if type(kinds) != array:
+            kinds = array('B', kinds)
+        self.kinds[start:stop] = kinds
+        self.texts[start:stop] = other.texts
+
+    def find_non_space(self, i : int, step : int, space_kind : int) -> int:
+        # Index of the first token from i on (in the direction of step) that isn't space_kind, or -1
+        end = len(self.texts)
+        kinds = self.kinds
+        while 0 <= i < end:
+            if kinds[i] != space_kind:
+                return i
+            i += step
+        return -1
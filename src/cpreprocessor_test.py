@@ -1,4 +1,4 @@
-import sys, shutil, os
+import sys, shutil, os, re, time, tempfile, cProfile, pstats
 from enum import IntEnum
 from types import FunctionType as function
 from collections import deque
@@ -6,8 +6,11 @@ from copy import deepcopy
 from pathlib import Path
 
 from core.cpreprocessor import Preprocessor
-from core.macro import MacroSection, MacroExpression, MacroExpressionNode, Macro, ObjectMacro, FunctionMacro, VariadicMacro, MacroSource, ExternalSource, CodeSource
+from core.macro import MacroSection, MacroExpression, Macro, ObjectMacro, FunctionMacro, VariadicMacro, MacroSource, ExternalSource, CodeSource
 from core.constexpr_evaluator import ConstexprEvaluator
+from core.section_reader import ReaderEngine
+from core.macro_expander import ExpansionEngine
+from core.header_cache import HeaderCache
 
 standard_c_lib_dir = "mm/include/libc" # I'm not sure if decomp uses compiler's standard C library
 
@@ -55,13 +58,300 @@ def preprocessor_test():
 
     p = Preprocessor(include_dirs, standard_c_lib_dir)
     p.exec(file)
+    p.print_include_stats()
 
     print("OK" if ("MESSAGE_ITEM_NONE" in p.macros) else "ERROR")
 
+def include_graph_test():
+    print("\nInclude graph test")
+
+    # a.h and b.h include each other, and main.c includes both
+    files = {
+        "main.c": '#include "a.h"\nint x;\n#include "inc/b.h"\n',
+        "a.h": '#ifndef A_H\n#define A_H\n#include "inc/b.h"\n#endif\n',
+        "inc/b.h": '#ifndef B_H\n#define B_H\n#include "a.h"\n#endif\n',
+    }
+    with tempfile.TemporaryDirectory() as dir:
+        for name, code in files.items():
+            Path(dir, name).parent.mkdir(parents=True, exist_ok=True)
+            Path(dir, name).write_text(code)
+        p = Preprocessor([dir], "")
+        p.exec(os.path.join(dir, "main.c"))
+        graph = p.include_graph
+        (main, a, b) = [os.path.join(dir, name) for name in files.keys()]
+
+        # Includes skipped because of a guard are still in the graph
+        print("OK" if graph.include_lines(main, a) == [1] and graph.include_lines(main, b) == [3] and graph.include_lines(a, b) == [3] and graph.include_lines(b, a) == [3] else "ERROR")
+        print("OK" if graph.transitive_includes(main) == {a, b} and graph.transitive_includes(a) == {b} and graph.transitive_includes(b) == {a} else "ERROR")
+        print("OK" if graph.reverse_dependencies(b) == {main, a} and graph.reverse_dependencies(main) == set() else "ERROR")
+
+def include_guard_test():
+    print("\nInclude guard test")
+
+    files = {
+        "main.c": '#include "guard.h"\n#include "guard.h"\n#include "once.h"\n#include "once.h"\n'
+                  '#include "else.h"\n#include "else.h"\n#undef GUARD_H\n#include "guard.h"\n',
+        "guard.h": '#ifndef GUARD_H\n#define GUARD_H\nint g;\n#endif\n',
+        "once.h": '#pragma once\nint o;\n',
+        # Has code when its macro is defined, so it isn't guarded by it
+        "else.h": '#ifndef ELSE_H\n#define ELSE_H\n#else\nint e;\n#endif\n',
+    }
+    with tempfile.TemporaryDirectory() as dir:
+        for name, code in files.items():
+            Path(dir, name).write_text(code)
+        p = Preprocessor([dir], "")
+        p.exec(os.path.join(dir, "main.c"))
+        (main, guard, once, other) = [os.path.join(dir, name) for name in files.keys()]
+
+        # The second guard.h and once.h are skipped, else.h is read twice and guard.h again once its guard is undefined
+        print("OK" if p.skipped_includes == 2 else "ERROR")
+        print("OK" if p.include_guards == {guard: "GUARD_H"} and p.once_files == {once} else "ERROR")
+        print("OK" if "GUARD_H" in p.macros and "ELSE_H" in p.macros else "ERROR")
+
+def header_cache_test():
+    global standard_c_lib_dir
+    print("\nHeader cache test")
+
+    cache = HeaderCache()
+    results = []
+    for i in range(3):
+        p = Preprocessor(include_dirs, standard_c_lib_dir, header_cache=(cache if i > 0 else None))
+
+        start = time.perf_counter()
+        p.exec(file)
+        print("%s: %.3fs" % (["No cache", "Recording", "Replaying"][i], time.perf_counter() - start))
+
+        macros = {n: ObjectMacro.contents_to_string(m.contents) for n, m in p.macros.items()}
+        results.append((macros, p.include_guards, p.once_files, p.detected_includes))
+
+    print(cache)
+    print("OK" if results[0] == results[1] == results[2] else "ERROR")
+
+def if_evaluation_test(dirs : list[str] = None):
+    global standard_c_lib_dir
+    print("\nIf evaluation test")
+
+    # Every #if/#elif expression in the headers, with defined() and macros already handled
+    directive_re = re.compile(r'^[ \t]*#[ \t]*(?:if|elif)\b((?:[^\n\\]|\\.)*)', re.M | re.S)
+    p = Preprocessor(include_dirs, standard_c_lib_dir)
+    exprs = []
+    directives = 0
+    for dir in (dirs if dirs != None else include_dirs):
+        for path in Path(dir).rglob("*.h"):
+            code = re.sub(r'/\*.*?\*/|//[^\n]*', ' ', path.read_text(errors="replace"), flags=re.S)
+            for m in directive_re.finditer(code):
+                directives += 1
+                try:
+                    parsed = ObjectMacro.parse(m.group(1).replace("\\\n", " ").strip())
+                    p._check_for_defined(parsed)
+                    parsed = p.expand_macros(parsed)
+                    ConstexprEvaluator().eval(parsed.copy())
+                except Exception:
+                    continue
+                exprs.append(parsed)
+
+    copies = [expr.copy() for expr in exprs]
+    start = time.perf_counter()
+    for expr in copies:
+        ConstexprEvaluator().eval(expr)
+    elapsed = time.perf_counter() - start
+    print("%d of %d directive(s): %.3fs, %.1fus per directive" % (len(exprs), directives, elapsed, elapsed / max(len(exprs), 1) * 1e6))
+
+def reader_engine_test():
+    global standard_c_lib_dir
+    print("\nReader engine test")
+
+    results = []
+    for engine in [ReaderEngine.LEGACY, ReaderEngine.FAST]:
+        # Skipping inactive segments drops their sections, which the legacy engine keeps
+        p = Preprocessor(include_dirs, standard_c_lib_dir, reader_engine=engine, skip_inactive=False)
+
+        start = time.perf_counter()
+        p.exec2(file)
+        print("%s: %.3fs" % (engine.name, time.perf_counter() - start))
+
+        sections = [(k, v.section, v.content, v.code_content) for k, v in p.sections.items()]
+        macros = {n: ObjectMacro.contents_to_string(m.contents) for n, m in p.macros.items()}
+        results.append((sections, macros))
+
+    print("OK" if results[0] == results[1] else "ERROR")
+
+def skip_inactive_test():
+    print("\nSkip inactive test")
+
+    # Disabled segments nest, and only the outermost one's #elif/#else can enable code again.
+    # Directives in comments don't count.
+    code = (
+        "#define BASE 1\n#if 0\n#define A0 1\n#if 1\n#define A1 1\n#elif 1\n#define A2 1\n#else\n#define A3 1\n#endif\n"
+        "/*\n#define C0 1\n*/\n"
+        "#elif BASE\n#define B1 1\n#if 0\n#define B2 1\n#elif 1\n#define B3 1\n#else\n#define B4 1\n#endif\n"
+        "#else\n#define B5 1\n#endif\n#ifdef MISSING\n#define D0 1\n#else\n#define D1 1\n#endif\n"
+    )
+    # Neither does one on a continued line. Only skipping gets this right, the readers otherwise
+    # take the '\\' for code.
+    continued = "#if 0\nint x = 1; \\\n#endif\n#define E0 1\n#endif\n#define E1 1\n"
+
+    def read_macros(read : function, code : str, skip_inactive : bool) -> dict[str, str]:
+        p = Preprocessor([], "", skip_inactive=skip_inactive)
+        p.current_file = "test.h"
+        read(p, code)
+        return {n: ObjectMacro.contents_to_string(m.contents) for n, m in p.macros.items() if not n.startswith("_")}
+
+    results = [read_macros(read, code, skip_inactive) for skip_inactive in [False, True] for read in [Preprocessor.read_include, Preprocessor.read]]
+    print("OK" if all(r == results[0] for r in results) else "ERROR")
+    print("OK" if set(results[0]) == {"BASE", "B1", "B3", "D1"} else "ERROR")
+
+    results = [read_macros(read, continued, True) for read in [Preprocessor.read_include, Preprocessor.read]]
+    print("OK" if results == [{"E1": "1"}] * 2 else "ERROR")
+
+def expansion_engine_test():
+    global standard_c_lib_dir
+    print("\nExpansion engine test")
+
+    defines = [
+        "A B", "B 1", "C A + B", "SELF SELF + 1", "F(x) (x * 2)", "G(x, y) F(x) + F(y)", "CAT(a, b) a ## b",
+        "CAT3(a, b, c) a ## b ## c", "STR(x) #x", "XSTR(x) STR(x)", "ID(x) x",
+        "ARRAY_COUNT(arr) (s32)(sizeof(arr) / sizeof(arr[0]))", "OFFSETOF(structure, member) ((size_t)&(((structure*)0)->member))",
+        "V(fmt, ...) printf(fmt, __VA_ARGS__)", "VS(...) #__VA_ARGS__", "EMPTY", "CALL(f, x) f(x)", "TWICE(x) ID(ID(x))",
+        "SEG(name) _ ## name ## SegmentStart", "PAIR(a, b) { a, b }", "APPLY(m, ...) m(__VA_ARGS__)", "NEST(x) x ## _ID",
+        "AB_ID 42", "RECUR(x) RECUR(x + 1)", "NUM 10", "f(a) a*g", "g(a) f(a)", "PP QQ", "QQ PP", "h(x) x h", "OBJF ID",
+    ]
+    # (expression, what cpp -P expands it to), compared without whitespace
+    cases = [
+        ("A", "1"), ("C", "1 + 1"), ("SELF", "SELF + 1"), ("F(3)", "(3 * 2)"), ("G(1, 2)", "(1 * 2) + (2 * 2)"),
+        ("CAT(x, y)", "xy"), ("CAT3(a, b, c)", "abc"), ("STR(a + b)", '"a + b"'), ("XSTR(A)", '"1"'), ("STR(A)", '"A"'),
+        ("ID(A)", "1"), ("ARRAY_COUNT(sArr)", "(s32)(sizeof(sArr) / sizeof(sArr[0]))"),
+        ("OFFSETOF(Actor, world.pos)", "((size_t)&(((Actor*)0)->world.pos))"), ('V("%d", 1, 2)', 'printf("%d", 1, 2)'),
+        ("VS(a, b)", '"a, b"'), ("EMPTY x EMPTY", "x"), ("CALL(F, 2)", "(2 * 2)"), ("SEG(ovl_En_Test)", "_ovl_En_TestSegmentStart"),
+        ("PAIR(F(1), G(2, 3))", "{ (1 * 2), (2 * 2) + (3 * 2) }"), ("APPLY(G, 4, 5)", "(4 * 2) + (5 * 2)"), ("NEST(AB)", "42"),
+        ("RECUR(1)", "RECUR(1 + 1)"), ("CAT(NUM, 1)", "NUM1"), ("XSTR(CAT(N, UM))", '"10"'), ("CAT(N, UM)", "10"),
+        ("F((a, b))", "((a, b) * 2)"), ("G((1, 2), 3)", "((1, 2) * 2) + (3 * 2)"), ("ID()", ""), ("XSTR(F(NUM))", '"(10 * 2)"'),
+        ("A B C", "1 1 1 + 1"), ("F (2)", "(2 * 2)"), ("CALL(ID, NUM)", "10"), ("PP", "PP"), ("QQ", "QQ"), ("ID(ID)(3)", "ID(3)"),
+        # The legacy engine gets these wrong
+        ("TWICE(A)", "1"), ("F(F(2))", "((2 * 2) * 2)"), ("f(2)(9)", "2*9*g"), ("h(h(1))", "1 h h"), ("OBJF(5)", "5"),
+        ("CALL(f, 1)(2)", "1*2*g"),
+    ]
+    agreed = len(cases) - 6
+
+    results = []
+    for engine in [ExpansionEngine.LEGACY, ExpansionEngine.HIDE_SET]:
+        p = Preprocessor(include_dirs, standard_c_lib_dir, expansion_engine=engine)
+        for definition in defines:
+            p.handle_DEFINE(definition, None)
+
+        expansions = [ObjectMacro.contents_to_string(p.expand_macros(ObjectMacro.parse(e))) for (e, _) in cases]
+        results.append([re.sub(r'\s+', '', expansion) for expansion in expansions])
+
+    print("OK" if results[0][:agreed] == results[1][:agreed] else "ERROR")
+    print("OK" if results[1] == [re.sub(r'\s+', '', expected) for (_, expected) in cases] else "ERROR")
+
+    # Misplaced '#' and '##' are reported by #define, not when the macro is used
+    errors = 0
+    for definition in ["BAD(x) #y", "BAD(x) ## x", "BAD(x) x ##", "BAD(...) #x"]:
+        try:
+            Preprocessor(include_dirs, standard_c_lib_dir).handle_DEFINE(definition, None)
+        except Exception:
+            errors += 1
+    print("OK" if errors == 4 else "ERROR")
+
+def count_deepcopies(profile : cProfile.Profile) -> int:
+    return sum(stats[1] for (func, stats) in pstats.Stats(profile).stats.items() if func[2] == "deepcopy")
+
+def nested_expansion_test():
+    global standard_c_lib_dir
+    print("\nNested expansion test")
+
+    exprs = [
+        ObjectMacro.parse("CLAMP(ABS(SQ(SCREEN_WIDTH - SCREEN_HEIGHT)), SQ(2), MAX(SCREEN_WIDTH, SCREEN_HEIGHT))"),
+        ObjectMacro.parse("MAX(MAX(MAX(1, 2), MAX(3, 4)), MAX(MAX(5, 6), MAX(7, 8)))"),
+        ObjectMacro.parse("LOG(\"%d %d\", GLUE(SCREEN_, WIDTH), ABS(MIN(SCREEN_WIDTH, SCREEN_HEIGHT)))"),
+    ]
+    for engine in [ExpansionEngine.LEGACY, ExpansionEngine.HIDE_SET]:
+        p = Preprocessor(include_dirs, standard_c_lib_dir, expansion_engine=engine)
+        p.new_ObjectMacro("SCREEN_WIDTH", None, "320")
+        p.new_ObjectMacro("SCREEN_HEIGHT", None, "240")
+        p.new_FunctionMacro("ABS", None, "((x) >= 0 ? (x) : -(x))", ["x"])
+        p.new_FunctionMacro("MAX", None, "((a) > (b) ? (a) : (b))", ["a", "b"])
+        p.new_FunctionMacro("MIN", None, "((a) < (b) ? (a) : (b))", ["a", "b"])
+        p.new_FunctionMacro("CLAMP", None, "MAX(lo, MIN(x, hi))", ["x", "lo", "hi"])
+        p.new_FunctionMacro("SQ", None, "((x) * (x))", ["x"])
+        p.new_FunctionMacro("GLUE", None, "a ## b", ["a", "b"])
+        p.new_VariadicMacro("LOG", None, "printf(fmt, __VA_ARGS__)", ["fmt"])
+
+        def run(n : int):
+            for _ in range(n):
+                for expr in exprs:
+                    p.expand_macros(expr.copy())
+
+        n = 1000
+        run(50)
+        start = time.perf_counter()
+        run(n)
+        print("%s: %.1fus per expression" % (engine.name, (time.perf_counter() - start) / (n * len(exprs)) * 1e6))
+
+        # Bodies and arguments are shared, nothing gets deep-copied
+        profile = cProfile.Profile()
+        profile.runcall(run, 100)
+        print("OK" if count_deepcopies(profile) == 0 else "ERROR")
+
+def expansion_profile_test(path : str = None, dirs : list[str] = None):
+    global standard_c_lib_dir
+    print("\nExpansion profile test")
+
+    p = Preprocessor(dirs if dirs != None else include_dirs, standard_c_lib_dir)
+    profile = cProfile.Profile()
+    profile.runcall(p.exec, path if path != None else file)
+    pstats.Stats(profile).sort_stats("tottime").print_stats(15)
+    print("OK" if count_deepcopies(profile) == 0 else "ERROR")
+
+def snapshot_test():
+    global standard_c_lib_dir
+    print("\nSnapshot test")
+
+    prelude = Preprocessor(include_dirs, standard_c_lib_dir)
+    prelude.new_ObjectMacro("NUM", None, "10")
+    prelude.new_ObjectMacro("TWICE", None, "NUM * 2")
+    snapshot = prelude.snapshot()
+
+    # Forks don't see each other's changes, and leave the snapshot as it was
+    a = Preprocessor(include_dirs, standard_c_lib_dir)
+    a.fork(snapshot)
+    a.new_ObjectMacro("NUM", None, "20")
+    b = Preprocessor(include_dirs, standard_c_lib_dir)
+    b.fork(snapshot)
+    b.handle_UNDEF("TWICE", None)
+
+    results = [ObjectMacro.contents_to_string(p.expand_macros(ObjectMacro.parse("TWICE"))) for p in [a, b]]
+    print("OK" if results == ["20 * 2", "TWICE"] else "ERROR")
+    print("OK" if a.is_inherited_macro("TWICE") and not a.is_inherited_macro("NUM") and "TWICE" in snapshot.macros else "ERROR")
+
+def output_test():
+    print("\nOutput test")
+
+    p = Preprocessor([], "", True, emit_output=True)
+    p.handle_command_line_macros(["-E", "-DSCALE=3", "-D", "ADD(a,b)=a+b"])
+    p.current_file = "test.c"
+    p.preprocess("#define NEG -1\nint x = -NEG;\nint y = ADD(SCALE,\n  2);\nint z = __LINE__;\n#if SCALE > 2\nint big;\n#else\nint small;\n#endif\n")
+
+    # Tokens that would merge are kept apart, and lines are marked again after a multi-line invocation
+    expected = '# 2 "test.c"\nint x = - -1;\nint y = 3+2;\n# 5 "test.c"\nint z = 5;\n\nint big;\n'
+    print("OK" if p.get_output() == expected else "ERROR")
+
 def main():
     macro_test()
     constexpr_evaluator_test()
+    skip_inactive_test()
+    expansion_engine_test()
+    nested_expansion_test()
+    snapshot_test()
+    output_test()
+    include_graph_test()
+    include_guard_test()
     preprocessor_test()
+    expansion_profile_test()
+    header_cache_test()
+    reader_engine_test()
+    if_evaluation_test()
     print("\nFINISHED")
 
 include_dirs = [
@@ -13,6 +13,9 @@ class ProjectConfig:
     local_macros: dict[str, str]
     standard_c_lib_dir: str
     includes: list[Path]
+    prelude: list[Path]
+    preproc_backend: str
+    parse_mode: str
     preproc_command: str
     preproc_flags: list[str]
 
@@ -56,6 +59,9 @@ class ProjectConfig:
                 "${PROJECT_ROOT}/src",
                 "${PROJECT_ROOT}/assets",
             ],
+            "prelude": [],
+            "preproc_backend": "external",
+            "parse_mode": "full",
             "preproc_command": "${DEFAULT_PREPROC}",
             "preproc_flags": [
                 "-U__GNUC__",
@@ -80,6 +86,9 @@ class ProjectConfig:
             "local_macros": {},
             "standard_c_lib_dir" : "",
             "includes": [],
+            "prelude": [],
+            "preproc_backend": "external",
+            "parse_mode": "full",
             "preproc_command": "",
             "preproc_flags": [],
             "process_specs": {},
@@ -102,6 +111,9 @@ class ProjectConfig:
         else:
             self.standard_c_lib_dir = ""
             self.includes = []
+            self.prelude = []
+            self.preproc_backend = "external"
+            self.parse_mode = "full"
             self.preproc_command = ""
             self.preproc_flags = []
             self.process_specs = []
@@ -123,7 +135,13 @@ class ProjectConfig:
         self.includes = [
             self.location.joinpath(i) for i in load_dict["includes"]
         ]
+        # Headers every file starts with. They're preprocessed once and shared by all the specs.
+        self.prelude = [
+            self.location.joinpath(i) for i in load_dict["prelude"]
+        ]
         self.standard_c_lib_dir = load_dict["standard_c_lib_dir"]
+        self.preproc_backend = load_dict["preproc_backend"]
+        self.parse_mode = load_dict["parse_mode"]
         self.preproc_command = load_dict["preproc_command"]
         self.preproc_flags = load_dict["preproc_flags"]
         self.process_specs = {}
@@ -0,0 +1,112 @@
+import hashlib, os, pickle, sys, tempfile
+from pathlib import Path
+
+import pycparser
+from pycparser.c_ast import FileAST
+
+import settings, util
+
+class AstCache:
+    # On-disk cache of parsed pycparser ASTs, keyed by the hash of the preprocessed text they came from.
+    # Entries are pickle files in the user cache directory. An entry's mtime is refreshed when it's
+    # used, so evicting the oldest files first once the size cap is exceeded is least-recently-used.
+    suffix = ".ast.pickle"
+
+    directory: Path
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        # Returns None if the cache is disabled.
+        if not settings.current.cache.ast_cache_enabled or settings.current.paths.rfa_cache_dir is None:
+            return None
+        return cls(
+            settings.current.paths.rfa_cache_dir.joinpath("ast"),
+            settings.current.cache.ast_cache_max_size_mb * 1024 * 1024,
+        )
+
+    @staticmethod
+    def key(text: str, filename: str) -> str:
+        # ASTs pickled by another version of pycparser may not match its current node classes.
+        # The file name ends up in the coordinates of nodes that aren't covered by a line marker.
+        return hashlib.sha256(f"{pycparser.__version__}\0{filename}\0{text}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory.joinpath(key + self.suffix)
+
+    def get(self, text: str, filename: str) -> FileAST:
+        path = self._entry_path(self.key(text, filename))
+        try:
+            with path.open("rb") as file:
+                ast = pickle.load(file)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            util.print_warning(f"Discarding unreadable AST cache entry '{path.name}': {e}")
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return ast
+
+    def put(self, text: str, filename: str, ast: FileAST):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # ASTs of large translation units nest deeper than the default recursion limit allows pickling.
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, 20000))
+        try:
+            data = pickle.dumps(ast, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            util.print_warning("AST is nested too deeply to be cached.")
+            return
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+        if len(data) > self.max_size:
+            return
+
+        # Written to a temporary file first, so parallel workers never see a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, self._entry_path(self.key(text, filename)))
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for path in self.directory.glob("*" + self.suffix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+    def clear(self):
+        for path in self.directory.glob("*" + self.suffix):
+            path.unlink(missing_ok=True)
+
+    def __str__(self):
+        return f"AST cache: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,152 @@
+import hashlib, json
+from pathlib import Path
+
+import util
+
+class BuildManifest:
+    # Remembers what every spec was generated from, so unchanged specs can be skipped.
+    # For each spec it stores a hash of the spec itself, a hash of the effective
+    # preprocessor flags, and a content hash of the input file and every include it resolved.
+    version = 1
+
+    path: Path
+    specs: dict[str, dict]
+
+    _file_hashes: dict[str, dict]
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.specs = {}
+        self._file_hashes = {}
+
+    @classmethod
+    def path_for_config(cls, config_path: Path) -> Path:
+        return config_path.with_name(config_path.stem + ".manifest.json")
+
+    @staticmethod
+    def hash_str(value: str) -> str:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def hash_json(cls, value) -> str:
+        return cls.hash_str(json.dumps(value, sort_keys=True))
+
+    def load(self):
+        if not self.path.is_file():
+            return
+
+        try:
+            manifest = json.loads(self.path.read_text())
+        except json.decoder.JSONDecodeError as e:
+            util.print_warning(f"Ignoring unreadable build manifest '{self.path}': {e}")
+            return
+
+        if manifest.get("version") == self.version:
+            self.specs = manifest.get("specs", {})
+
+    def save(self):
+        self.path.write_text(json.dumps({"version": self.version, "specs": self.specs}, indent=4))
+
+    def _stat_file(self, path: str) -> dict:
+        # Hashes are only computed once per run, and only if the file's size or mtime changed.
+        try:
+            return self._file_hashes[path]
+        except KeyError:
+            pass
+
+        file = Path(path)
+        if file.is_file():
+            stat = file.stat()
+            entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "hash": None,
+            }
+        else:
+            entry = None
+
+        self._file_hashes[path] = entry
+        return entry
+
+    def _hash_file(self, path: str) -> str:
+        entry = self._stat_file(path)
+        if entry is None:
+            return None
+        if entry["hash"] is None:
+            entry["hash"] = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+        return entry["hash"]
+
+    def _is_file_unchanged(self, path: str, recorded: dict) -> bool:
+        entry = self._stat_file(path)
+        if entry is None:
+            return False
+        if entry["size"] == recorded["size"] and entry["mtime"] == recorded["mtime"]:
+            return True
+        if self._hash_file(path) != recorded["hash"]:
+            return False
+        # Only touched, remember the new timestamp so it isn't hashed again next run.
+        recorded.update(entry)
+        return True
+
+    def is_up_to_date(self, name: str, spec_hash: str, flags_hash: str, out_file: Path) -> bool:
+        recorded = self.specs.get(name)
+        if recorded is None or not out_file.is_file():
+            return False
+
+        if recorded["spec"] != spec_hash or recorded["flags"] != flags_hash:
+            return False
+
+        for path, file_entry in recorded["files"].items():
+            if not self._is_file_unchanged(path, file_entry):
+                return False
+
+        return True
+
+    def record(self, name: str, spec_hash: str, flags_hash: str, files: list[Path]):
+        file_entries = {}
+        for file in files:
+            path = str(file)
+            if self._hash_file(path) is not None:
+                file_entries[path] = dict(self._stat_file(path))
+
+        self.specs[name] = {
+            "spec": spec_hash,
+            "flags": flags_hash,
+            "files": file_entries,
+        }
+
+    def forget(self, name: str):
+        self.specs.pop(name, None)
+
+
+def parse_dependency_file(text: str) -> list[Path]:
+    # Parses a Makefile-style dependency file, as written by 'clang -MD -MF <file>'
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+
+    # Only the first rule is relevant, everything after the target's colon is a dependency.
+    rule = text.split("\n", 1)[0]
+    colon = rule.find(": ")
+    if colon < 0:
+        colon = rule.find(":")
+    rule = rule[colon + 1:]
+
+    retVal = []
+    current = ""
+    i = 0
+    while i < len(rule):
+        c = rule[i]
+        if c == "\\" and i + 1 < len(rule) and rule[i + 1] == " ":
+            current += " "
+            i += 1
+        elif c.isspace():
+            if current != "":
+                retVal.append(Path(current))
+            current = ""
+        else:
+            current += c
+        i += 1
+
+    if current != "":
+        retVal.append(Path(current))
+
+    return retVal
@@ -3,6 +3,10 @@ from typing import Union, Callable
 
 import settings
 
+# A named function rather than a lambda, so project configs can be pickled for worker processes.
+def default_preproc_cmd() -> str:
+    return settings.current.preprocessing.default_cmd
+
 class ConfigMacroProcessor:
     class ConfigMacroDef:
         name: str
@@ -35,7 +39,7 @@ class ConfigMacroProcessor:
     
     def __init__(self):
         self.macros = [
-            ConfigMacroProcessor.ConfigMacroDef("DEFAULT_PREPROC", lambda: settings.current.preprocessing.default_cmd)
+            ConfigMacroProcessor.ConfigMacroDef("DEFAULT_PREPROC", default_preproc_cmd)
         ]
         
     def add_macro(self, name: str, value: str | Callable):
@@ -0,0 +1,160 @@
+import hashlib, os, pickle, sys, tempfile
+from pathlib import Path
+
+import pycparser
+from pycparser.c_ast import Node
+
+import settings, util, version_info
+
+_declaration_cache = None
+
+class DeclarationCache:
+    # Cache of parsed top-level declarations, shared by every translation unit that includes the same headers.
+    # Entries are found by a hash of the declaration's normalized text and the typedef names it uses,
+    # and stored pickled, so every hit gets nodes of its own. They're grouped in shard files in the user
+    # cache directory, each loaded the first time it's needed and written back by save().
+    suffix = ".decl.pickle"
+    shard_count = 256
+    # Bumped when chunks are split or scoped differently, shards of another version are dropped
+    format_version = 2
+
+    directory: Path
+    max_size: int
+    shards: dict[str, dict[str, bytes]]
+    # Entries added since the last save, by shard
+    added: dict[str, dict[str, bytes]]
+    hits: int
+    misses: int
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.shards = {}
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        # Returns None if the cache is disabled. Entries are only kept in memory if there's no cache directory.
+        if not settings.current.cache.declaration_cache_enabled:
+            return None
+        directory = None
+        if settings.current.paths.rfa_cache_dir is not None:
+            directory = settings.current.paths.rfa_cache_dir.joinpath("declarations")
+        return cls(directory, settings.current.cache.declaration_cache_max_size_mb * 1024 * 1024)
+
+    @classmethod
+    def key(cls, text: str) -> str:
+        # Nodes pickled by another version of pycparser may not match its current node classes.
+        return hashlib.sha256(f"{cls.format_version}\0{version_info.version_string}\0{pycparser.__version__}\0{text}".encode("utf-8")).hexdigest()
+
+    def _shard_path(self, shard: str) -> Path:
+        return self.directory.joinpath(shard + self.suffix)
+
+    def _read_shard(self, shard: str) -> dict[str, bytes]:
+        if self.directory is None:
+            return {}
+        path = self._shard_path(shard)
+        try:
+            with path.open("rb") as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return {}
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError) as e:
+            util.print_warning(f"Discarding unreadable declaration cache shard '{path.name}': {e}")
+            path.unlink(missing_ok=True)
+            return {}
+
+        # Shards from before there was a version are plain dicts
+        if not isinstance(data, tuple) or data[0] != self.format_version:
+            path.unlink(missing_ok=True)
+            return {}
+        return data[1]
+
+    def _get_shard(self, key: str) -> dict[str, bytes]:
+        shard = key[:2]
+        entries = self.shards.get(shard)
+        if entries is None:
+            entries = self.shards[shard] = self._read_shard(shard)
+        return entries
+
+    def get(self, text: str) -> list[Node]:
+        key = self.key(text)
+        data = self._get_shard(key).get(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        try:
+            nodes = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            util.print_warning(f"Discarding unreadable declaration cache entry: {e}")
+            del self._get_shard(key)[key]
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return nodes
+
+    def put(self, text: str, nodes: list[Node]):
+        # Large function bodies nest deeper than the default recursion limit allows pickling.
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, 20000))
+        try:
+            data = pickle.dumps(nodes, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            return
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+        key = self.key(text)
+        self._get_shard(key)[key] = data
+        self.added.setdefault(key[:2], {})[key] = data
+
+    def save(self):
+        # Merges the entries added since the last save into the shard files, which other processes may
+        # have added to in the meantime. The oldest entries of a shard are dropped once it's over its share of the size cap.
+        if self.directory is None or len(self.added) == 0:
+            self.added.clear()
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        max_shard_size = self.max_size // self.shard_count
+        for shard, added in self.added.items():
+            entries = self._read_shard(shard)
+            entries.update(added)
+
+            size = sum(len(data) for data in entries.values())
+            for key in list(entries.keys()):
+                if size <= max_shard_size:
+                    break
+                size -= len(entries.pop(key))
+            self.shards[shard] = entries
+
+            # Written to a temporary file first, so other processes never see a partial shard.
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump((self.format_version, entries), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._shard_path(shard))
+
+        self.added.clear()
+
+    def clear(self):
+        self.shards.clear()
+        self.added.clear()
+        if self.directory is not None:
+            for path in self.directory.glob("*" + self.suffix):
+                path.unlink(missing_ok=True)
+
+    def __str__(self):
+        return f"Declaration cache: {self.hits} hits, {self.misses} misses"
+
+def get_declaration_cache() -> DeclarationCache:
+    # One declaration cache per process, shared by every spec it processes. Returns None if it's disabled.
+    global _declaration_cache
+
+    if _declaration_cache is None:
+        _declaration_cache = DeclarationCache.from_settings()
+
+    return _declaration_cache
@@ -0,0 +1,69 @@
+import sys, shutil, time
+from pathlib import Path
+
+import pycparser
+from pycparser import CParser
+
+import settings, util
+
+# Names of the PLY table modules. PLY doesn't validate optimized tables against the grammar,
+# so they're versioned to be regenerated whenever pycparser changes.
+_table_suffix = pycparser.__version__.replace(".", "_")
+lextab_name = f"rfa_lextab_{_table_suffix}"
+yacctab_name = f"rfa_yacctab_{_table_suffix}"
+
+# Where rfa.spec puts the tables inside the frozen app.
+bundled_tables_dir_name = "pycparser_tables"
+
+_parser: CParser = None
+setup_time: float = None
+first_parse_time: float = None
+
+def write_tables(out_dir: Path):
+    # Generates the lexer and parser tables into out_dir. Used by rfa.spec when building the frozen app.
+    out_dir.mkdir(parents=True, exist_ok=True)
+    CParser(lextab=lextab_name, yacctab=yacctab_name, taboutputdir=str(out_dir))
+
+def _tables_dir() -> Path:
+    tables_dir = settings.current.paths.rfa_cache_dir.joinpath("pycparser")
+    tables_dir.mkdir(parents=True, exist_ok=True)
+
+    # Seed the cache from the tables bundled into the frozen app, if there are any.
+    if util.is_build_version():
+        bundled_dir = Path(sys._MEIPASS).joinpath(bundled_tables_dir_name)
+        for name in [lextab_name, yacctab_name]:
+            file_name = name + ".py"
+            if not tables_dir.joinpath(file_name).is_file() and bundled_dir.joinpath(file_name).is_file():
+                shutil.copyfile(bundled_dir.joinpath(file_name), tables_dir.joinpath(file_name))
+
+    return tables_dir
+
+def get_parser() -> CParser:
+    # One parser per process, reused for every parse. CParser.parse resets all of its state.
+    # The PLY tables are loaded from the user cache directory, and written there the first time.
+    global _parser, setup_time
+
+    if _parser is None:
+        start = time.perf_counter()
+
+        tables_dir = str(_tables_dir())
+        # PLY imports its tables by module name
+        if tables_dir not in sys.path:
+            sys.path.append(tables_dir)
+
+        _parser = CParser(lextab=lextab_name, yacctab=yacctab_name, taboutputdir=tables_dir)
+        setup_time = time.perf_counter() - start
+
+    return _parser
+
+def parse(text: str, filename: str):
+    global first_parse_time
+
+    start = time.perf_counter()
+    ast = get_parser().parse(text, filename)
+
+    if first_parse_time is None:
+        # Includes building the parser, if this parse had to wait for it
+        first_parse_time = time.perf_counter() - start
+
+    return ast
@@ -1,15 +1,21 @@
 from pathlib import Path
-import subprocess
+import subprocess, tempfile, io, contextlib, traceback, time
+from concurrent.futures import ProcessPoolExecutor
 
 import pycparser
+from pycparser.plyparser import ParseError
 from pycparser.c_generator import CGenerator
 from pycparser.c_ast import *
 
 from project import ProjectConfig
-import settings
+from project.build_manifest import BuildManifest, parse_dependency_file
+from project.ast_cache import AstCache
+from project import parser_factory, prelude_cache, declaration_cache
+import settings, util, version_info
 
 from core.scanner import Scanner
-from core.cpreprocessor import Preprocessor
+from core.chunked_unit import ChunkedUnit
+from core.cpreprocessor import Preprocessor, PreprocessorSnapshot
 from core.macro import MacroSource, CodeSource, ExternalSource
 
 class PatchGenerator:
@@ -17,27 +23,270 @@ class PatchGenerator:
         "basic_analysis_only": "Performs basic analysis on the input to determine function dependencies.",
         "preprocess_only": "Preprocesses the input file and outputs the result."
     }
+    preproc_backends: dict[str, str] = {
+        "external": "Runs the project's preprocessor command.",
+        "internal": "Opt-in. Preprocesses in-process with the built-in preprocessor. Only '-D' and '-U' flags are used."
+    }
+    parse_modes: dict[str, str] = {
+        "full": "Parses the whole preprocessed file.",
+        "chunked": "Opt-in. Parses the requested functions, then only the declarations they need."
+    }
     
     config: ProjectConfig
+    manifest: BuildManifest
+    ast_cache: AstCache
+    dependency_file: Path
+    # Files read by the internal preprocessor, if it was used
+    read_files: list[Path]
+    profile: bool
     
     class CustomCGenerator(CGenerator):
         def _make_indent(self):
             return ' ' * self.indent_level
     
-    def __init__(self, config: ProjectConfig):
+    class SpecResult:
+        output: str
+        dependencies: list[Path]
+        error: str
+        stats: dict[str, int]
+        
+        def __init__(self, output: str, dependencies: list[Path], error: str, stats: dict[str, int]):
+            self.output = output
+            self.dependencies = dependencies
+            self.error = error
+            self.stats = stats
+    
+    def __init__(self, config: ProjectConfig, manifest: BuildManifest = None, profile: bool = False):
         self.config = config
+        self.manifest = manifest
+        self.ast_cache = AstCache.from_settings()
+        self.dependency_file = None
+        self.read_files = None
+        self.profile = profile
+        
+    def process(self, force: bool = False, jobs: int = 1) -> list[str]:
+        # Returns the names of the specs that failed.
+        if self.config.preproc_backend not in self.preproc_backends:
+            raise ValueError(f"'{self.config.preproc_backend}' is not a valid preprocessor backend.")
+        if self.config.parse_mode not in self.parse_modes:
+            raise ValueError(f"'{self.config.parse_mode}' is not a valid parse mode.")
+        
+        pending: list[str] = []
+        hashes: dict[str, tuple[str, str]] = {}
         
-    def process(self):
         for name, spec in self.config.process_specs.items():
-            if spec.mode in self.modes:
-                getattr(self, spec.mode)(spec)
-            else:
+            if spec.mode not in self.modes:
                 raise ValueError(f"'{spec.mode}' is not a valid analysis mode.")
+            
+            if self.manifest is not None:
+                spec_hash = BuildManifest.hash_json(spec.as_dict())
+                flags_hash = BuildManifest.hash_json(self._effective_flags(spec))
+                
+                if not force and self.manifest.is_up_to_date(name, spec_hash, flags_hash, spec.out_file):
+                    print(f"'{name}' is up to date, skipping.")
+                    continue
+                
+                hashes[name] = (spec_hash, flags_hash)
+                self.manifest.forget(name)
+            
+            pending.append(name)
+        
+        if jobs > 1 and len(pending) > 1:
+            results = self._process_parallel(pending, jobs)
+        else:
+            results = (self._process_spec(name, self.manifest is not None) for name in pending)
+        
+        failed = []
+        stats: dict[str, int] = {}
+        # Results always arrive in config order, whatever order the specs finished in.
+        for name, result in zip(pending, results):
+            print(result.output, end="")
+            
+            if result.error is not None:
+                util.print_error(f"'{name}' failed:\n{result.error}")
+                failed.append(name)
+            elif self.manifest is not None and result.dependencies is not None:
+                self.manifest.record(name, *hashes[name], result.dependencies)
+            
+            # Saved after every spec, so a failure later on doesn't discard finished work.
+            if self.manifest is not None:
+                self.manifest.save()
+            
+            for key, value in result.stats.items():
+                stats[key] = stats.get(key, 0) + value
+        
+        self._print_stats(stats)
+        return failed
+    
+    def _print_stats(self, stats: dict[str, int]):
+        if "ast_cache_hits" in stats:
+            print(f"AST cache: {stats['ast_cache_hits']} hits, {stats['ast_cache_misses']} misses")
+        if stats.get("declaration_cache_hits", 0) + stats.get("declaration_cache_misses", 0) > 0:
+            print(f"Declaration cache: {stats['declaration_cache_hits']} hits, {stats['declaration_cache_misses']} misses")
+    
+    def _process_spec(self, name: str, track: bool, capture_output: bool = False) -> SpecResult:
+        # Exceptions are reported per spec instead of aborting the whole run.
+        spec = self.config.process_specs[name]
+        output = io.StringIO()
+        stats = {}
+        dependencies = None
+        error = None
+        
+        if self.ast_cache is not None:
+            cache_hits = self.ast_cache.hits
+            cache_misses = self.ast_cache.misses
+        decl_cache = declaration_cache.get_declaration_cache()
+        if decl_cache is not None:
+            decl_cache_hits = decl_cache.hits
+            decl_cache_misses = decl_cache.misses
+        
+        try:
+            with contextlib.redirect_stdout(output) if capture_output else contextlib.nullcontext():
+                if track:
+                    dependencies = self._run_tracked(spec)
+                else:
+                    getattr(self, spec.mode)(spec)
+        except Exception:
+            dependencies = None
+            error = traceback.format_exc()
+        
+        if self.ast_cache is not None:
+            stats["ast_cache_hits"] = self.ast_cache.hits - cache_hits
+            stats["ast_cache_misses"] = self.ast_cache.misses - cache_misses
+        if decl_cache is not None:
+            stats["declaration_cache_hits"] = decl_cache.hits - decl_cache_hits
+            stats["declaration_cache_misses"] = decl_cache.misses - decl_cache_misses
+        
+        return PatchGenerator.SpecResult(output.getvalue(), dependencies, error, stats)
+    
+    def _process_parallel(self, pending: list[str], jobs: int) -> list[SpecResult]:
+        out_files: dict[Path, str] = {}
+        for name in pending:
+            out_file = self.config.process_specs[name].out_file
+            if out_file in out_files:
+                raise ValueError(f"'{out_files[out_file]}' and '{name}' both write to '{out_file}'. Run them with '--jobs 1'.")
+            out_files[out_file] = name
+        
+        # Makes sure the parser tables exist before the workers race to write them.
+        if any(self.config.process_specs[name].mode == "basic_analysis_only" for name in pending):
+            needs_setup = parser_factory.setup_time is None
+            parser_factory.get_parser()
+            if needs_setup:
+                self._print_profile("parser setup", parser_factory.setup_time)
+            # Same for the prelude snapshot, the workers then load it from the cache.
+            self._get_prelude()
+        
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, len(pending)),
+            initializer=_init_worker,
+            initargs=(settings.current.s_dict, settings.current.paths),
+        ) as executor:
+            futures = [
+                executor.submit(_process_spec_in_worker, self.config, name, self.manifest is not None, self.profile)
+                for name in pending
+            ]
+            
+            return [future.result() for future in futures]
+    
+    def _effective_flags(self, spec: ProjectConfig.FileSpec) -> dict:
+        return {
+            "version": version_info.version_string,
+            "preproc_backend": self.config.preproc_backend,
+            "preproc_command": str(self.config.preproc_command_path) if spec.preprocess and not self._is_internal(spec) else None,
+            "default_flags": settings.current.preprocessing.default_flags,
+            "preproc_flags": self.config.preproc_flags,
+            "includes": [str(i) for i in self.config.includes],
+            "prelude": [str(i) for i in self.config.prelude],
+            "parse_mode": self.config.parse_mode,
+        }
+    
+    def _dependency_args(self) -> list[str]:
+        # Has the preprocessor write out every file it read, if dependencies are being tracked.
+        if self.dependency_file is None:
+            return []
+        return ["-MD", "-MF", str(self.dependency_file)]
+    
+    def _run_tracked(self, spec: ProjectConfig.FileSpec) -> list[Path]:
+        # Returns every file the spec's output depends on, or None if the run failed.
+        if not spec.preprocess:
+            result = getattr(self, spec.mode)(spec)
+            return [spec.in_file] + self._prelude_dependencies(spec) if result in (None, 0) else None
+        
+        if self._is_internal(spec):
+            result = getattr(self, spec.mode)(spec)
+            if result not in (None, 0):
+                return None
+            return [spec.in_file] + self.read_files + self._prelude_dependencies(spec)
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.dependency_file = Path(temp_dir).joinpath("deps.d")
+            try:
+                result = getattr(self, spec.mode)(spec)
+                
+                if result not in (None, 0):
+                    util.print_error(f"'{spec.in_file}' failed with exit code {result}, it will be regenerated next run.")
+                    return None
+                elif self.dependency_file.is_file():
+                    dependencies = parse_dependency_file(self.dependency_file.read_text())
+                else:
+                    util.print_warning(f"Preprocessor didn't report the dependencies of '{spec.in_file}'. Only the file itself will be tracked.")
+                    dependencies = []
+            finally:
+                self.dependency_file = None
+        
+        # The dependency file's paths are relative to the working directory the preprocessor ran in.
+        return [spec.in_file] + [i.resolve() for i in dependencies] + self._prelude_dependencies(spec)
+    
+    def _get_prelude(self) -> PreprocessorSnapshot:
+        # Returns None if the project has no prelude.
+        if len(self.config.prelude) == 0:
+            return None
+        return prelude_cache.get_snapshot(self.config.prelude, self.config.includes, self._preproc_flags())
+    
+    def _prelude_dependencies(self, spec: ProjectConfig.FileSpec) -> list[Path]:
+        if spec.mode != "basic_analysis_only" or len(self.config.prelude) == 0:
+            return []
+        return self.config.prelude + [Path(i) for i in sorted(self._get_prelude().files)]
+    
+    def _is_internal(self, spec: ProjectConfig.FileSpec) -> bool:
+        return spec.preprocess and self.config.preproc_backend == "internal"
+    
+    def _preproc_flags(self) -> list[str]:
+        return settings.current.preprocessing.default_flags + self.config.preproc_flags
+    
+    def _create_preprocessor(self, spec: ProjectConfig.FileSpec, use_prelude: bool) -> Preprocessor:
+        # The internal backend reads includes and writes the preprocessed code, otherwise only
+        # the file itself is read to collect its includes and macros.
+        if not self._is_internal(spec):
+            preproc = Preprocessor([str(i) for i in self.config.includes], "", False)
+            prelude = self._get_prelude() if use_prelude else None
+            if prelude is not None:
+                preproc.fork(prelude)
+            return preproc
+        
+        preproc = Preprocessor(
+            [str(i) for i in self.config.includes], "", True,
+            header_cache=prelude_cache.get_header_cache(), emit_output=True
+        )
+        prelude = self._get_prelude() if use_prelude else None
+        if prelude is not None:
+            # The prelude's snapshot has the flags' macros already.
+            preproc.fork(prelude)
+        else:
+            preproc.handle_command_line_macros(self._preproc_flags())
+        return preproc
+    
+    def _run_preprocessor(self, spec: ProjectConfig.FileSpec, preproc: Preprocessor):
+        start = time.perf_counter()
+        preproc.exec(spec.in_file)
+        if self._is_internal(spec):
+            self.read_files = [Path(i).resolve() for i in sorted(preproc.include_graph.files())]
+            self._print_profile("preprocess", time.perf_counter() - start)
     
     def _create_source_include_code(self, preproc: Preprocessor) -> str:
         retVal = ""
         
-        for include in sorted(preproc.detected_includes):
+        for include in sorted(preproc.main_includes):
             retVal += f"#include {include}\n"
             
         return retVal
@@ -45,8 +294,12 @@ class PatchGenerator:
     def _create_source_macro_code(self, preproc: Preprocessor) -> str:
         retVal = ""
         for name, macro in preproc.macros.items():
-            if isinstance(macro.macros, tuple) and len(macro.macros) > 1:
-                macro_str: str = macro.macros[1]
+            # Macros from the prelude or included headers belong to those, not to this file.
+            if preproc.main_macros.get(name) is not macro:
+                continue
+            
+            if isinstance(macro.source, tuple) and len(macro.source) > 1:
+                macro_str: str = macro.source[1]
                 
                 # Not a perfect solution, but good enough for now.
                 if not macro_str.strip().startswith("#"):
@@ -77,11 +330,18 @@ class PatchGenerator:
             nodes = scanner.node
         
         for name, node in reversed(nodes.items()):
-            if name in scanner.types:
+            # Enumerators only have a node of their own if their enum has no typedef or tag
+            if name in scanner.types or name in scanner.constants:
                 retVal += c_gen.visit(node) + ";\n"
         
         return retVal
     
+    @staticmethod
+    def _extern_view(var: Decl) -> Decl:
+        # An extern declaration of the variable that shares its type. The scanned node isn't changed,
+        # so the same AST can be emitted again, by another spec or from a cache.
+        return Decl(var.name, var.quals, var.align, ['extern'] + var.storage, var.funcspec, var.type, None, var.bitsize, var.coord)
+    
     def _create_ast_variable_externs(self, scanner: Scanner, c_gen: CGenerator, filter: str = None):
         retVal = ""
         if filter is not None:
@@ -95,10 +355,7 @@ class PatchGenerator:
                 # We'll deal with static variables later:
                 if 'static' in var.storage:
                     continue
-                # Convert the node into a extern declaration:
-                var.storage.insert(0, 'extern')
-                var.init = None
-                retVal += c_gen.visit(var) + ";\n"
+                retVal += c_gen.visit(self._extern_view(var)) + ";\n"
         
         return retVal
     
@@ -115,10 +372,7 @@ class PatchGenerator:
                 # We'll deal with static variables later:
                 if 'static' not in var.storage:
                     continue
-                # Convert the node into a extern declaration:
-                var.storage.insert(0, 'extern')
-                var.init = None
-                retVal += c_gen.visit(var) + ";\n"
+                retVal += c_gen.visit(self._extern_view(var)) + ";\n"
         
         return retVal
                 
@@ -138,22 +392,90 @@ class PatchGenerator:
         
         return retVal
         
+    def _print_profile(self, label: str, seconds: float):
+        if self.profile:
+            print(f"[profile] {label}: {seconds:.3f}s")
+    
+    def _preprocess(self, spec: ProjectConfig.FileSpec, preproc: Preprocessor) -> str:
+        start = time.perf_counter()
+        if self._is_internal(spec):
+            text = preproc.get_output()
+        elif spec.preprocess:
+            text = pycparser.preprocess_file(
+                spec.in_file,
+                cpp_path=str(self.config.preproc_command_path),
+                cpp_args=settings.current.preprocessing.default_flags + self.config.preproc_flags
+                + [f"-I{i}" for i in self.config.includes]
+                + self._dependency_args()
+            )
+        else:
+            text = spec.in_file.read_text()
+        if not self._is_internal(spec):
+            self._print_profile("preprocess", time.perf_counter() - start)
+        return text
+    
+    def _parse(self, spec: ProjectConfig.FileSpec, text: str) -> FileAST:
+        # Same as pycparser.parse_file, but looks the AST up in the cache before parsing.
+        filename = str(spec.in_file)
+        if self.ast_cache is not None:
+            start = time.perf_counter()
+            ast = self.ast_cache.get(text, filename)
+            if ast is not None:
+                self._print_profile("AST cache load", time.perf_counter() - start)
+                return ast
+        
+        is_first_parse = parser_factory.first_parse_time is None
+        needs_setup = parser_factory.setup_time is None
+        start = time.perf_counter()
+        ast = parser_factory.parse(text, filename)
+        if needs_setup:
+            self._print_profile("parser setup", parser_factory.setup_time)
+            self._print_profile("parse", time.perf_counter() - start - parser_factory.setup_time)
+        else:
+            self._print_profile("parse", time.perf_counter() - start)
+        if is_first_parse:
+            self._print_profile("time to first parse", parser_factory.first_parse_time)
+        
+        if self.ast_cache is not None:
+            self.ast_cache.put(text, filename, ast)
+        
+        return ast
+    
+    def _scan(self, spec: ProjectConfig.FileSpec, text: str, scanner: Scanner):
+        if self.config.parse_mode != "chunked":
+            scanner.exec(self._parse(spec, text))
+            return
+        
+        needs_setup = parser_factory.setup_time is None
+        parser = parser_factory.get_parser()
+        if needs_setup:
+            self._print_profile("parser setup", parser_factory.setup_time)
+        
+        start = time.perf_counter()
+        cache = declaration_cache.get_declaration_cache()
+        unit = ChunkedUnit(text, str(spec.in_file), parser, cache)
+        try:
+            scanner.exec_chunked(unit)
+        except ParseError as e:
+            # A declaration that doesn't parse on its own, the whole file might
+            util.print_warning(f"Couldn't parse '{spec.in_file}' a declaration at a time ({e}), parsing all of it instead.")
+            scanner.reset()
+            scanner.exec(self._parse(spec, text))
+            return
+        finally:
+            if cache is not None:
+                cache.save()
+        self._print_profile(f"chunked parse, {unit}", time.perf_counter() - start)
+    
     def basic_analysis_only(self, spec: ProjectConfig.FileSpec):
         # Analyze code file:
         # Not using deep analyis right now:
-        preproc = Preprocessor([str(i) for i in self.config.includes], "", False)
-        preproc.exec(spec.in_file)
+        preproc = self._create_preprocessor(spec, True)
+        self._run_preprocessor(spec, preproc)
         
         # Analyze preprocessed AST:
-        ast = pycparser.parse_file(
-            spec.in_file,
-            use_cpp=spec.preprocess,
-            cpp_path=str(self.config.preproc_command_path),
-            cpp_args=settings.current.preprocessing.default_flags + self.config.preproc_flags
-            + [f"-I{i}" for i in self.config.includes]
-        )
         scanner = Scanner(spec.functions)
-        scanner.exec(ast)
+        self._scan(spec, self._preprocess(spec, preproc), scanner)
         
         # Prepping for output:
         c_gen = self.CustomCGenerator()
@@ -208,11 +530,18 @@ class PatchGenerator:
         spec.out_file.write_text(output)
     
     def preprocess_only(self, spec: ProjectConfig.FileSpec):
+        if self._is_internal(spec):
+            preproc = self._create_preprocessor(spec, False)
+            self._run_preprocessor(spec, preproc)
+            spec.out_file.write_text(preproc.get_output())
+            return 0
+        
         result = subprocess.run(
             [str(self.config.preproc_command_path), str(spec.in_file)]
             + settings.current.preprocessing.default_flags
             + self.config.preproc_flags
             + [f"-I{i}" for i in self.config.includes]
+            + self._dependency_args()
             + ["-o", str(spec.out_file)],
         )
 
@@ -274,4 +603,13 @@ class PatchGenerator:
     #             out_code += c_gen.visit(node) + ";\n"
             
     #     spec.out_file.write_text(out_code)
-        
+
+
+# Worker process entry points for PatchGenerator._process_parallel. These live at module level so they can be pickled.
+def _init_worker(settings_dict: dict, paths: settings.path_handler.PathHandler):
+    # Workers started with 'spawn' don't inherit the parent's loaded settings.
+    settings.current = settings.SettingsWrapper(settings_dict)
+    settings.current.paths = paths
+
+def _process_spec_in_worker(config: ProjectConfig, name: str, track: bool, profile: bool) -> PatchGenerator.SpecResult:
+    return PatchGenerator(config, profile=profile)._process_spec(name, track, capture_output=True)
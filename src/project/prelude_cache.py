@@ -0,0 +1,116 @@
+import hashlib, json, os, pickle, tempfile
+from pathlib import Path
+
+from core.cpreprocessor import Preprocessor, PreprocessorSnapshot
+from core.header_cache import HeaderCache
+import settings, util, version_info
+
+# Snapshots already preprocessed or loaded by this process, by cache key.
+_snapshots: dict[str, PreprocessorSnapshot] = {}
+_header_cache: HeaderCache = None
+
+class PreludeCache:
+    # On-disk cache of Preprocessor snapshots taken after reading a project's prelude files.
+    # An entry is found by the prelude's paths and include dirs, and is only used while every file
+    # the prelude read still has the content hash it was saved with.
+    suffix = ".prelude.pickle"
+
+    directory: Path
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    @classmethod
+    def from_settings(cls):
+        # Returns None if the cache is disabled.
+        if not settings.current.cache.prelude_cache_enabled or settings.current.paths.rfa_cache_dir is None:
+            return None
+        return cls(settings.current.paths.rfa_cache_dir.joinpath("prelude"))
+
+    @staticmethod
+    def key(prelude: list[Path], includes: list[Path], flags: list[str]) -> str:
+        # Snapshots pickled by another version may not match the current macro classes.
+        value = json.dumps([version_info.version_string, [str(i) for i in prelude], [str(i) for i in includes], flags])
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def hash_files(files: list[str]) -> dict[str, str]:
+        retVal = {}
+        for path in sorted(files):
+            try:
+                retVal[path] = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+            except OSError:
+                retVal[path] = None
+        return retVal
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory.joinpath(key + self.suffix)
+
+    def get(self, key: str) -> PreprocessorSnapshot:
+        path = self._entry_path(key)
+        try:
+            with path.open("rb") as file:
+                (file_hashes, snapshot) = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError) as e:
+            util.print_warning(f"Discarding unreadable prelude cache entry '{path.name}': {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+        if self.hash_files(file_hashes.keys()) != file_hashes:
+            return None
+        return snapshot
+
+    def put(self, key: str, files: list[str], snapshot: PreprocessorSnapshot):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data = pickle.dumps((self.hash_files(files), snapshot), pickle.HIGHEST_PROTOCOL)
+
+        # Written to a temporary file first, so parallel workers never see a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, self._entry_path(key))
+
+    def clear(self):
+        for path in self.directory.glob("*" + self.suffix):
+            path.unlink(missing_ok=True)
+
+def get_header_cache() -> HeaderCache:
+    # One header cache per process, shared by every preprocessor that reads includes.
+    # Returns None if it's disabled. Records are only kept in memory if there's no cache directory.
+    global _header_cache
+    
+    if _header_cache is None and settings.current.cache.header_cache_enabled:
+        directory = None
+        if settings.current.paths.rfa_cache_dir is not None:
+            directory = settings.current.paths.rfa_cache_dir.joinpath("headers")
+        _header_cache = HeaderCache(directory)
+    
+    return _header_cache
+
+def get_snapshot(prelude: list[Path], includes: list[Path], flags: list[str]) -> PreprocessorSnapshot:
+    # One snapshot per prelude and process. Loaded from the cache if it's there and up to date,
+    # otherwise the prelude is preprocessed and the snapshot saved for next time.
+    # The flags' macros are defined first, and the snapshot keeps the prelude's output.
+    key = PreludeCache.key(prelude, includes, flags)
+    snapshot = _snapshots.get(key)
+    if snapshot is not None:
+        return snapshot
+
+    cache = PreludeCache.from_settings()
+    if cache is not None:
+        snapshot = cache.get(key)
+
+    if snapshot is None:
+        preproc = Preprocessor([str(i) for i in includes], "", header_cache=get_header_cache(), emit_output=True)
+        preproc.handle_command_line_macros(flags)
+        for path in prelude:
+            preproc.exec(str(path))
+        snapshot = preproc.snapshot()
+
+        if cache is not None:
+            cache.put(key, [str(i) for i in prelude] + list(snapshot.files), snapshot)
+
+    _snapshots[key] = snapshot
+    return snapshot
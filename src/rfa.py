@@ -1,4 +1,4 @@
-import sys
+import sys, multiprocessing
 
 from colors import *
 import util
@@ -38,4 +38,6 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
+    # Needed for worker processes in the pyinstaller bundle.
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
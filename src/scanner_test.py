@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pycparser import CParser
+from pycparser.c_ast import Decl
+
+from core.scanner import Scanner
+from core.chunked_unit import ChunkedUnit
+from project.declaration_cache import DeclarationCache
+
+tu_a = """
+typedef int s32;
+struct Vec { s32 x; s32 y; };
+s32 gCounter;
+s32 helper(struct Vec* v);
+s32 entry_a(void) { struct Vec v; return helper(&v) + gCounter; }
+"""
+
+tu_b = """
+typedef float f32;
+union Value { f32 f; int i; };
+f32 gScale;
+static int unused;
+f32 entry_b(union Value* v) { return v->f * gScale; }
+"""
+
+def parse(code : str):
+    return CParser().parse(code, "<test>")
+
+def symbols(scanner : Scanner) -> dict:
+    return {
+        "functions": set(scanner.functions),
+        "variables": set(scanner.variables),
+        "types": set(scanner.types),
+        "node": set(scanner.node.keys()),
+        "structs": set(scanner.structs),
+        "unions": set(scanner.unions),
+        "enums": set(scanner.enums),
+        "tag_node": set(scanner.tag_node.keys()),
+    }
+
+def scan(code : str, funcs : list[str]) -> dict:
+    scanner = Scanner(funcs)
+    scanner.exec(parse(code))
+    return symbols(scanner)
+
+def back_to_back_test():
+    print("\nBack to back test")
+
+    expected_a = {
+        "functions": {"helper"},
+        "variables": {"gCounter"},
+        "types": {"s32", "int", "void"},
+        "node": {"entry_a", "helper", "gCounter", "s32"},
+        "structs": {"Vec"},
+        "unions": set(),
+        "enums": set(),
+        "tag_node": {"Vec"},
+    }
+    expected_b = {
+        "functions": set(),
+        "variables": {"gScale"},
+        "types": {"f32", "float", "int"},
+        "node": {"entry_b", "gScale", "f32"},
+        "structs": set(),
+        "unions": {"Value"},
+        "enums": set(),
+        "tag_node": {"Value"},
+    }
+
+    a = scan(tu_a, ["entry_a"])
+    b = scan(tu_b, ["entry_b"])
+    assert a == expected_a
+    assert b == expected_b
+
+    # The same scanner, reused for the second translation unit
+    scanner = Scanner(["entry_a"])
+    scanner.exec(parse(tu_a))
+    assert symbols(scanner) == expected_a
+    scanner.reset(["entry_b"])
+    scanner.exec(parse(tu_b))
+    assert symbols(scanner) == expected_b
+
+# Declarations the entry needs come both before and after it, and only the others need them
+tu_c = """
+typedef int s32;
+typedef unsigned char u8;
+typedef s32 Index;
+struct Node;
+s32 walk(struct Node* n);
+s32 entry_c(void) { return walk(0) + COUNT; }
+enum { COUNT = 4 };
+struct Node { struct Node* next; Index index; u8 tag; };
+s32 walk(struct Node* n) { return n->index; }
+static int unused;
+"""
+
+# A typedef'd enum, whose enumerators are values and not type names
+tu_d = """
+typedef enum { STATE_IDLE, STATE_RUN = 2 } State;
+State gState;
+int entry_d(int x) { return (STATE_RUN) - x + (gState == STATE_IDLE); }
+"""
+
+# Symbols only used in a local initializer, or as a bit-field's width
+tu_e = """
+typedef int s32;
+enum { K = 3 };
+enum { WIDTH = 4 };
+s32 gX;
+s32 helper(void);
+struct Bits { s32 flag : WIDTH; };
+s32 entry_e(void) { s32 v = helper() + gX + K; struct Bits b; return v + b.flag; }
+"""
+
+def closure_test():
+    print("\nClosure test")
+
+    expected = {
+        "functions": {"walk"},
+        "variables": set(),
+        "types": {"s32", "int", "void", "Index", "u8", "unsigned", "char"},
+        "node": {"entry_c", "walk", "COUNT", "s32", "Index", "u8"},
+        "structs": {"Node"},
+        "unions": set(),
+        "enums": set(),
+        "tag_node": {"Node"},
+    }
+
+    scanner = Scanner(["entry_c"])
+    scanner.exec(parse(tu_c))
+    print(symbols(scanner))
+    assert symbols(scanner) == expected
+    assert scanner.constants == {"COUNT"}
+    # Reversed, the nodes are in source order
+    assert list(reversed(scanner.node)) == ["s32", "u8", "Index", "walk", "entry_c", "COUNT"]
+    # Every node is in its file's bucket, in the same order
+    assert list(scanner.filter_nodes_by_source(Path("<test>"))) == list(scanner.node)
+    assert list(scanner.filter_tag_nodes_by_source(Path("<test>"))) == ["Node"]
+    assert len(scanner.filter_nodes_by_source(Path("other.h"))) == 0
+
+    scanner = Scanner(["entry_e"])
+    scanner.exec(parse(tu_e))
+    assert scanner.functions == {"helper"}
+    assert scanner.variables == {"gX"}
+    assert scanner.constants == {"K", "WIDTH"}
+    assert scanner.structs == {"Bits"}
+
+def chunked_test():
+    print("\nChunked test")
+
+    for code, funcs in [(tu_d, ["entry_d"]), (tu_a, ["entry_a"]), (tu_b, ["entry_b"]), (tu_e, ["entry_e"]), (tu_c, ["entry_c"])]:
+        parser = CParser()
+        unit = ChunkedUnit(code, "<test>", parser)
+        scanner = Scanner(funcs)
+        scanner.exec_chunked(unit)
+        print(unit)
+        assert symbols(scanner) == scan(code, funcs)
+        if code is tu_d:
+            # Only the declarator is a typedef name, the enumerators are still found by name
+            assert list(unit.typedef_chunks) == ["State"]
+            assert "STATE_RUN" not in scanner.types
+
+    # The unused variable is never parsed, and walk's body isn't either
+    assert "unused" in unit.name_chunks
+    assert isinstance(scanner.node["walk"], Decl)
+
+    # A second unit gets every declaration from the cache, with nodes of its own
+    cache = DeclarationCache(None, 1 << 20)
+    results = []
+    for i in range(2):
+        scanner = Scanner(["entry_c"])
+        scanner.exec_chunked(ChunkedUnit(tu_c, "<test>", CParser(), cache))
+        results.append(scanner)
+    print(cache)
+    assert cache.hits == cache.misses and symbols(results[0]) == symbols(results[1])
+    assert results[0].node["s32"] is not results[1].node["s32"]
+
+def threads_test():
+    print("\nThreads test")
+
+    jobs = [(tu_a, ["entry_a"]), (tu_b, ["entry_b"])] * 16
+    expected = [scan(code, funcs) for code, funcs in jobs]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda job: scan(*job), jobs))
+
+    assert results == expected
+    print(f"{len(jobs)} scans matched")
+
+def main():
+    back_to_back_test()
+    closure_test()
+    chunked_test()
+    threads_test()
+
+if __name__ == "__main__":
+    main()
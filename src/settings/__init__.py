@@ -13,6 +13,14 @@ def default_settings_dict():
             "default_flags": [
                 "-E"
             ]
+        },
+        "cache": {
+            "ast_cache_enabled": True,
+            "ast_cache_max_size_mb": 1024,
+            "prelude_cache_enabled": True,
+            "header_cache_enabled": True,
+            "declaration_cache_enabled": True,
+            "declaration_cache_max_size_mb": 512
         }
     }
 
@@ -82,13 +90,65 @@ class SettingsWrapper(SettingsWrapperBase):
         def default_flags(self, value: str):
             self.s_dict["default_flags"] = value
     
+    class CacheSettings(SettingsWrapperBase):
+        
+        @property
+        def ast_cache_enabled(self):
+            return self.s_dict["ast_cache_enabled"]
+        
+        @ast_cache_enabled.setter
+        def ast_cache_enabled(self, value: bool):
+            self.s_dict["ast_cache_enabled"] = value
+            
+        @property
+        def ast_cache_max_size_mb(self):
+            return self.s_dict["ast_cache_max_size_mb"]
+        
+        @ast_cache_max_size_mb.setter
+        def ast_cache_max_size_mb(self, value: int):
+            self.s_dict["ast_cache_max_size_mb"] = value
+            
+        @property
+        def prelude_cache_enabled(self):
+            return self.s_dict["prelude_cache_enabled"]
+        
+        @prelude_cache_enabled.setter
+        def prelude_cache_enabled(self, value: bool):
+            self.s_dict["prelude_cache_enabled"] = value
+            
+        @property
+        def header_cache_enabled(self):
+            return self.s_dict["header_cache_enabled"]
+        
+        @header_cache_enabled.setter
+        def header_cache_enabled(self, value: bool):
+            self.s_dict["header_cache_enabled"] = value
+            
+        @property
+        def declaration_cache_enabled(self):
+            return self.s_dict["declaration_cache_enabled"]
+        
+        @declaration_cache_enabled.setter
+        def declaration_cache_enabled(self, value: bool):
+            self.s_dict["declaration_cache_enabled"] = value
+            
+        @property
+        def declaration_cache_max_size_mb(self):
+            return self.s_dict["declaration_cache_max_size_mb"]
+        
+        @declaration_cache_max_size_mb.setter
+        def declaration_cache_max_size_mb(self, value: int):
+            self.s_dict["declaration_cache_max_size_mb"] = value
+    
     preprocessing: PreprocessorSettings
+    cache: CacheSettings
     paths = path_handler.PathHandler
     
     def __init__(self, s_dict: dict):
         super().__init__(s_dict)
         
         self.preprocessing = SettingsWrapper.PreprocessorSettings(s_dict["preprocessing"])
+        self.cache = SettingsWrapper.CacheSettings(s_dict["cache"])
         self.paths = path_handler.PathHandler()
 
     def load_paths(self):
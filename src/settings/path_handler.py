@@ -10,6 +10,7 @@ class PathHandler:
     
     rfa_user_dir: Path = None
     rfa_user_settings_path: Path = None
+    rfa_cache_dir: Path = None
 
     def load_paths(self):
         if util.is_build_version():
@@ -40,6 +41,7 @@ class PathHandler:
             
         # 
         self.rfa_user_settings_path = self.rfa_user_dir.joinpath("rfa_settings.json")
+        self.rfa_cache_dir = self.rfa_user_dir.joinpath("cache")
     
     
 def make_path_str_forward_slashed(path_str: str) -> str: